@@ -0,0 +1,210 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import argparse
+from datetime import datetime as dt
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from demo_data import Basal, Boluses, Dexcom, Meals, Messages, SMBG, finalise_records
+from ids import IDAllocator
+from segments import load_library, write_library
+from writers import merge_streams, write_records
+
+DAYS = [7, 30, 365, 3650]
+
+# the most precise clock available, perf_counter being Python 3 only
+clock = getattr(time, 'perf_counter', time.time)
+
+# every run starts its trace around the same time, so runs differ only in their number of days
+START = dt(2014, 1, 1, 12)
+
+def synthetic_library(out_file, seed=0, low=40, high=400, per_start=3):
+    """Write a compiled segment library of random walks, per_start segments for every start value from low to high."""
+
+    rng = random.Random(seed)
+
+    keys, segments = [], []
+
+    for start in range(low, high + 1):
+        keys.append((start, per_start))
+        for i in range(per_start):
+            value, segment = start, []
+            for j in range(rng.randint(6, 60)):
+                segment.append(value)
+                value = max(low, min(high, value + rng.randint(-4, 4)))
+            segments.append(segment)
+
+    write_library(keys, segments, out_file)
+
+class StageTimer:
+    """Time, and optionally trace the peak memory allocated by, each stage of a run."""
+
+    def __init__(self, memory):
+
+        self.memory = memory
+
+        self.results = []
+
+    def run(self, stage, function):
+
+        if self.memory:
+            tracemalloc.start()
+
+        start = clock()
+
+        value = function()
+
+        seconds = clock() - start
+
+        result = {'stage': stage, 'seconds': seconds}
+
+        if self.memory:
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        self.results.append(result)
+
+        return value
+
+def run_stages(library, num_days, seed, backend, out_file, memory=False):
+    """Generate num_days of demo data a stage at a time, as one window, returning the result of each stage."""
+
+    random.seed(seed)
+
+    timer = StageTimer(memory)
+
+    dex = Dexcom(None, num_days, backend, segments=library, start=START)
+
+    timer.run('dexcom', dex.generate_JSON)
+
+    smbg = timer.run('smbg', lambda: SMBG(dex))
+
+    meals = timer.run('meals', lambda: Meals(smbg))
+
+    boluses = timer.run('boluses', lambda: Boluses(meals))
+
+    basal = timer.run('basal', lambda: Basal({}, boluses.json, meals.carbs))
+
+    messages = timer.run('messages', lambda: Messages(smbg))
+
+    streams = [dex.json, smbg.json, basal.json, meals.json, boluses.json, messages.json]
+
+    ids = IDAllocator(seed=seed)
+
+    count = timer.run('write', lambda: write_records(finalise_records(merge_streams(streams), ids), out_file, 'ndjson'))
+
+    for result in timer.results:
+        result['num_days'] = num_days
+        result['records'] = count
+
+    return timer.results
+
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    """Return the results more than tolerance times slower than the same stage and number of days in baseline.
+
+    Stages that took less than min_seconds in the baseline are too noisy to compare.
+    """
+
+    previous = dict(((r['stage'], r['num_days']), r['seconds']) for r in baseline['results'])
+
+    slower = []
+
+    for result in results:
+        before = previous.get((result['stage'], result['num_days']))
+        if before and before >= min_seconds and result['seconds'] > tolerance * before:
+            slower.append(dict(result, baseline_seconds=before))
+
+    return slower
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark each stage of demo data generation across numbers of days, on a synthetic segment library.')
+    parser.add_argument('-n', '--num_days', action='store', dest='num_days', type=int, nargs='+', default=DAYS, help='numbers of days to generate;\ndefault is ' + ' '.join(str(d) for d in DAYS))
+    parser.add_argument('-b', '--backend', action='store', dest='backend', default='python', choices=['python', 'numpy'], help='engine used to build the Dexcom trace;\ndefault is python')
+    parser.add_argument('-s', '--seed', action='store', dest='seed', default=0, type=int, help='random seed of the library and the generated data;\ndefault is 0')
+    parser.add_argument('-m', '--memory', action='store_true', dest='memory', help='use this flag to also trace the peak memory allocated by each stage, in a second run so the tracing does not skew the times; needs Python 3')
+    parser.add_argument('-o', '--output_file', action='store', dest='output_file', help='name of file to write the results to as JSON;\ndefault is stdout')
+    parser.add_argument('--baseline', action='store', dest='baseline', help='results of an earlier run to compare against, failing if any stage is much slower')
+    parser.add_argument('--tolerance', action='store', dest='tolerance', default=1.5, type=float, help='how many times slower than the baseline a stage can be;\ndefault is 1.5')
+    parser.add_argument('--min_seconds', action='store', dest='min_seconds', default=0.05, type=float, help='shortest baseline time of a stage to compare, as shorter times are mostly noise;\ndefault is 0.05')
+    args = parser.parse_args()
+
+    if args.memory and tracemalloc is None:
+        parser.error('tracing memory needs tracemalloc, from Python 3')
+
+    workdir = tempfile.mkdtemp()
+
+    try:
+        library_file = os.path.join(workdir, 'segments.bin')
+        synthetic_library(library_file, args.seed)
+        library = load_library(library_file)
+
+        out_file = os.path.join(workdir, 'device-data.ndjson')
+
+        results = []
+
+        for num_days in args.num_days:
+            print(dt.now(), 'Benchmarking', num_days, 'days...', file=sys.stderr)
+            stages = run_stages(library, num_days, args.seed, args.backend, out_file)
+            if args.memory:
+                peaks = run_stages(library, num_days, args.seed, args.backend, out_file, memory=True)
+                for stage, peak in zip(stages, peaks):
+                    stage['peak_bytes'] = peak['peak_bytes']
+            for stage in stages:
+                stage['seconds_per_day'] = stage['seconds'] / num_days
+            results += stages
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'python': platform.python_version(),
+        'backend': args.backend,
+        'seed': args.seed,
+        'results': results
+    }
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance, args.min_seconds)
+        for result in slower:
+            print('%s at %d days took %.3fs, up from %.3fs' % (result['stage'], result['num_days'], result['seconds'], result['baseline_seconds']), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
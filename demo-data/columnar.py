@@ -0,0 +1,351 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import zipfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# formats that write a file of columns for each type of record
+COLUMNAR_FORMATS = ['npz', 'arrow']
+
+# records of each type gathered into columns before they are written
+CHUNK_SIZE = 65536
+
+# fields holding timestamps, kept as int64 seconds since the epoch
+TIME_COLUMNS = ['deviceTime', 'start', 'end', 'utcTime']
+
+def available(output_format):
+    """Return whether the library the columnar output_format needs is installed."""
+
+    return np is not None if output_format == 'npz' else pa is not None
+
+def type_file(out_file, record_type, output_format):
+    """Return the name of the file of the columns of record_type."""
+
+    root, extension = os.path.splitext(out_file)
+
+    return '%s-%s.%s' % (root, record_type, output_format)
+
+class ColumnSet:
+    """Columns of the records of one type, filled in as the records arrive and handed to sink every chunk_size records.
+
+    A field missing from a record is None in its column, and every column is
+    as long as the number of records in the chunk so far.
+    """
+
+    def __init__(self, sink, chunk_size=CHUNK_SIZE):
+
+        self.sink = sink
+
+        self.chunk_size = chunk_size
+
+        self.columns = {}
+
+        self.count = 0
+
+    def add(self, record):
+
+        for field, value in record.items():
+            column = self.columns.get(field)
+            if column is None:
+                column = self.columns[field] = [None] * self.count
+            column.append(value)
+
+        self.count += 1
+
+        for column in self.columns.values():
+            if len(column) < self.count:
+                column.append(None)
+
+        if self.count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+
+        if self.count:
+            self.sink.write(self.columns, self.count)
+
+        self.columns, self.count = {}, 0
+
+    def close(self):
+
+        self.flush()
+
+        self.sink.close()
+
+def _numpy_column(field, values):
+    """Return a column as a NumPy array: int64 for times, bool, float with NaN for missing numbers, or unicode."""
+
+    present = [v for v in values if v is not None]
+
+    if field in TIME_COLUMNS:
+        return np.array(values, dtype=np.int64)
+
+    if present and all(isinstance(v, bool) for v in present):
+        return np.array([bool(v) for v in values], dtype=bool)
+
+    if present and all(isinstance(v, (int, float)) for v in present):
+        if len(present) == len(values) and all(isinstance(v, int) for v in present):
+            return np.array(values, dtype=np.int64)
+        return np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+
+    return np.array([v if v is not None else '' for v in values], dtype=np.str_)
+
+def _numpy_dtype(field, dtypes, missing):
+    """Return the dtype of a whole column from the dtypes of its chunks, and whether any chunk is missing it."""
+
+    if field in TIME_COLUMNS:
+        if missing:
+            raise ValueError('some records have no %s' % field)
+        return np.dtype(np.int64)
+
+    kinds = set(dtype.kind for dtype in dtypes)
+
+    if not kinds or 'U' in kinds:
+        # room for a number written out, when there are numbers among the strings
+        return np.result_type(np.dtype('U1' if kinds <= set('U') else 'U32'), *[dtype for dtype in dtypes if dtype.kind == 'U'])
+
+    if kinds == set('b'):
+        return np.dtype(bool)
+
+    if kinds == set('i') and not missing:
+        return np.dtype(np.int64)
+
+    return np.dtype(np.float64)
+
+# the value of a missing field, by kind of column; integer columns with missing values are float
+MISSING = {'b': False, 'f': float('nan'), 'U': ''}
+
+class NpzSink:
+    """Write the columns of one type of record to a compressed NumPy archive, a chunk at a time.
+
+    Each chunk's columns are saved to a scratch directory beside out_file as
+    they arrive. At close each column is gathered, a chunk at a time, into a
+    memory-mapped .npy file of its whole length, which is added to the
+    archive, so no more than a chunk of the records is ever in memory.
+    """
+
+    def __init__(self, out_file):
+
+        self.out_file = out_file
+
+        self.directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_file)))
+
+        # records in each chunk so far
+        self.lengths = []
+
+        # the saved chunks of each field, as (chunk, file name); fields only ever None have none
+        self.chunks = {}
+
+        self.files = 0
+
+    def write(self, columns, count):
+
+        chunk = len(self.lengths)
+
+        for field, values in columns.items():
+            saved = self.chunks.setdefault(field, [])
+            if any(v is not None for v in values):
+                name = os.path.join(self.directory, '%d.npy' % self.files)
+                self.files += 1
+                np.save(name, _numpy_column(field, values))
+                saved.append((chunk, name))
+
+        self.lengths.append(count)
+
+    def close(self):
+
+        starts = [0]
+        for length in self.lengths:
+            starts.append(starts[-1] + length)
+
+        column_file = os.path.join(self.directory, 'column.npy')
+
+        try:
+            with zipfile.ZipFile(self.out_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                for field in sorted(self.chunks):
+                    saved = self.chunks[field]
+                    dtype = _numpy_dtype(field, [np.load(name, mmap_mode='r').dtype for chunk, name in saved], len(saved) < len(self.lengths))
+                    column = np.lib.format.open_memmap(column_file, mode='w+', dtype=dtype, shape=(starts[-1],))
+                    if len(saved) < len(self.lengths):
+                        column[:] = MISSING[dtype.kind]
+                    for chunk, name in saved:
+                        column[starts[chunk]:starts[chunk + 1]] = np.load(name).astype(dtype)
+                    # flushed and unmapped before it is read into the archive
+                    del column
+                    archive.write(column_file, field + '.npy')
+                    os.remove(column_file)
+        finally:
+            shutil.rmtree(self.directory)
+
+def _arrow_batch(columns):
+
+    arrays, names = [], []
+
+    for field in sorted(columns):
+        values = columns[field]
+        if field in TIME_COLUMNS:
+            arrays.append(pa.array(values, type=pa.timestamp('s')))
+        else:
+            arrays.append(pa.array(values))
+        names.append(field)
+
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+def _wider_type(a, b):
+    """Return an Arrow type that holds the values of both a and b."""
+
+    if a.equals(b) or pa.types.is_null(b):
+        return a
+
+    if pa.types.is_null(a):
+        return b
+
+    numeric = [pa.types.is_integer, pa.types.is_floating]
+    if any(f(a) for f in numeric) and any(f(b) for f in numeric):
+        return pa.float64()
+
+    return pa.string()
+
+def _wider_schema(schema, other):
+    """Return the schema of the fields of both schemas, sorted by name, widening the types of fields they share."""
+
+    types = dict((field.name, field.type) for field in schema)
+
+    for field in other:
+        types[field.name] = _wider_type(types[field.name], field.type) if field.name in types else field.type
+
+    return pa.schema([pa.field(name, types[name]) for name in sorted(types)])
+
+def _conform(batch, schema):
+    """Return batch with the fields and types of schema, its missing fields all null."""
+
+    arrays = []
+
+    for field in schema:
+        position = batch.schema.get_field_index(field.name)
+        if position == -1:
+            arrays.append(pa.nulls(batch.num_rows, field.type))
+        else:
+            arrays.append(batch.column(position).cast(field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+class ArrowSink:
+    """Write the columns of one type of record to an Arrow IPC file, a record batch per chunk.
+
+    The schema of the file is that of the first chunk. A later chunk with a
+    new field, or numbers where there were only integers, widens it, and the
+    batches already written are copied a batch at a time into a file with the
+    wider schema, which the rest are then written to.
+    """
+
+    def __init__(self, out_file):
+
+        self.out_file = out_file
+
+        self.schema = None
+
+        self.sink, self.writer = None, None
+
+    def _open(self, schema):
+
+        self.schema = schema
+
+        self.sink = pa.OSFile(self.out_file, 'wb')
+
+        self.writer = pa.ipc.new_file(self.sink, schema)
+
+    def _widen(self, schema):
+
+        self.writer.close()
+        self.sink.close()
+
+        narrower = self.out_file + '.narrower'
+        os.rename(self.out_file, narrower)
+
+        self._open(schema)
+
+        with pa.memory_map(narrower) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                self.writer.write_batch(_conform(reader.get_batch(i), schema))
+
+        os.remove(narrower)
+
+    def write(self, columns, count):
+
+        batch = _arrow_batch(columns)
+
+        if self.schema is None:
+            self._open(batch.schema)
+
+        schema = _wider_schema(self.schema, batch.schema)
+
+        if not schema.equals(self.schema):
+            self._widen(schema)
+
+        self.writer.write_batch(_conform(batch, self.schema))
+
+    def close(self):
+
+        if self.writer is not None:
+            self.writer.close()
+            self.sink.close()
+
+SINKS = {'npz': NpzSink, 'arrow': ArrowSink}
+
+def write_columnar(records, out_file, output_format, chunk_size=CHUNK_SIZE):
+    """Write records, their timestamps still seconds since the epoch, as a file of columns for each type of record.
+
+    npz output is a compressed NumPy archive of one array per field; arrow
+    output is an Arrow IPC file. The columns of each type are written every
+    chunk_size records of it, so memory is bounded by the chunks rather than
+    growing with the run. Returns the number of records.
+    """
+
+    if not available(output_format):
+        raise ImportError('%s output requires %s to be installed' % (output_format, 'NumPy' if output_format == 'npz' else 'pyarrow'))
+
+    types = {}
+
+    count = 0
+
+    try:
+        for record in records:
+            columns = types.get(record['type'])
+            if columns is None:
+                columns = types[record['type']] = ColumnSet(SINKS[output_format](type_file(out_file, record['type'], output_format)), chunk_size)
+            columns.add(record)
+            count += 1
+    finally:
+        for columns in types.values():
+            columns.close()
+
+    return count
@@ -0,0 +1,306 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from bisect import bisect_left, bisect_right
+import json
+import mmap
+import struct
+
+from timestamps import to_epoch
+
+# A sidecar index of an ndjson device data file, written alongside it, locates
+# the records of each day and of each type without parsing the file. It is laid
+# out as a header, then a block for the records first written and another for
+# those of each append to the file. A block is a table of the days with
+# records, each with the byte offset of its first record, then a table of the
+# types of record, each with its number of records, then for each type in turn
+# the byte offsets of all its records. Offsets are in file order, so records of
+# a type on a given day lie between the offsets of that day and the next. The
+# header is rewritten only once a block is in place, so an append that fails
+# part way leaves the index as it was.
+MAGIC = b'TPDIDX02'
+
+# magic, number of blocks, size of the data file in bytes, size of the index in bytes
+HEADER = struct.Struct('<8sIQQ')
+
+# number of days, number of types
+BLOCK = struct.Struct('<II')
+
+# days since the epoch, offset of the first record of the day
+DAY = struct.Struct('<iQ')
+
+# type, number of records of the type
+TYPE = struct.Struct('<32sI')
+
+OFFSET = struct.Struct('<Q')
+
+# fields a record is ordered by in the output, in order of preference
+ORDER_FIELDS = ['deviceTime', 'start', 'utcTime']
+
+def index_name(out_file):
+    """Return the name of the sidecar index of out_file."""
+
+    return out_file + '.idx'
+
+class IndexBuilder:
+    """Build the sidecar index of an ndjson file as its records are written.
+
+    A builder from load_index carries on from the end of an existing index,
+    and holds only the records appended since, which write adds as a block of
+    their own.
+    """
+
+    def __init__(self, size=0, blocks=0, index_size=0):
+
+        self.days = []
+
+        self.day_offsets = []
+
+        self.types = {}
+
+        self.size = size
+
+        # blocks already in the index file and its size in bytes, if there is one to append to
+        self.blocks = blocks
+
+        self.index_size = index_size
+
+    def add(self, time, record_type, line_length):
+        """Add the next record of the file, at time in seconds since the epoch, written as line_length bytes."""
+
+        day = time // 86400
+
+        if not self.days or day > self.days[-1]:
+            self.days.append(day)
+            self.day_offsets.append(self.size)
+
+        self.types.setdefault(record_type, []).append(self.size)
+
+        self.size += line_length
+
+    def _block(self):
+
+        types = sorted(self.types)
+
+        parts = [BLOCK.pack(len(self.days), len(types))]
+
+        parts.extend(DAY.pack(day, offset) for day, offset in zip(self.days, self.day_offsets))
+
+        parts.extend(TYPE.pack(record_type.encode('ascii'), len(self.types[record_type])) for record_type in types)
+
+        for record_type in types:
+            offsets = self.types[record_type]
+            parts.append(struct.pack('<%dQ' % len(offsets), *offsets))
+
+        return b''.join(parts)
+
+    def write(self, index_file):
+        """Write the index, or add a block of the records appended since load_index to it."""
+
+        block = self._block()
+
+        if not self.blocks:
+            with open(index_file, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, 1, self.size, HEADER.size + len(block)))
+                f.write(block)
+            return
+
+        with open(index_file, 'r+b') as f:
+            # anything past the end of the index was left by an append that failed
+            f.seek(self.index_size)
+            f.write(block)
+            f.truncate()
+            f.flush()
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, self.blocks + 1, self.size, self.index_size + len(block)))
+
+def _read_header(buf, index_file):
+
+    magic, num_blocks, size, index_size = HEADER.unpack_from(buf, 0)
+
+    if magic != MAGIC:
+        raise ValueError('%s is not a device data index' % index_file)
+
+    return num_blocks, size, index_size
+
+def load_index(index_file):
+    """Return an IndexBuilder to index records appended to the file of a sidecar index, reading only its header."""
+
+    with open(index_file, 'rb') as f:
+        num_blocks, size, index_size = _read_header(f.read(HEADER.size), index_file)
+
+    return IndexBuilder(size, num_blocks, index_size)
+
+class Offsets:
+    """Read-only sequence of the offsets of one type of record in an index, read straight from the mapped index.
+
+    The offsets of each block of the index are a run of them, and runs holds
+    the position and number of offsets of each in turn.
+    """
+
+    def __init__(self, buf, runs):
+
+        self.buf = buf
+
+        self.runs = runs
+
+        # index of the first offset of each run
+        self.firsts = []
+
+        self.count = 0
+
+        for start, count in runs:
+            self.firsts.append(self.count)
+            self.count += count
+
+    def __len__(self):
+
+        return self.count
+
+    def __getitem__(self, i):
+
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+
+        run = bisect_right(self.firsts, i) - 1
+
+        return OFFSET.unpack_from(self.buf, self.runs[run][0] + (i - self.firsts[run]) * OFFSET.size)[0]
+
+class IndexedData:
+    """Read the records of an ndjson device data file by day and type, using its sidecar index.
+
+    Both the data file and its index are memory mapped, so only the records
+    asked for are read and parsed.
+    """
+
+    def __init__(self, filename, index_file=None):
+
+        self.data_file = open(filename, 'rb')
+
+        self.index_file = open(index_file or index_name(filename), 'rb')
+
+        self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        num_blocks, self.size, index_size = _read_header(self.index, self.index_file.name)
+
+        if self.size > len(self.data):
+            raise ValueError('%s indexes %d bytes but %s has only %d' % (self.index_file.name, self.size, filename, len(self.data)))
+
+        position = HEADER.size
+
+        self.days, self.day_offsets = [], []
+
+        runs = {}
+
+        for block in range(num_blocks):
+            num_days, num_types = BLOCK.unpack_from(self.index, position)
+            position += BLOCK.size
+
+            for i in range(num_days):
+                day, offset = DAY.unpack_from(self.index, position)
+                # an append that carries on the last day of the data before it starts part way into that day
+                if not self.days or day > self.days[-1]:
+                    self.days.append(day)
+                    self.day_offsets.append(offset)
+                position += DAY.size
+
+            counts = []
+            for i in range(num_types):
+                record_type, count = TYPE.unpack_from(self.index, position)
+                counts.append((record_type.rstrip(b'\0').decode('ascii'), count))
+                position += TYPE.size
+
+            for record_type, count in counts:
+                runs.setdefault(record_type, []).append((position, count))
+                position += count * OFFSET.size
+
+        self.types = sorted(runs)
+
+        self.offsets = dict((record_type, Offsets(self.index, runs[record_type])) for record_type in self.types)
+
+    def close(self):
+
+        self.data.close()
+        self.index.close()
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+    def _span(self, start, end):
+        """Return the byte range of the days from start up to end, datetimes or None for unbounded."""
+
+        first = bisect_left(self.days, to_epoch(start) // 86400) if start is not None else 0
+
+        # the day of the last second before end
+        last = bisect_left(self.days, (to_epoch(end) - 1) // 86400 + 1) if end is not None else len(self.days)
+
+        begin = self.day_offsets[first] if first < len(self.days) else self.size
+
+        finish = self.day_offsets[last] if last < len(self.days) else self.size
+
+        return begin, finish
+
+    def _record(self, offset):
+
+        end = self.data.find(b'\n', offset, self.size)
+
+        return json.loads(self.data[offset:end if end != -1 else self.size].decode('utf-8'))
+
+    def _in_window(self, record, start, end):
+
+        for field in ORDER_FIELDS:
+            if field in record:
+                time = record[field].rstrip('Z')
+                break
+
+        return (start is None or time >= start) and (end is None or time < end)
+
+    def records(self, start=None, end=None, record_type=None):
+        """Return the records ordered at times from start up to end, optionally only those of record_type.
+
+        start and end are datetimes, and either can be None to leave that end
+        of the window open.
+        """
+
+        begin, finish = self._span(start, end)
+
+        bounds = [d.strftime('%Y-%m-%dT%H:%M:%S') if d is not None else None for d in (start, end)]
+
+        if record_type is not None:
+            offsets = self.offsets.get(record_type, [])
+            records = [self._record(offsets[i]) for i in range(bisect_left(offsets, begin), bisect_left(offsets, finish))]
+        else:
+            lines = self.data[begin:finish].decode('utf-8').splitlines()
+            records = [json.loads(line) for line in lines]
+
+        # whole days are read, so trim the records of the first and last day to the window
+        return [record for record in records if self._in_window(record, bounds[0], bounds[1])]
+
+    def count(self, record_type):
+        """Return the number of records of record_type in the file."""
+
+        return len(self.offsets.get(record_type, []))
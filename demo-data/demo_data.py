@@ -17,239 +17,363 @@
 from __future__ import print_function
 
 import argparse
+from bisect import bisect_left, bisect_right
 from datetime import datetime as dt
 from datetime import time as t
 from datetime import timedelta as td
 import json
+from multiprocessing import Pool, cpu_count
+import os
 import random
 import sys
-from urllib2 import urlopen
-import uuid
 
-HOURS = range(0,24)
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-VERY_LIKELY = [7, 8, 11, 12, 6, 11]
+from dataindex import IndexBuilder, index_name, load_index
+from exporters import VENDOR_FORMATS, write_export
+from feed import emit, open_sink
+from ids import ID_KINDS, IDAllocator
+from records import BasalSegment, BolusRecord, CarbsRecord, CBGColumns, MessageRecord, SMBGRecord
+from rollups import DailyRollups, rollup_name
+from sampling import HOURS, randint_below, random_time, random_times
+from scheduler import StageGraph, prefetch
+from segments import find_library, load_library
+from tail import read_tail
+from timestamps import EPOCH, from_epoch, to_epoch
+from text import BACON_IPSUM_URL, PROVIDERS, WordBankProvider, get_provider
+from validation import Validator
+from writers import FORMATS, format_available, merge_windows, write_records
 
-for i in VERY_LIKELY:
-    j = 0
-    while j < 3:
-        HOURS.append(i)
-        j += 1
+class ReadingIndex:
+    """Index time-ordered columns of readings for fast lookups by time window."""
 
-LIKELY = [9, 13, 4, 5, 9, 10]
+    def __init__(self, times, values):
 
-for i in LIKELY:
-    j = 0
-    while j < 2:
-        HOURS.append(i)
-        j += 1
+        self.times = times
 
-SIXTY = range(0, 60)
+        self.values = values
 
-MICRO = range(0, 1000000)
+    def between(self, start, end):
+        """Return the values of the readings with start <= time < end, in seconds since the epoch."""
+
+        return self.values[bisect_left(self.times, start):bisect_left(self.times, end)]
+
+    def in_hour(self, d, hour):
+        """Return the values of the readings falling within the given hour of the given date."""
+
+        start = to_epoch(dt(d.year, d.month, d.day, hour))
+
+        return self.between(start, start + 3600)
 
 class Dexcom:
     """Generate demo Dexcom data."""
 
-    def __init__(self, filename, days):
-        """Load the indexed segments to use for generating demo Dexcom data."""
+    def __init__(self, filename, days, backend='python', segments=None, start=None, rng=random):
+        """Load the indexed segments to use for generating demo Dexcom data.
+
+        An already loaded segment library can be passed as segments instead,
+        and start fixes the time the trace starts around instead of now. Like
+        every stage, the trace draws its random numbers from rng, the random
+        module itself by default, or a random.Random of its own.
+        """
+
+        self.rng = rng
+
+        if backend == 'numpy' and np is None:
+            raise ImportError('the numpy backend requires NumPy to be installed')
 
-        filename = filename if (filename != None) else 'indexed_segments.json'
+        self.backend = backend
 
-        self.segments = json.load(open(filename, 'rU'))
+        self.segments = segments if segments is not None else load_library(find_library(filename))
+
+        self.start_time = start
 
         self.days = days
 
         self.delta = td(minutes=5)
 
-    def _increment_timestamp(self, t):
-        """Increment a timestamp with a timedelta and return the updated value."""
+    def start_trace(self, tail=None):
+        """Pick the start time of the trace and its initial segment.
 
-        self.current = t + self.delta
-        return self.current
+        Given the TailState of existing data, the trace instead carries on
+        from the last reading of that data.
+        """
 
-    def _stitch_segments(self):
-        """Stitch together segments of Dexcom data."""
-        
-        initial = random.choice(self.segments[random.choice(self.segments.keys())])
+        # the reading the trace carries on from, if any
+        self.resume = None
 
-        start = dt.now() + td(hours=random.choice(range(-5,6)))
+        if tail is not None and tail.cbg_time is not None:
+            self.start = from_epoch(tail.cbg_time)
+            self.resume = tail.cbg_value
+        elif tail is not None:
+            self.start = from_epoch(tail.last_time)
+        else:
+            self.start = (self.start_time or dt.now()) + td(hours=self.rng.choice(range(-5,6)))
 
-        self.current = start
+        self.final = self.start + td(days=self.days)
 
-        self.readings = [{'deviceTime': self._increment_timestamp(self.current), 'value': reading['blood_glucose']} for reading in initial]
+        if self.backend == 'numpy':
+            self._stitch_segments_numpy()
+            return
 
-        last_reading = initial[len(initial) - 1]['blood_glucose']
+        if self.resume is not None:
+            self.current = tail.cbg_time
+            self.pending = CBGColumns()
+            self.last_reading = self.resume
+            return
 
-        self.final = start + td(days=self.days)
+        initial = self.segments.random_segment(self.rng.choice(self.segments.starts), self.rng)
 
-        elapsed = self.current - start
+        # the trace is stitched in whole seconds since the epoch
+        self.current = to_epoch(self.start)
 
-        while(elapsed.total_seconds() < (86400 * self.days)):
-            try:
-                next = random.choice(self.segments[str(last_reading + random.choice([-1, 0, 1]))])
-                last_reading = next[len(next) - 1]['blood_glucose']
-            except KeyError:
-                print()
-                print('Could not stitch segments!')
+        # readings stitched so far that have not yet been handed out in a window
+        self.pending = CBGColumns()
+
+        self._append_readings(initial)
+
+        self.last_reading = initial[-1]
+
+    def _append_readings(self, values):
+        """Append values to the trace, one every five minutes after the current time."""
 
-                next = None
-                try:
-                    while next is None:
-                        next = self._get_segment(last_reading)
-                except RuntimeError:
-                    sys.exit('\nRecursion limit exceeded. Please try again.\n')
-                last_reading = next[len(next) - 1]['blood_glucose']
+        step = int(self.delta.total_seconds())
 
-            jump = random.randint(0,6)
+        self.pending.times.extend(range(self.current + step, self.current + step * (len(values) + 1), step))
+        self.pending.values.extend(values)
 
-            i = 0
-            while i < jump:
-                self.current = self._increment_timestamp(self.current)
-                i += 1
+        self.current += step * len(values)
 
-            self.readings += [{'deviceTime': self._increment_timestamp(self.current), 'value': reading['blood_glucose']} for reading in next]
-            elapsed = self.current - start
+    def _stitch_segments(self, end):
+        """Stitch together segments of Dexcom data until the trace reaches end."""
 
-    def _get_segment(self, last_reading):
-        """Return a randomly shifted segment of Dexcom data."""
+        end = to_epoch(end)
 
-        print()
-        print('Rescue stitch!')
+        while self.current < end:
+            next = self.segments.random_segment(self.last_reading + self.rng.choice([-1, 0, 1]), self.rng)
+            self.last_reading = next[-1]
 
-        random_increment = random.randint(-6, 6)
+            jump = self.rng.randint(0,6)
+
+            self.current += jump * int(self.delta.total_seconds())
+
+            self._append_readings(next)
+
+    def _stitch_segments_numpy(self):
+        """Stitch together segments of Dexcom data, building the whole trace as NumPy arrays."""
+
+        values, offsets = self.segments.arrays()
+
+        lengths = np.diff(offsets)
+
+        lasts = values[offsets[1:] - 1]
+
+        starts = np.array(self.segments.starts)
+
+        # position in starts of the nearest available start value for every value that can be looked up
+        low = int(min(starts.min(), lasts.min())) - 1
+        grid = np.arange(low, int(max(starts.max(), lasts.max())) + 2)
+        if len(starts) > 1:
+            i = np.searchsorted(starts, grid).clip(1, len(starts) - 1)
+            nearest = np.where(starts[i] - grid < grid - starts[i - 1], i, i - 1)
+        else:
+            nearest = np.zeros(len(grid), dtype=np.int64)
+
+        nearest, firsts, counts = nearest.tolist(), self.segments.firsts, self.segments.counts
+        segment_lengths, segment_lasts = lengths.tolist(), lasts.tolist()
+
+        rng = np.random.RandomState(self.rng.getrandbits(32))
+
+        if self.resume is not None:
+            # kept within the values that can be looked up, with room for the shift
+            chosen, jumps, steps = [], [], 0
+            last_reading = min(max(self.resume, low + 1), int(grid[-1]) - 1)
+        else:
+            position = rng.randint(len(firsts))
+            chosen = [firsts[position] + rng.randint(counts[position])]
+            jumps = [0]
 
-        try:
-            return random.choice(self.segments[str(last_reading + random_increment)])
-        except KeyError:
-            self._get_segment(last_reading)
+            steps = segment_lengths[chosen[0]]
+            last_reading = segment_lasts[chosen[0]]
+
+        while steps < 288 * self.days:
+            # draw the random choices for a whole batch of segments at once
+            shifts = rng.randint(-1, 2, 1024).tolist()
+            picks = rng.random_sample(1024).tolist()
+            gaps = rng.randint(0, 7, 1024).tolist()
+
+            for shift, pick, gap in zip(shifts, picks, gaps):
+                position = nearest[last_reading + shift - low]
+                segment = firsts[position] + int(pick * counts[position])
+                chosen.append(segment)
+                jumps.append(gap)
+                steps += gap + segment_lengths[segment]
+                last_reading = segment_lasts[segment]
+                if steps >= 288 * self.days:
+                    break
+
+        chosen = np.array(chosen)
+        chosen_lengths = lengths[chosen]
+        total = int(chosen_lengths.sum())
+
+        # index into values of every reading, and its number of 5 minute steps from the start
+        ends = np.cumsum(chosen_lengths)
+        within = np.arange(total) - np.repeat(ends - chosen_lengths, chosen_lengths)
+        self.trace_values = values[np.repeat(offsets[chosen], chosen_lengths) + within]
+        positions = np.arange(total) + np.repeat(np.cumsum(jumps), chosen_lengths) + 1
+
+        self.trace_times = to_epoch(self.start) + positions * int(self.delta.total_seconds())
+
+        # index of the first reading not yet handed out in a window
+        self.position = 0
+
+    def generate_window(self, end):
+        """Generate the readings of the trace before end, continuing on from the previous window."""
+
+        end = min(end, self.final)
+
+        if self.backend == 'numpy':
+            i = int(np.searchsorted(self.trace_times, to_epoch(end)))
+
+            self.json = CBGColumns(self.trace_times[self.position:i].tolist(), self.trace_values[self.position:i].tolist())
+
+            self.position = i
+        else:
+            self._stitch_segments(end)
+
+            i = bisect_left(self.pending.times, to_epoch(end))
+
+            self.json = CBGColumns(self.pending.times[:i], self.pending.values[:i])
+
+            self.pending = CBGColumns(self.pending.times[i:], self.pending.values[i:])
+
+        self.index = ReadingIndex(self.json.times, self.json.values)
 
     def generate_JSON(self):
         """Generate a list ready to print to JSON of demo Dexcom data."""
-        
-        self._stitch_segments()
 
-        self.json = [{'id': str(uuid.uuid4()), 'type': 'cbg', 'value': reading['value'], 'deviceTime': reading['deviceTime'].isoformat()[:-7]} for reading in self.readings if reading['deviceTime'] < self.final]
+        self.start_trace()
+
+        self.generate_window(self.final)
+
+    def generate_txt(self, out_file):
+        """Generate a tab-delimited text file of demo Dexcom data in Dexcom Studio format, returning the number of readings."""
+
+        self.generate_JSON()
 
-    def generate_txt(self):
-        """Generate a tab-delimited text file of demo Dexcom data in Dexcom Studio format."""
-        # TODO
-        pass
+        return write_export(iter(self.json), out_file, 'dexcom.txt')
 
 class SMBG:
     """Generate demo self-monitored blood glucose data."""
 
-    def __init__(self, dex, readings_per_day = 7):
+    def __init__(self, dex, readings_per_day = 7, rng=random):
 
-        self.dexcom = dex.readings
+        self.rng = rng
 
-        self.dates = get_dates(self.dexcom)
+        # shared with anything else that needs CBG readings near a given time
+        self.index = dex.index
+
+        self.dates = get_dates(self.index.times)
 
         self.readings_per_day = readings_per_day
 
         self.readings = []
 
-        for date in self.dates:
+        for date in sorted(self.dates):
             self.readings += self._generate_smbg(date)
 
-        self.readings = sorted(self.readings, key=lambda reading: reading['deviceTime'])
+        self.readings = sorted(self.readings, key=lambda reading: reading.time)
 
-        self.json = [{'id': str(uuid.uuid4()), 'type': 'smbg', 'value': r['value'], 'deviceTime': r['deviceTime'].isoformat()[:-7]} for r in self.readings]
+        self.json = self.readings
 
     def _generate_smbg(self, d):
         """Generate timestamps and smbg values from a non-uniform pool of potential timestamps."""
 
         readings = []
 
-        i = 0
-
-        while i < self.readings_per_day:
-
-            hour = random.choice(HOURS)
+        for timestamp in random_times(d, self.readings_per_day, self.rng):
 
-            timestamp = dt(d.year, d.month, d.day, hour, random.choice(SIXTY), random.choice(SIXTY), random.choice(MICRO))
+            near = self.index.in_hour(d, timestamp.hour)
 
-            near = []
-
-            for reading in self.dexcom:
-                t = reading['deviceTime']
-                if t.date() == d:
-                    if t.hour == hour:
-                        near.append(reading)
-
-            jump = random.randint(-26, 26)
+            jump = self.rng.randint(-26, 26)
 
             try:
-                value = random.choice(near)['value'] + jump
-                readings.append({'value': value, 'deviceTime': timestamp})
+                value = self.rng.choice(near) + jump
+                readings.append(SMBGRecord(to_epoch(timestamp), value))
             # exception occurs when can't find a near enough timestamp because data starts with datetime.now()
             # which could be middle of the afternoon, but this method will always try to generate some morning timestamps
             except IndexError:
                 pass
 
-            i += 1
-
         return readings
 
 class Messages:
     """Generate demo messages with bacon ipsum."""
 
-    def __init__(self, smbg):
+    def __init__(self, smbg, text_provider=None, ids=None, rng=random):
 
-        self.dates = get_dates(smbg.readings)
+        self.rng = rng
+
+        self.ids = ids if ids is not None else IDAllocator()
+
+        self.dates = get_dates([reading.time for reading in smbg.readings])
+
+        self.text_provider = text_provider if text_provider is not None else WordBankProvider()
 
         self.json = []
 
+        # key of the text for each message, filled in once all the text has been prefetched
+        self.text_keys = []
+
         self._generate_messages()
 
-    def _generate_message(self, t, message_id, parent_message_id):
-        """Generate a single message with bacon ipsum."""
+        self.text_provider.prefetch(self.text_keys)
+
+        for message, key in zip(self.json, self.text_keys):
+            message.text = self.text_provider.text(key)
+
+        self.json.sort(key=lambda message: message.time)
+
+    def _generate_message(self, t, parent_message_id):
+        """Generate a single message, leaving its text to be filled in."""
 
         if parent_message_id != '':
-            timestamp = t + td(minutes=random.choice(range(1,61)))
+            timestamp = t + td(minutes=self.rng.choice(range(1,61)))
         else:
             timestamp = t
 
-        print()
-        print(dt.now(), 'Fetching some bacon ipsum...')
-        
-        request = urlopen('https://baconipsum.com/api/?type=meat-and-filler&sentences=' + str(random.choice(range(1,4))))
+        self.text_keys.append(self.text_provider.key(self.rng.choice(range(1,4)), self.rng))
 
-        bacon_ipsum = json.loads(request.read())[0]
+        time = to_epoch(timestamp)
 
-        return {'type': 'message', 'id': message_id, 'parentMessage': parent_message_id, 'utcTime': timestamp.isoformat()[:-7] + 'Z', 'messageText': bacon_ipsum}
+        return MessageRecord(time, self.ids.next(time), parent_message_id)
 
     def _generate_messages(self):
 
         likelihood = [0,0,1]
 
-        messages = []
+        for d in sorted(self.dates):
 
-        for d in self.dates:
+            timestamp = random_time(d, rng=self.rng)
 
-            hour = random.choice(HOURS)
-
-            timestamp = dt(d.year, d.month, d.day, hour, random.choice(SIXTY), random.choice(SIXTY), random.choice(MICRO))
-
-            message_id = str(uuid.uuid4())
-
-            message = self._generate_message(timestamp, message_id, '')
+            message = self._generate_message(timestamp, '')
 
             self.json.append(message)
 
-            if random.choice(likelihood):
-                parent_message_id = message_id
+            if self.rng.choice(likelihood):
+                parent_message_id = message.id
 
-                length_of_thread = random.choice(range(1,6))
+                length_of_thread = self.rng.choice(range(1,6))
 
                 threaded_messages = []
 
                 i = 0
 
                 while i <= length_of_thread:
-                    message_id = str(uuid.uuid4())
-
-                    message = self._generate_message(timestamp, message_id, parent_message_id)
+                    message = self._generate_message(timestamp, parent_message_id)
 
                     threaded_messages.append(message)
 
@@ -260,7 +384,9 @@ class Messages:
 class Meals:
     """Generate demo carb intake data."""
 
-    def __init__(self, smbg):
+    def __init__(self, smbg, rng=random):
+
+        self.rng = rng
 
         self.readings = smbg.readings
 
@@ -272,24 +398,31 @@ class Meals:
 
         self.carbs = self._generate_meals(self.mu, self.sigma)
 
-        self.json = [{'id': str(uuid.uuid4()), 'type': 'carbs', 'units': 'grams', 'value': c['value'], 'deviceTime': c['deviceTime'].isoformat()[:-7]} for c in self.carbs if c['value'] > 5]
+        self.json = [c for c in self.carbs if c.value > 5]
 
     def _generate_meals(self, mu, sigma):
         """ Generate carb counts for meals based on ."""
 
-        mealtimes = random.sample(self.readings, int(.8 * len(self.readings)))
+        mealtimes = sorted(self.rng.sample(self.readings, int(.8 * len(self.readings))), key=lambda reading: reading.time)
 
-        carbs = [{'deviceTime': meal['deviceTime'], 'value': int(random.gauss(mu, sigma))} for meal in mealtimes]
+        carbs = [CarbsRecord(meal.time, int(self.rng.gauss(mu, sigma))) for meal in mealtimes]
 
         return carbs
 
 class Boluses:
     """Generate demo bolus data."""
 
-    def __init__(self, meals):
+    def __init__(self, meals, last_correction=None, end=None, rng=random):
+        """Generate boluses for meals, continuing correction boluses from last_correction and stopping them before end when given."""
+
+        self.rng = rng
 
         self.meals = meals.carbs
 
+        self.last_correction = last_correction
+
+        self.end = to_epoch(end) if end is not None else None
+
         self.ratio = 15.0
 
         self.mu = 2.0
@@ -302,26 +435,24 @@ class Boluses:
 
         self._generate_correction_boluses()
 
-        self.json = [b for b in self.boluses if (b['value'] > 0)]
-
-        for bolus in self.json:
-            bolus['deviceTime'] = bolus['deviceTime'].isoformat()[:-7]
+        self.json = sorted([b for b in self.boluses if (b.value > 0)], key=lambda b: b.time)
 
     def _time_shift(self):
+        """Return a random shift of up to five minutes either way, in seconds."""
 
-        return td(minutes=random.randint(-5,5))
+        return self.rng.randint(-5,5) * 60
 
     def _ratio_shift(self):
 
-        return random.randint(-2, 2)
+        return self.rng.randint(-2, 2)
 
     def _dose_shift(self):
 
-        return random.choice([-1.5, -1.0, -0.5, 0.5, 1.0, 1.5])
+        return self.rng.choice([-1.5, -1.0, -0.5, 0.5, 1.0, 1.5])
 
     def _recommendation(self):
 
-        return random.randint(-3,3)
+        return self.rng.randint(-3,3)
 
     def _generate_meal_boluses(self):
         """Generate boluses to match generated carb counts."""
@@ -330,7 +461,7 @@ class Boluses:
 
         likelihood = [0,0,0,0,1]
 
-        boluses = [{'id': str(uuid.uuid4()), 'type': 'bolus', 'deviceTime': meal['deviceTime'] + random.choice(likelihood) * bolus._time_shift(), 'value': round(float(meal['value'] / (bolus.ratio + random.choice(likelihood) * bolus._ratio_shift())), 1), 'recommended': round(meal['value'] / bolus.ratio, 1)} for meal in bolus.meals]
+        boluses = [BolusRecord(meal.time + self.rng.choice(likelihood) * bolus._time_shift(), round(float(meal.value / (bolus.ratio + self.rng.choice(likelihood) * bolus._ratio_shift())), 1), round(meal.value / bolus.ratio, 1)) for meal in bolus.meals]
 
         return boluses
 
@@ -339,26 +470,35 @@ class Boluses:
 
         likelihood = [0,0,1]
 
-        self.meals = sorted(self.meals, key=lambda x: x['deviceTime'])
+        self.meals = sorted(self.meals, key=lambda x: x.time)
+
+        if not self.meals and (self.last_correction is None or self.end is None):
+            return
 
-        t = self.meals[0]['deviceTime']
+        t = self.last_correction if self.last_correction is not None else self.meals[0].time
 
-        end = self.meals[len(self.meals) - 1]['deviceTime']
+        end = self.end if self.end is not None else self.meals[len(self.meals) - 1].time
 
-        delta = td(hours=12)
+        delta = 12 * 3600
 
         while t < end:
             next = t + delta + self._time_shift()
 
-            current_value = round(random.gauss(self.mu, self.sigma), 1)
+            # leave corrections after the end of a window to the next one
+            if self.end is not None and next >= self.end:
+                break
 
-            current_recommendation = round(current_value + random.choice(likelihood) * self._dose_shift(), 1)
+            current_value = round(self.rng.gauss(self.mu, self.sigma), 1)
+
+            current_recommendation = round(current_value + self.rng.choice(likelihood) * self._dose_shift(), 1)
 
             if (current_recommendation > 0) and (current_value > 0):
-                self.boluses.append({'id': str(uuid.uuid4()), 'type': 'bolus', 'deviceTime': next, 'value': current_value, 'recommended': current_recommendation})
+                self.boluses.append(BolusRecord(next, current_value, current_recommendation))
 
             t = next
 
+        self.last_correction = t
+
     def _generate_extended_boluses(self):
         """Generate some dual- and square-wave boluses."""
 
@@ -367,31 +507,37 @@ class Boluses:
         durations = [30,45,60,90,120,180,240]
 
         for bolus in self.boluses:
-            coin_flip = random.choice(likelihood)
+            coin_flip = self.rng.choice(likelihood)
 
             if coin_flip:
-                if bolus['value'] >= 2:
-                    dual = random.choice(likelihood)
+                if bolus.value >= 2:
+                    dual = self.rng.choice(likelihood)
                     if dual:
-                        bolus['initialDelivery'] = round(float(random.choice(range(1,10)))/10 * bolus['value'], 1)
-                        bolus['extendedDelivery'] = bolus['value'] - bolus['initialDelivery']
+                        bolus.initial_delivery = round(float(self.rng.choice(range(1,10)))/10 * bolus.value, 1)
+                        bolus.extended_delivery = bolus.value - bolus.initial_delivery
                         # duration in milliseconds for now
                         # TODO: reconsider units?
-                        bolus['duration'] = random.choice(durations) * 60 * 1000
-                        bolus['type'] = 'bolus'
-                        bolus['extended'] = True
+                        bolus.duration = self.rng.choice(durations) * 60 * 1000
                     else:
-                        bolus['extendedDelivery'] = bolus['value']
+                        bolus.extended_delivery = bolus.value
                         # duration in milliseconds for now
                         # TODO: reconsider units?
-                        bolus['duration'] = random.choice(durations) * 60 * 1000
-                        bolus['type'] = 'bolus'
-                        bolus['extended'] = True
+                        bolus.duration = self.rng.choice(durations) * 60 * 1000
 
 class Basal:
     """Generate demo basal data."""
 
-    def __init__(self, schedule, boluses, carbs):
+    def __init__(self, schedule, boluses, carbs, start=None, end=None, pending_temp=None, rng=random):
+        """Generate basal segments spanning the boluses and carbs given.
+
+        When generating a window of a longer run, start is where the previous
+        window's scheduled segments ended and pending_temp is its next temp
+        basal. Given an end, the last scheduled segment runs on to its scheduled
+        end rather than being cut short, and is picked up from there by the
+        next window.
+        """
+
+        self.rng = rng
 
         self.boluses = boluses
 
@@ -399,6 +545,14 @@ class Basal:
 
         self.endpoints = self._get_endpoints()
 
+        if start is not None:
+            self.endpoints = ({'deviceTime': start}, self.endpoints[1])
+
+        if end is not None:
+            self.endpoints = (self.endpoints[0], {'deviceTime': end})
+
+        self.pending_temp = pending_temp
+
         if schedule:
             self.schedule = schedule
         else:
@@ -415,162 +569,107 @@ class Basal:
 
         self.segment_starts = sorted([time for time in self.schedule.keys()])
 
-        self.segments = []
+        # the 24-hour schedule as seconds into the day each segment starts, and its rate
+        self.day_starts = [s.hour * 3600 + s.minute * 60 + s.second for s in self.segment_starts]
 
-        self.temp_segments = []
+        self.rates = [self.schedule[s] for s in self.segment_starts]
 
-        self.end_initial = self._get_initial_segment()
-
-        self.end_middle = self._get_middle_segments()
-
-        self._get_final_segment()
-
-        self.generate_temp_basals()
-        # more hackery because of my bad while loops /o\
-        self.temp_segments.pop()
-
-        self.json = [s for s in self.segments] + [s for s in self.temp_segments]
-
-        for segment in self.json:
-            segment['start'] = segment['start'].isoformat()
-            segment['end'] = segment['end'].isoformat()
-            segment['id'] = str(uuid.uuid4())
-
-    def _append_segment(self, d, segment_start, inferred = False):
-
-        try:
-            index = self.segment_starts.index(t(d.hour, d.minute, d.second))
-        except ValueError:
-            index = self.segment_starts.index(segment_start) - 1
+        self.segments = []
 
-        try:
-            current_segment = self.segment_starts[index]
-        except IndexError:
-            current_segment = self.segment_starts[len(self.segment_starts) - 1]
+        self.temp_segments = []
 
-        segment = {                
-                    'type': 'basal-rate-segment',
-                    'delivered': self.schedule[current_segment],
-                    'value': self.schedule[current_segment],
-                    'deliveryType': 'scheduled',
-                    'inferred': inferred,
-                    'start': dt(d.year, d.month, d.day, d.hour, d.minute, d.second),
-                    'end': dt(d.year, d.month, d.day, segment_start.hour, segment_start.minute, segment_start.second)
-                }
+        self.json = []
 
-        if segment_start == t(0,0,0):
-            segment['end'] = segment['end'] + td(days=1)
+        # where the next window's scheduled segments pick up
+        self.next_start = start
 
-        # print('Basal segment start', segment['start'].isoformat())
-        # print('Basal segment end', segment['end'].isoformat())
-        # print('Basal segment rate', segment['delivered'])
-        # print()
+        if None in self.endpoints or self.endpoints[0]['deviceTime'] >= self.endpoints[1]['deviceTime']:
+            return
 
-        self.segments.append(segment);
+        self._expand_schedule(start is None, end is None)
 
-    def _append_temp_segment(self, d, duration, value):
+        self.next_start = from_epoch(self.segments[-1].end)
 
-        start = dt(d.year, d.month, d.day, d.hour, d.minute, d.second)
-
-        segment = {                
-                    'type': 'basal-rate-segment',
-                    'delivered': value,
-                    'value': value,
-                    'deliveryType': 'temp',
-                    'inferred': False,
-                    'start': start,
-                    'end': start + duration
-                }
-
-        # print('Basal segment start', segment['start'].isoformat())
-        # print('Basal segment end', segment['end'].isoformat())
-        # print('Basal segment rate', segment['delivered'])
-        # print()
+        self.generate_temp_basals()
 
-        self.temp_segments.append(segment);
+        self._merge_temp_segments()
 
-    def _get_difference(self, t1, t2):
+        # the last temp basal starts after the end, so it is left to the next window
+        self.pending_temp = self.temp_segments.pop()
 
-        d = dt.now() - td(days=30)
+        self.temp_segments = [s for s in self.temp_segments if s.end > s.start]
 
-        dt1 = dt(d.year, d.month, d.day, t1.hour, t1.minute, t1.second)
+        self.json = sorted(self.segments + self.temp_segments, key=lambda s: s.start)
 
-        dt2 = dt(d.year, d.month, d.day, t2.hour, t2.minute, t2.second)
+    def _append_segment(self, start, end, index, inferred = False):
 
-        if t1 == t(0,0,0):
-            dt1 = dt1 + td(days=1)
+        self.segments.append(BasalSegment(to_epoch(start), to_epoch(end), self.rates[index], 'scheduled', inferred))
 
-        return dt1 - dt2
+    def _expand_schedule(self, inferred_start, truncate_end):
+        """Lay the 24-hour schedule over the time between the endpoints, one segment per scheduled rate.
 
-    def _get_endpoints(self):
+        The first segment starts partway through the scheduled segment running
+        at the start. If truncate_end, the last segment is cut short at the
+        end, otherwise it runs on to its scheduled end. Cut short segments are
+        inferred.
+        """
 
-        bolus_times = []
+        begin = self.endpoints[0]['deviceTime'].replace(microsecond=0)
 
-        for b in self.boluses:
-            date_string = b['deviceTime']
-            bolus_times.append({'deviceTime': dt.strptime(date_string, '%Y-%m-%dT%H:%M:%S')})
+        end = self.endpoints[1]['deviceTime']
 
-        all_pump_data = bolus_times + self.carbs
+        day = dt(begin.year, begin.month, begin.day)
 
-        all_pump_data = sorted(all_pump_data, key=lambda x: x['deviceTime'])
+        # the segment running at begin; -1 is the last segment of the previous day
+        index = bisect_right(self.day_starts, (begin - day).seconds) - 1
 
-        return (all_pump_data[0], all_pump_data[len(all_pump_data) - 1])
+        segment_start = begin
 
-    def _get_initial_segment(self):
+        following = index + 1
 
-        d = self.endpoints[0]['deviceTime']
+        inferred = inferred_start
 
-        beginning = t(d.hour, d.minute, d.second)
+        while True:
+            if following == len(self.day_starts):
+                day += td(days=1)
+                following = 0
 
-        for i, start in enumerate(self.segment_starts):
-            if beginning < start:
-                self._append_segment(d, start, True)
-                return start
-        else:
-            self._append_segment(d, t(0,0,0), True)
-            return t(0,0,0)
+            boundary = day + td(seconds=self.day_starts[following])
 
-    def _get_middle_segments(self):
+            if truncate_end and boundary >= end:
+                self._append_segment(segment_start, end, index, True)
+                return
 
-        midnight = t(0,0,0)
+            self._append_segment(segment_start, boundary, index, inferred)
 
-        index = self.segment_starts.index(self.end_initial)
+            if boundary >= end:
+                return
 
-        segment_start = self.end_initial
+            segment_start, index, inferred = boundary, following, False
 
-        d = self.endpoints[0]['deviceTime']
+            following += 1
 
-        end = self.endpoints[1]['deviceTime']
+    def _append_temp_segment(self, d, duration, value):
 
-        start_datetime = dt(d.year, d.month, d.day, segment_start.hour, segment_start.minute, segment_start.second)
+        start = dt(d.year, d.month, d.day, d.hour, d.minute, d.second)
 
-        if segment_start == midnight:
-            start_datetime = start_datetime + td(days=1)
+        self.temp_segments.append(BasalSegment(to_epoch(start), to_epoch(start + duration), value, 'temp'))
 
-        current_datetime = start_datetime
+    def _merge_temp_segments(self):
+        """Cut each temp basal short where the next one starts, since a new temp basal replaces the one running."""
 
-        while current_datetime < end:
-            try:
-                next_segment_start = self.segment_starts[index + 1]
-                index += 1            
-            except IndexError:
-                next_segment_start = midnight
-                index = 0
-            self._append_segment(current_datetime, next_segment_start)
-            start_datetime = current_datetime
-            difference = self._get_difference(next_segment_start, t(current_datetime.hour, current_datetime.minute, current_datetime.second))
-            current_datetime = current_datetime + difference
+        for current, following in zip(self.temp_segments, self.temp_segments[1:]):
+            if current.end > following.start:
+                current.end = following.start
 
-        return start_datetime
-
-    def _get_final_segment(self):
+    def _get_endpoints(self):
 
-        # this is hack since I didn't do a great job on the while loop in _get_middle_segments
-        self.segments.pop()
+        times = [b.time for b in self.boluses] + [c.time for c in self.carbs]
 
-        d = self.endpoints[1]['deviceTime']
+        if not times:
+            return (None, None)
 
-        self._append_segment(self.end_middle, t(d.hour, d.minute, d.second), True)
+        return ({'deviceTime': from_epoch(min(times))}, {'deviceTime': from_epoch(max(times))})
 
     def generate_temp_basals(self):
 
@@ -583,15 +682,20 @@ class Basal:
 
         current_datetime = start
 
+        # carry on the run of temp basals from the previous window
+        if self.pending_temp is not None:
+            current_datetime = from_epoch(self.pending_temp.start)
+            self.temp_segments.append(self.pending_temp)
+
         basal_range = (min(self.schedule.values()) * 100, (max(self.schedule.values()) + max(self.schedule.values()) / 2) * 100)
 
         basal_possibilities = [x / 100.0 for x in range(0, int(basal_range[1]), 25)]
 
         while current_datetime < end:
-            days_delta = td(days=random.choice(day_skip))
-            time_delta = td(hours=random.choice(HOURS), minutes=random.choice(SIXTY))
+            days_delta = td(days=self.rng.choice(day_skip))
+            time_delta = td(hours=HOURS.sample(self.rng), minutes=randint_below(60, self.rng))
             current_datetime = current_datetime + days_delta + time_delta
-            self._append_temp_segment(current_datetime, td(minutes=random.choice(durations)), random.choice(basal_possibilities))
+            self._append_temp_segment(current_datetime, td(minutes=self.rng.choice(durations)), self.rng.choice(basal_possibilities))
 
 # TODO User class for generating profile info
 # class User:
@@ -609,101 +713,380 @@ class Basal:
 
 #         deets = data['results'][0]['user']
 
-def get_dates(data):
-    """Get the unique dates from an arbitrary set of device data."""
+def get_dates(times):
+    """Get the unique dates from a set of times, in seconds since the epoch."""
 
-    dates = set([])
+    return set(EPOCH.date() + td(days=day) for day in set(time // 86400 for time in times))
 
-    for reading in data:
-        dates.add(reading['deviceTime'].date())
+def finalise_records(records, ids):
+    """Turn records into dicts with the _id and deviceId fields each needs on output, drawing ids from ids."""
 
-    return dates
+    # smbg, boluses, carbs, and basal-rate-segments come from the pump
+    pump_fields = ['smbg', 'carbs', 'bolus', 'basal-rate-segment']
 
-def print_JSON(all_json, out_file):
+    for record in records:
+        time = record.time
+        record = record.to_dict(ids)
+        record['_id'] = ids.next(time)
+        if record['type'] in pump_fields:
+            record['deviceId'] = 'Paradigm Revel - 523'
+        yield record
 
-    # add an _id field as well
-    for a in all_json:
-        a['_id'] = str(uuid.uuid4())
+def generate_windows(dex, window_days, schedule={}, messages=True, text_provider=None, ids=None, tail=None, seed=None, workers=1):
+    """Generate every stage of demo data window_days at a time.
 
-    # add deviceId field to smbg, boluses, carbs, and basal-rate-segments
-    pump_fields = ['smbg', 'carbs', 'bolus', 'basal-rate-segment']
-    for a in all_json:
-        if a['type'] in pump_fields:
-            a['deviceId'] = 'Paradigm Revel - 523'
-
-    # temporarily add a device time to messages to enable sorting
-    for a in all_json:
-        try:
-            t = a['utcTime']
-            a['deviceTime'] = t
-        except KeyError:
-            pass
-
-    # temporarily add a device time to basals to enable sorting
-    for a in all_json:
-        try:
-            t = a['start']
-            a['deviceTime'] = t
-        except KeyError:
-            pass
-
-    all_json = sorted(all_json, key=lambda x: x['deviceTime'])
-
-    # remove device time from messages
-    for a in all_json:
-        try:
-            utc = a['utcTime']
-            del a['deviceTime']
-        except KeyError:
-            pass
-
-    # remove device time from basals
-    for a in all_json:
-        try:
-            start = a['start']
-            del a['deviceTime']
-        except KeyError:
-            pass
-
-    # print()
-    # print("Preview: first 50 data points...")
-    # print()
-
-    # for i in all_json[0:50]:
-    #     print(i)
-
-    # print()
-
-    with open(out_file, 'w') as f:
-        f.write(json.dumps(all_json, indent=4, separators=(',', ': ')))
+    Yields, for each window, a key that no record of this or any later window
+    sorts before, and the time-ordered record streams of the window. Only the
+    state each stage needs to carry on from one window to the next is kept
+    between windows, and given the TailState of existing data, the first
+    window carries on from that.
+
+    The stages of each window are run as a scheduler.StageGraph, each drawing
+    from its own random number stream seeded from seed, so the data for a seed
+    is the same whatever the number of workers. With more than one worker,
+    stages that do not depend on each other run at once, and the next window
+    is generated while the last one is written.
+    """
+
+    if seed is None:
+        seed = random.getrandbits(32)
+
+    ids = ids if ids is not None else IDAllocator()
+
+    graph = StageGraph(seed)
+
+    dex.rng = graph.rng('dexcom')
+
+    dex.start_trace(tail)
+
+    # windows after the first start at midnight, so each date is generated within one window
+    boundary = dt.combine(dex.start.date() + td(days=window_days), t(0,0,0))
+
+    state = {'window_start': dex.start, 'last_correction': None, 'basal_start': None, 'pending_temp': None}
+
+    if tail is not None:
+        state['last_correction'] = tail.bolus_time
+
+        # the schedule picks up where it left off, unless that is before the last of the existing data
+        if tail.basal_end is not None:
+            state['basal_start'] = from_epoch(max(tail.basal_end, tail.last_time))
+
+    def window(end):
+        # the final window runs on to the last of the generated data rather than stopping at end
+        window_end = end if end < dex.final else None
+
+        def dexcom(rng):
+            dex.generate_window(end)
+            return dex
+
+        def boluses(rng, meals):
+            return Boluses(meals, state['last_correction'], window_end, rng)
+
+        def basal(rng, boluses, meals):
+            return Basal(schedule, boluses.json, meals.carbs, state['basal_start'], window_end, state['pending_temp'], rng)
+
+        def threaded_messages(rng, smbg):
+            # message ids come from an allocator of the stage's own, so they do not depend on when it runs
+            return Messages(smbg, text_provider, IDAllocator(ids.kind, rng.getrandbits(64) if ids.rng is not None else None), rng)
+
+        graph.clear()
+        graph.add('dexcom', dexcom)
+        graph.add('smbg', lambda rng, dex: SMBG(dex, rng=rng), ['dexcom'])
+        graph.add('meals', lambda rng, smbg: Meals(smbg, rng), ['smbg'])
+        graph.add('boluses', boluses, ['meals'])
+        graph.add('basal', basal, ['boluses', 'meals'])
+        if messages:
+            graph.add('messages', threaded_messages, ['smbg'])
+
+        results = graph.run(workers)
+
+        state['last_correction'] = results['boluses'].last_correction
+
+        state['basal_start'], state['pending_temp'] = results['basal'].next_start, results['basal'].pending_temp
+
+        streams = [results[name].json for name in ['dexcom', 'smbg', 'basal', 'meals', 'boluses', 'messages'] if name in results]
+
+        # boluses can be shifted a few minutes before the start of their window
+        floor = to_epoch(state['window_start'] - td(hours=1))
+
+        state['window_start'] = end
+
+        return floor, streams
+
+    def windows(boundary):
+        while state['window_start'] < dex.final:
+            yield window(min(boundary, dex.final))
+            boundary += td(days=window_days)
+
+    if workers > 1:
+        return prefetch(windows(boundary))
+
+    return windows(boundary)
+
+def generate_patient(dex, out_file, output_format='json', window_days=None, messages=True, text_provider=None, ids=None, index=False, validator=None, workers=1, rollups=False):
+    """Generate the demo data of one patient and write it to out_file, returning the number of records.
+
+    With index, ndjson output also gets a sidecar index, for reading with
+    dataindex.IndexedData, and given a validation.Validator, each record is
+    validated as it is written. workers is the number of threads each window's
+    stages are scheduled on, as for generate_windows. The vendor formats of
+    exporters.VENDOR_FORMATS are written straight from the generated records,
+    returning the number of rows instead. With rollups, daily aggregates of
+    the records are worked out as they are written, and written to a summary
+    file named by rollups.rollup_name.
+    """
+
+    ids = ids if ids is not None else IDAllocator()
+
+    windows = generate_windows(dex, window_days or dex.days, messages=messages, text_provider=text_provider, ids=ids, workers=workers)
+
+    records = merge_windows(windows)
+
+    daily = DailyRollups() if rollups else None
+
+    if daily is not None:
+        records = daily.observe(records)
+
+    if output_format in VENDOR_FORMATS:
+        # written straight from the generated records, which never become dicts
+        count = write_export(records, out_file, output_format)
+    else:
+        builder = IndexBuilder() if index and output_format == 'ndjson' else None
+
+        count = write_records(finalise_records(records, ids), out_file, output_format, builder, check=validator.check if validator else None)
+
+        if builder is not None:
+            builder.write(index_name(out_file))
+
+    if daily is not None:
+        daily.write(rollup_name(out_file))
+
+    return count
+
+def append_seed(seed, last_time):
+    """Return the seed of data appended after last_time to data generated from seed."""
+
+    return (seed * 1000003 + last_time) & 0xffffffffffff
+
+def append_patient(dex, out_file, window_days=None, messages=True, text_provider=None, ids=None, validator=None, workers=1, rollups=False, seed=None):
+    """Generate dex.days more days of demo data after the end of an existing ndjson file, and append them to it.
+
+    Only the tail of the file is read, and its sidecar index, if it has one,
+    is updated, as are its daily rollups, when asked for; rollups of data
+    that had none start at the appended records. The index gets a block for
+    the appended records and the rollups are rewritten from their last day,
+    so neither is read whole and an append takes time in proportion to the
+    data appended rather than to the file. Given the seed the file was
+    generated from, the appended data and its ids are drawn from a seed
+    derived from it and the end of the existing data, so they carry on from
+    it rather than replaying it. Returns the number of records appended.
+    """
+
+    ids = ids if ids is not None else IDAllocator()
+
+    tail = read_tail(out_file)
+
+    if tail.last_time is None:
+        raise ValueError('%s has no records to append to' % out_file)
+
+    if seed is not None:
+        seed = append_seed(seed, tail.last_time)
+        ids = IDAllocator(ids.kind, seed)
+
+    builder = None
+
+    if os.path.exists(index_name(out_file)):
+        builder = load_index(index_name(out_file))
+        if builder.size != os.path.getsize(out_file):
+            raise ValueError('the index of %s is out of date' % out_file)
+
+    windows = generate_windows(dex, window_days or dex.days, messages=messages, text_provider=text_provider, ids=ids, tail=tail, seed=seed, workers=workers)
+
+    # records generated before the end of the existing data would be out of order
+    records = (record for record in merge_windows(windows) if record.time >= tail.last_time)
+
+    daily = DailyRollups() if rollups else None
+
+    if daily is not None:
+        # so scheduled basal appended under a temp basal of the existing data is not counted
+        daily.follow(tail.running_temps())
+        records = daily.observe(records)
+
+    count = write_records(finalise_records(records, ids), out_file, 'ndjson', builder, append=True, check=validator.check if validator else None)
+
+    if builder is not None:
+        builder.write(index_name(out_file))
+
+    if daily is not None:
+        daily.append(rollup_name(out_file))
+
+    return count
+
+def feed_patient(dex, target, speed=100.0, batch_size=100, window_days=1, messages=True, text_provider=None, ids=None, workers=1):
+    """Generate the demo data of one patient a window at a time and send it to target as it falls due.
+
+    target is as for feed.open_sink, and the clock runs speed times faster
+    than real time. Returns the FeedStats of the feed.
+    """
+
+    ids = ids if ids is not None else IDAllocator()
+
+    windows = generate_windows(dex, window_days, messages=messages, text_provider=text_provider, ids=ids, workers=workers)
+
+    sink = open_sink(target)
+
+    try:
+        return emit(finalise_records(merge_windows(windows), ids), sink, speed, batch_size)
+    finally:
+        sink.close()
+
+# state shared by the worker processes of a cohort; filled in before forking so workers inherit the loaded library
+COHORT = {}
+
+def shard_name(out_file, index):
+    """Return the name of the output file for the patient at index of a cohort."""
+
+    root, extension = os.path.splitext(out_file)
+
+    return '%s-%05d%s' % (root, index, extension)
+
+def _init_cohort_worker(args):
+
+    # only needed where workers are spawned rather than forked
+    if 'library' not in COHORT:
+        COHORT['library'] = load_library(find_library(args.dexcom_segments))
+        COHORT['args'] = args
+
+def _generate_cohort_patient(job):
+
+    index, seed, out_file = job
+
+    args = COHORT['args']
+
+    random.seed(seed)
+
+    dex = Dexcom(None, args.num_days, args.backend, segments=COHORT['library'], start=args.start)
+
+    text_provider = get_provider(args.text_provider, args.text_url)
+
+    ids = IDAllocator(args.ids, seed)
+
+    try:
+        count = generate_patient(dex, out_file, args.output_format, args.window_days, not args.quiet_messages, text_provider, ids, args.index, Validator() if args.validate else None, args.workers, args.rollups)
+    finally:
+        text_provider.close()
+
+    return index, out_file, count
+
+def generate_cohort(args, patients, processes, seed):
+    """Generate a cohort of patients on a pool of processes, one output shard per patient.
+
+    The segment library is loaded once and shared with the workers, and each
+    patient is generated from its own seed derived from seed, so a cohort can
+    be reproduced exactly.
+    """
+
+    COHORT['library'] = load_library(find_library(args.dexcom_segments))
+    COHORT['args'] = args
+
+    jobs = [(i, seed * 1000003 + i, shard_name(args.output_file, i)) for i in range(patients)]
+
+    pool = Pool(processes, _init_cohort_worker, (args,))
+
+    try:
+        for index, out_file, count in pool.imap_unordered(_generate_cohort_patient, jobs):
+            print('Patient', index, 'wrote', count, 'records to', out_file)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 def main():
 
     parser = argparse.ArgumentParser(description='Generate demo diabetes data for Tidepool applications and visualizations.')
-    parser.add_argument('-d', '--dexcom', action='store', dest='dexcom_segments', help='name of file containing indexed continuous segments of Dexcom data;\ndefault is indexed_segments.json')
+    parser.add_argument('-d', '--dexcom', action='store', dest='dexcom_segments', help='name of file containing indexed continuous segments of Dexcom data, as JSON or compiled or built from Dexcom Studio exports with segments.py;\ndefault is indexed_segments.bin if present, otherwise indexed_segments.json')
+    parser.add_argument('-b', '--backend', action='store', dest='backend', default='python', choices=['python', 'numpy'], help='engine used to build the Dexcom trace; numpy is much faster for long date ranges but requires NumPy;\ndefault is python')
     parser.add_argument('-n', '--num_days', action='store', dest='num_days', default=30, type=int, help='number of days of demo data to generate;\ndefault is 30')
     parser.add_argument('-o', '--output_file', action='store', dest='output_file', default='device-data.json', help='name of output JSON file;\ndefault is device-data.json')
-    parser.add_argument('-q', '--quiet_messages', action='store_true', dest='quiet_messages', help='use this flag to turn off messages when bacon ipsum is being slow')
+    parser.add_argument('-f', '--format', action='store', dest='output_format', default='json', choices=FORMATS + VENDOR_FORMATS, help='output format: an indented JSON array, a minified JSON array, newline-delimited JSON, newline-delimited JSON compressed with gzip or zstd, columns of each type of record in NumPy .npz or Arrow files named after the output file, or the native export of Dexcom Studio, Medtronic CareLink or an Animas pump through Diasend;\ndefault is json')
+    parser.add_argument('-a', '--append', action='store_true', dest='append', help='use this flag to append num_days more days to the end of an existing ndjson output file, and to its index if it has one')
+    parser.add_argument('-x', '--index', action='store_true', dest='index', help='use this flag to also write a sidecar index of ndjson output, by day and type, to the output file name followed by .idx')
+    parser.add_argument('-r', '--rollups', action='store_true', dest='rollups', help='use this flag to also write daily rollups of the data, such as mean glucose, time in range and total insulin and carbs, to the output file name followed by .daily.json')
+    parser.add_argument('-w', '--window_days', action='store', dest='window_days', type=int, help='generate the data this many days at a time to bound memory use for long date ranges;\ndefault is all days at once')
+    parser.add_argument('-e', '--emit', action='store', dest='emit', help='instead of writing the output file, send the data as a live ndjson feed to - for stdout, tcp://host:port, an http:// URL to POST batches to, or a file, as it falls due on an accelerated clock')
+    parser.add_argument('--speed', action='store', dest='speed', default=100.0, type=float, help='how many times faster than real time the clock of a live feed runs;\ndefault is 100')
+    parser.add_argument('--batch_size', action='store', dest='batch_size', default=100, type=int, help='most records to send at once in a live feed;\ndefault is 100')
+    parser.add_argument('-p', '--patients', action='store', dest='patients', default=1, type=int, help='number of patients to generate; each patient of a cohort is written to its own numbered output file;\ndefault is 1')
+    parser.add_argument('-j', '--processes', action='store', dest='processes', default=cpu_count(), type=int, help='number of processes to generate a cohort of patients on;\ndefault is the number of CPUs')
+    parser.add_argument('-W', '--workers', action='store', dest='workers', default=1, type=int, help='number of threads to run the stages of each window on, overlapping generating the next window with writing the last; the data for a seed is the same whatever the number;\ndefault is 1')
+    parser.add_argument('-s', '--seed', action='store', dest='seed', type=int, help='random seed, for reproducible demo data;\ndefault is a random seed')
+    parser.add_argument('-V', '--validate', action='store_true', dest='validate', help='use this flag to validate each record against the schemas of the data model as it is written, stopping at the first invalid record')
+    parser.add_argument('-q', '--quiet_messages', action='store_true', dest='quiet_messages', help='use this flag to turn off messages altogether')
+    parser.add_argument('-t', '--text_provider', action='store', dest='text_provider', default='offline', choices=sorted(PROVIDERS.keys()), help='source of message text: generated offline from a bundled word bank, or fetched from bacon ipsum;\ndefault is offline')
+    parser.add_argument('-i', '--ids', action='store', dest='ids', default='uuid4', choices=ID_KINDS, help='kind of UUID to give records: random, or time-ordered from the time of the record; ids are reproducible when a seed is given;\ndefault is uuid4')
+    parser.add_argument('--text_url', action='store', dest='text_url', default=BACON_IPSUM_URL, help='URL to fetch bacon ipsum from, followed by the number of sentences;\ndefault is ' + BACON_IPSUM_URL)
     args = parser.parse_args()
 
-    dex = Dexcom(args.dexcom_segments, args.num_days)
-    dex.generate_JSON()
+    if args.backend == 'numpy' and np is None:
+        parser.error('the numpy backend requires NumPy to be installed')
 
-    smbg = SMBG(dex)
+    if not format_available(args.output_format):
+        parser.error('%s output requires a library that is not installed' % args.output_format)
 
-    meals = Meals(smbg)
+    if args.index and args.output_format != 'ndjson':
+        parser.error('only ndjson output can be indexed')
 
-    boluses = Boluses(meals)
+    if args.validate and args.output_format in VENDOR_FORMATS:
+        parser.error('only the Tidepool formats can be validated against the data model')
 
-    basal = Basal({}, boluses.json, meals.carbs)
+    if args.emit and (args.append or args.patients > 1):
+        parser.error('a live feed is of a single patient')
 
-    if args.quiet_messages:
-        all_json = dex.json + smbg.json + basal.json + meals.json + boluses.json
-    else:
-        messages = Messages(smbg)
-        all_json = dex.json + smbg.json + basal.json + meals.json + boluses.json + messages.json
+    if args.emit and args.rollups:
+        parser.error('rollups are written alongside an output file, not a live feed')
+
+    if args.append and (args.output_format != 'ndjson' or args.patients > 1):
+        parser.error('only the ndjson output of a single patient can be appended to')
+
+    if args.append and not os.path.exists(args.output_file):
+        parser.error('%s does not exist to append to' % args.output_file)
+
+    if args.patients > 1:
+        # patients of a cohort share a start day so they line up with each other
+        args.start = dt.combine(dt.now().date(), t(12,0,0))
+
+        seed = args.seed if args.seed is not None else random.randrange(1 << 30)
+        print('Generating', args.patients, 'patients with seed', seed)
+
+        generate_cohort(args, args.patients, args.processes, seed)
+        return
 
-    print_JSON(all_json, args.output_file)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    dex = Dexcom(args.dexcom_segments, args.num_days, args.backend)
+
+    text_provider = get_provider(args.text_provider, args.text_url)
+
+    ids = IDAllocator(args.ids, args.seed)
+
+    validator = Validator() if args.validate else None
+
+    try:
+        if args.emit:
+            stats = feed_patient(dex, args.emit, args.speed, args.batch_size, args.window_days or 1, not args.quiet_messages, text_provider, ids, args.workers)
+            # the feed itself may be going to stdout
+            print(json.dumps(stats.report(), sort_keys=True), file=sys.stderr)
+            return
+        if args.append:
+            count = append_patient(dex, args.output_file, args.window_days, not args.quiet_messages, text_provider, ids, validator, args.workers, args.rollups, args.seed)
+            print('Appended', count, 'records to', args.output_file)
+        else:
+            generate_patient(dex, args.output_file, args.output_format, args.window_days, not args.quiet_messages, text_provider, ids, args.index, validator, args.workers, args.rollups)
+    finally:
+        text_provider.close()
     print()
 
 if __name__ == '__main__':
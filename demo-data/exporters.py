@@ -0,0 +1,220 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from collections import deque
+
+from records import BasalSegment, BolusRecord, CarbsRecord, CBGRecord, SMBGRecord
+from segments import STUDIO_TIME, STUDIO_VALUE
+from timestamps import TimeFormatter
+
+# files in the native formats of device vendors' own software, for testing upload parsers with
+VENDOR_FORMATS = ['dexcom.txt', 'medtronic.csv', 'animas.csv']
+
+# bytes buffered before each write to the file
+BUFFER_SIZE = 1 << 20
+
+# records a pump records; the CGM readings come from a Dexcom and messages from Tidepool itself
+PUMP_RECORDS = (BasalSegment, BolusRecord, CarbsRecord, SMBGRecord)
+
+# columns of a Dexcom Studio tab-delimited export; internal times are the receiver's clock, taken to be the display time
+DEXCOM_COLUMNS = ['PatientInfoField', 'PatientInfoValue', 'GlucoseInternalTime', STUDIO_TIME, STUDIO_VALUE, 'MeterInternalTime', 'MeterDisplayTime', 'MeterValue']
+
+# columns of a Medtronic CareLink CSV export; the date and time columns are formatted together
+MEDTRONIC_COLUMNS = ['Index', 'Date,Time', 'BG Reading (mg/dL)', 'Basal Rate (U/h)', 'Temp Basal Amount (U/h)', 'Temp Basal Type', 'Temp Basal Duration (h:mm:ss)', 'Bolus Type', 'Bolus Volume Selected (U)', 'Bolus Volume Delivered (U)', 'Programmed Bolus Duration (h:mm:ss)', 'BWZ Estimate (U)', 'BWZ Carb Input (grams)', 'Raw-Type']
+
+# columns of an Animas pump export from Diasend
+ANIMAS_COLUMNS = ['Time', 'Glucose (mg/dL)', 'Basal Amount (U/h)', 'Bolus Type', 'Bolus Volume (U)', 'Immediate Volume (U)', 'Extended Volume (U)', 'Duration (min)', 'Carbs (g)']
+
+def _row_format(columns, fields, separator=','):
+    """Return a format string for a row with a %s in each of fields, in the order of columns, and every other column empty."""
+
+    return separator.join('%s' if column in fields else '' for column in columns) + '\n'
+
+def _hms(milliseconds):
+    """Return a duration in milliseconds as h:mm:ss."""
+
+    minutes, seconds = divmod(milliseconds // 1000, 60)
+
+    return '%d:%02d:%02d' % (minutes // 60, minutes % 60, seconds)
+
+def _units(value):
+
+    return '%.2f' % value
+
+DEXCOM_ROWS = {
+    'both': _row_format(DEXCOM_COLUMNS, ['GlucoseInternalTime', STUDIO_TIME, STUDIO_VALUE, 'MeterInternalTime', 'MeterDisplayTime', 'MeterValue'], '\t'),
+    'cbg': _row_format(DEXCOM_COLUMNS, ['GlucoseInternalTime', STUDIO_TIME, STUDIO_VALUE], '\t'),
+    'smbg': _row_format(DEXCOM_COLUMNS, ['MeterInternalTime', 'MeterDisplayTime', 'MeterValue'], '\t')
+}
+
+def dexcom_rows(records):
+    """Yield the rows of a Dexcom Studio export of the CGM and meter readings among records.
+
+    Studio lists glucose and meter readings side by side, each in time order,
+    so a meter reading waits only until the next glucose reading to share its
+    row.
+    """
+
+    formatter = TimeFormatter(pattern='%Y-%m-%d %H:%M:')
+
+    stamp = formatter.format
+
+    both, cbg, smbg = DEXCOM_ROWS['both'], DEXCOM_ROWS['cbg'], DEXCOM_ROWS['smbg']
+
+    meter = deque()
+
+    for record in records:
+        if isinstance(record, CBGRecord):
+            time = stamp(record.time)
+            if meter:
+                reading = meter.popleft()
+                yield both % (time, time, record.value, reading[0], reading[0], reading[1])
+            else:
+                yield cbg % (time, time, record.value)
+        elif isinstance(record, SMBGRecord):
+            meter.append((stamp(record.time), record.value))
+
+    for time, value in meter:
+        yield smbg % (time, time, value)
+
+MEDTRONIC_ROWS = {
+    'smbg': _row_format(MEDTRONIC_COLUMNS, ['Index', 'Date,Time', 'BG Reading (mg/dL)', 'Raw-Type']),
+    'scheduled': _row_format(MEDTRONIC_COLUMNS, ['Index', 'Date,Time', 'Basal Rate (U/h)', 'Raw-Type']),
+    'temp': _row_format(MEDTRONIC_COLUMNS, ['Index', 'Date,Time', 'Temp Basal Amount (U/h)', 'Temp Basal Type', 'Temp Basal Duration (h:mm:ss)', 'Raw-Type']),
+    'carbs': _row_format(MEDTRONIC_COLUMNS, ['Index', 'Date,Time', 'BWZ Carb Input (grams)', 'Raw-Type']),
+    'normal': _row_format(MEDTRONIC_COLUMNS, ['Index', 'Date,Time', 'Bolus Type', 'Bolus Volume Selected (U)', 'Bolus Volume Delivered (U)', 'BWZ Estimate (U)', 'Raw-Type']),
+    'square': _row_format(MEDTRONIC_COLUMNS, ['Index', 'Date,Time', 'Bolus Type', 'Bolus Volume Selected (U)', 'Bolus Volume Delivered (U)', 'Programmed Bolus Duration (h:mm:ss)', 'Raw-Type'])
+}
+
+def medtronic_rows(records):
+    """Yield the rows of a Medtronic CareLink export of the pump records among records.
+
+    CGM readings came from a Dexcom, so are not among them. The carbs of a
+    meal are entered in the bolus wizard, and a dual-wave bolus is a row for
+    each of its normal and square parts.
+    """
+
+    formatter = TimeFormatter(pattern='%m/%d/%y,%H:%M:')
+
+    stamp = formatter.format
+
+    rows = MEDTRONIC_ROWS
+
+    index = 0
+
+    for record in records:
+        if not isinstance(record, PUMP_RECORDS):
+            continue
+
+        time = stamp(record.time)
+
+        index += 1
+
+        if isinstance(record, BasalSegment):
+            if record.delivery_type == 'temp':
+                yield rows['temp'] % (index, time, '%.3f' % record.rate, 'Absolute', _hms((record.end - record.start) * 1000), 'ChangeTempBasal')
+            else:
+                yield rows['scheduled'] % (index, time, '%.3f' % record.rate, 'BasalProfileStart')
+        elif isinstance(record, BolusRecord):
+            if not record.extended:
+                yield rows['normal'] % (index, time, 'Normal', _units(record.value), _units(record.value), _units(record.recommended), 'BolusNormal')
+            elif record.initial_delivery is None:
+                yield rows['square'] % (index, time, 'Square', _units(record.value), _units(record.value), _hms(record.duration), 'BolusSquare')
+            else:
+                yield rows['normal'] % (index, time, 'Dual (normal part)', _units(record.initial_delivery), _units(record.initial_delivery), _units(record.recommended), 'BolusNormal')
+                index += 1
+                yield rows['square'] % (index, time, 'Dual (square part)', _units(record.extended_delivery), _units(record.extended_delivery), _hms(record.duration), 'BolusSquare')
+        elif isinstance(record, SMBGRecord):
+            yield rows['smbg'] % (index, time, record.value, 'BGReceived')
+        elif isinstance(record, CarbsRecord):
+            yield rows['carbs'] % (index, time, record.value, 'BolusWizardBolusEstimate')
+
+ANIMAS_ROWS = {
+    'smbg': _row_format(ANIMAS_COLUMNS, ['Time', 'Glucose (mg/dL)']),
+    'basal': _row_format(ANIMAS_COLUMNS, ['Time', 'Basal Amount (U/h)']),
+    'carbs': _row_format(ANIMAS_COLUMNS, ['Time', 'Carbs (g)']),
+    'normal': _row_format(ANIMAS_COLUMNS, ['Time', 'Bolus Type', 'Bolus Volume (U)']),
+    'extended': _row_format(ANIMAS_COLUMNS, ['Time', 'Bolus Type', 'Bolus Volume (U)', 'Immediate Volume (U)', 'Extended Volume (U)', 'Duration (min)'])
+}
+
+def animas_rows(records):
+    """Yield the rows of a Diasend export of an Animas pump, of the pump records among records.
+
+    Diasend shows scheduled and temp basals alike as changes of the basal
+    rate, and an extended or combination bolus as one row with both parts.
+    """
+
+    formatter = TimeFormatter(pattern='%d/%m/%Y %H:%M:')
+
+    stamp = formatter.format
+
+    rows = ANIMAS_ROWS
+
+    for record in records:
+        if isinstance(record, BasalSegment):
+            yield rows['basal'] % (stamp(record.time), '%.3f' % record.rate)
+        elif isinstance(record, BolusRecord):
+            if not record.extended:
+                yield rows['normal'] % (stamp(record.time), 'Normal', _units(record.value))
+            else:
+                immediate = record.initial_delivery or 0.0
+                yield rows['extended'] % (stamp(record.time), 'Combination' if record.initial_delivery is not None else 'Extended', _units(record.value), _units(immediate), _units(record.extended_delivery), record.duration // 60000)
+        elif isinstance(record, SMBGRecord):
+            yield rows['smbg'] % (stamp(record.time), record.value)
+        elif isinstance(record, CarbsRecord):
+            yield rows['carbs'] % (stamp(record.time), record.value)
+
+EXPORTERS = {
+    'dexcom.txt': (DEXCOM_COLUMNS, '\t', dexcom_rows),
+    'medtronic.csv': (MEDTRONIC_COLUMNS, ',', medtronic_rows),
+    'animas.csv': (ANIMAS_COLUMNS, ',', animas_rows)
+}
+
+def write_export(records, out_file, output_format):
+    """Write the time-ordered records, as generated rather than as dicts, to out_file in the vendor output_format.
+
+    Each row is formatted straight from its record, and rows are gathered
+    into writes of about BUFFER_SIZE bytes. Records the vendor's device would
+    not have recorded are left out. Returns the number of rows.
+    """
+
+    with open(out_file, 'w') as f:
+        return stream_export(records, f, output_format)
+
+def stream_export(records, f, output_format, buffer_size=BUFFER_SIZE):
+    """Write records in the vendor output_format to f, which need only have a write method, returning the number of rows."""
+
+    columns, separator, rows = EXPORTERS[output_format]
+
+    count = 0
+
+    f.write(separator.join(columns) + '\n')
+
+    chunk, size = [], 0
+    for row in rows(records):
+        chunk.append(row)
+        size += len(row)
+        if size >= buffer_size:
+            f.write(''.join(chunk))
+            count += len(chunk)
+            chunk, size = [], 0
+
+    f.write(''.join(chunk))
+    count += len(chunk)
+
+    return count
@@ -0,0 +1,196 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from array import array
+import json
+import socket
+import sys
+import time
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+
+from timestamps import TimeFormatter
+from writers import format_record, record_time
+
+class StreamSink:
+    """Send batches of records to a file-like object as ndjson."""
+
+    def __init__(self, stream, close=False):
+
+        self.stream = stream
+
+        # only close streams opened for the sink
+        self.should_close = close
+
+    def send(self, lines):
+
+        self.stream.write(''.join(lines))
+        self.stream.flush()
+
+    def close(self):
+
+        if self.should_close:
+            self.stream.close()
+
+class SocketSink:
+    """Send batches of records to a TCP socket as ndjson."""
+
+    def __init__(self, host, port, timeout=30):
+
+        self.socket = socket.create_connection((host, port), timeout)
+
+    def send(self, lines):
+
+        self.socket.sendall(''.join(lines).encode('utf-8'))
+
+    def close(self):
+
+        self.socket.close()
+
+class HTTPSink:
+    """POST each batch of records to a URL as a JSON array."""
+
+    def __init__(self, url, timeout=30):
+
+        self.url = url
+
+        self.timeout = timeout
+
+    def send(self, lines):
+
+        body = ('[' + ','.join(line.rstrip('\n') for line in lines) + ']').encode('utf-8')
+
+        request = Request(self.url, body, {'Content-Type': 'application/json'})
+
+        urlopen(request, timeout=self.timeout).read()
+
+    def close(self):
+
+        pass
+
+def open_sink(target):
+    """Return the sink for target: - for stdout, tcp://host:port, an http:// URL, or otherwise a file name."""
+
+    if target == '-':
+        return StreamSink(sys.stdout)
+
+    if target.startswith('tcp://'):
+        host, port = target[len('tcp://'):].rsplit(':', 1)
+        return SocketSink(host, int(port))
+
+    if target.startswith('http://') or target.startswith('https://'):
+        return HTTPSink(target)
+
+    return StreamSink(open(target, 'w'), close=True)
+
+def percentile(values, p):
+    """Return the pth percentile of sorted values, by the nearest rank."""
+
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+class FeedStats:
+    """Throughput and latency of a feed.
+
+    The latency of a record is how long after it was due, on the accelerated
+    clock, it was sent.
+    """
+
+    def __init__(self):
+
+        self.records = 0
+
+        self.batches = 0
+
+        self.latencies = array('d')
+
+        self.started = None
+
+        self.finished = None
+
+    def report(self):
+
+        elapsed = (self.finished - self.started) if self.started is not None else 0.0
+
+        latencies = sorted(self.latencies)
+
+        return {
+            'records': self.records,
+            'batches': self.batches,
+            'seconds': elapsed,
+            'records_per_second': self.records / elapsed if elapsed > 0 else 0.0,
+            'latency_ms': dict(('p%d' % p, percentile(latencies, p) * 1000) for p in (50, 90, 99, 100))
+        }
+
+def emit(records, sink, speed=100.0, batch_size=100, clock=time.time, sleep=time.sleep):
+    """Send records, in time order, to sink as they fall due on a clock running speed times faster than real time.
+
+    records are the dicts of finalise_records, and are formatted as they are
+    sent. A batch is sent when it reaches batch_size records or the next
+    record is not yet due. Returns the FeedStats of the feed.
+    """
+
+    stats = FeedStats()
+
+    formatter = TimeFormatter()
+
+    batch, due_times = [], []
+
+    first = None
+
+    def flush():
+
+        sink.send(batch)
+        sent = clock()
+        stats.latencies.extend(max(0.0, sent - due) for due in due_times)
+        stats.records += len(batch)
+        stats.batches += 1
+        del batch[:], due_times[:]
+
+    for record in records:
+        time_of_record = record_time(record)
+
+        if first is None:
+            first = time_of_record
+            stats.started = clock()
+
+        due = stats.started + (time_of_record - first) / float(speed)
+
+        wait = due - clock()
+
+        if batch and (len(batch) >= batch_size or wait > 0):
+            flush()
+            wait = due - clock()
+
+        if wait > 0:
+            sleep(wait)
+
+        batch.append(json.dumps(format_record(record, formatter), separators=(',', ':')) + '\n')
+        due_times.append(due)
+
+    if batch:
+        flush()
+
+    stats.finished = clock()
+
+    return stats
@@ -0,0 +1,98 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from binascii import hexlify
+import os
+import random
+import time
+
+# uuid4 ids are random; uuid7 ids start with the record's time in milliseconds, so they sort in time order
+ID_KINDS = ['uuid4', 'uuid7']
+
+# the two variant bits of an RFC 4122 UUID are 10, so the first hex digit of the fourth group is one of these
+VARIANT = '89ab'
+
+class IDAllocator:
+    """Allocate UUID strings for the id and _id fields of records.
+
+    Entropy is drawn batch_size ids at a time rather than once per id. Given a
+    seed the ids are drawn from their own random number generator, so they are
+    reproducible without disturbing the generation of the data itself.
+    """
+
+    def __init__(self, kind='uuid4', seed=None, batch_size=4096):
+
+        if kind not in ID_KINDS:
+            raise ValueError('unknown kind of id: %s' % kind)
+
+        self.kind = kind
+
+        self.rng = random.Random(seed) if seed is not None else None
+
+        self.batch_size = batch_size
+
+        self.entropy = ''
+
+        self.position = 0
+
+        # the last uuid7 millisecond, and the counter that keeps ids within it in order
+        self.last_millis = None
+
+        self.sequence = 0
+
+    def _random_hex(self):
+        """Return the next 32 random hex digits."""
+
+        if self.position >= len(self.entropy):
+            if self.rng is not None:
+                self.entropy = '%0*x' % (32 * self.batch_size, self.rng.getrandbits(128 * self.batch_size))
+            else:
+                self.entropy = hexlify(os.urandom(16 * self.batch_size)).decode('ascii')
+            self.position = 0
+
+        self.position += 32
+
+        return self.entropy[self.position - 32:self.position]
+
+    def next(self, seconds=None):
+        """Return a new id, for a record at seconds since the epoch when the kind of id is time-ordered."""
+
+        h = self._random_hex()
+
+        variant = VARIANT[int(h[16], 16) & 3]
+
+        if self.kind == 'uuid4':
+            return '%s-%s-4%s-%s%s-%s' % (h[:8], h[8:12], h[13:16], variant, h[17:20], h[20:])
+
+        millis = int(seconds * 1000) if seconds is not None else int(time.time() * 1000)
+
+        # record times are whole seconds, so ids for the same time count up in the 12 bits
+        # after the version, carrying into the following milliseconds if they run out
+        if self.last_millis is not None and self.last_millis - 1000 < millis <= self.last_millis:
+            self.sequence += 1
+            if self.sequence > 0xfff:
+                self.last_millis += 1
+                self.sequence = 0
+            millis = self.last_millis
+        else:
+            self.last_millis = millis
+            self.sequence = 0
+
+        stamp = '%012x' % millis
+
+        return '%s-%s-7%03x-%s%s-%s' % (stamp[:8], stamp[8:], self.sequence, variant, h[17:20], h[20:])
@@ -0,0 +1,195 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from array import array
+
+# Generated data is held in these compact record types rather than dicts. Every
+# record has a time, in seconds since the epoch, that it is ordered by in the
+# output, and only becomes a dict, through to_dict, as it is written; its id is
+# drawn then from an IDAllocator.
+
+class CBGRecord(object):
+    """A continuous blood glucose reading."""
+
+    __slots__ = ('time', 'value')
+
+    type = 'cbg'
+
+    def __init__(self, time, value):
+
+        self.time = time
+
+        self.value = value
+
+    def to_dict(self, ids):
+
+        return {'id': ids.next(self.time), 'type': 'cbg', 'value': self.value, 'deviceTime': self.time}
+
+class CBGColumns(object):
+    """A time-ordered run of continuous blood glucose readings, stored as columns."""
+
+    def __init__(self, times=(), values=()):
+
+        # typecode 'l' rather than 'q' so this also works on Python 2
+        self.times = array('l', times)
+
+        self.values = array('h', values)
+
+    def __len__(self):
+
+        return len(self.times)
+
+    def __iter__(self):
+
+        for time, value in zip(self.times, self.values):
+            yield CBGRecord(time, value)
+
+class SMBGRecord(object):
+    """A self-monitored blood glucose reading."""
+
+    __slots__ = ('time', 'value')
+
+    type = 'smbg'
+
+    def __init__(self, time, value):
+
+        self.time = time
+
+        self.value = value
+
+    def to_dict(self, ids):
+
+        return {'id': ids.next(self.time), 'type': 'smbg', 'value': self.value, 'deviceTime': self.time}
+
+class CarbsRecord(object):
+    """Carbohydrates eaten, in grams."""
+
+    __slots__ = ('time', 'value')
+
+    type = 'carbs'
+
+    def __init__(self, time, value):
+
+        self.time = time
+
+        self.value = value
+
+    def to_dict(self, ids):
+
+        return {'id': ids.next(self.time), 'type': 'carbs', 'units': 'grams', 'value': self.value, 'deviceTime': self.time}
+
+class BolusRecord(object):
+    """A normal, square-wave or dual-wave bolus."""
+
+    __slots__ = ('time', 'value', 'recommended', 'initial_delivery', 'extended_delivery', 'duration')
+
+    type = 'bolus'
+
+    def __init__(self, time, value, recommended):
+
+        self.time = time
+
+        self.value = value
+
+        self.recommended = recommended
+
+        # initial_delivery is only set for dual-wave boluses, and extended_delivery and duration for any extended bolus
+        self.initial_delivery = None
+
+        self.extended_delivery = None
+
+        # duration in milliseconds
+        self.duration = None
+
+    @property
+    def extended(self):
+
+        return self.extended_delivery is not None
+
+    def to_dict(self, ids):
+
+        bolus = {'id': ids.next(self.time), 'type': 'bolus', 'deviceTime': self.time, 'value': self.value, 'recommended': self.recommended}
+
+        if self.initial_delivery is not None:
+            bolus['initialDelivery'] = self.initial_delivery
+
+        if self.extended:
+            bolus['extendedDelivery'] = self.extended_delivery
+            bolus['duration'] = self.duration
+            bolus['extended'] = True
+
+        return bolus
+
+class BasalSegment(object):
+    """A span of time over which a scheduled or temp basal rate was delivered."""
+
+    __slots__ = ('start', 'end', 'rate', 'delivery_type', 'inferred')
+
+    type = 'basal-rate-segment'
+
+    def __init__(self, start, end, rate, delivery_type, inferred=False):
+
+        self.start = start
+
+        self.end = end
+
+        self.rate = rate
+
+        self.delivery_type = delivery_type
+
+        self.inferred = inferred
+
+    @property
+    def time(self):
+
+        return self.start
+
+    def to_dict(self, ids):
+
+        return {
+            'type': 'basal-rate-segment',
+            'delivered': self.rate,
+            'value': self.rate,
+            'deliveryType': self.delivery_type,
+            'inferred': self.inferred,
+            'start': self.start,
+            'end': self.end,
+            'id': ids.next(self.time)
+        }
+
+class MessageRecord(object):
+    """A message, or a reply in a thread of messages."""
+
+    __slots__ = ('time', 'id', 'parent', 'text')
+
+    type = 'message'
+
+    def __init__(self, time, message_id, parent, text=None):
+
+        self.time = time
+
+        self.id = message_id
+
+        # id of the message this replies to, or '' for the start of a thread
+        self.parent = parent
+
+        self.text = text
+
+    def to_dict(self, ids):
+
+        return {'type': 'message', 'id': self.id, 'parentMessage': self.parent, 'utcTime': self.time, 'messageText': self.text}
@@ -0,0 +1,310 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from datetime import datetime as dt
+import json
+import math
+import os
+
+from timestamps import from_epoch, to_epoch
+
+# target range of blood glucose, in mg/dL, inclusive
+TARGET_RANGE = (70, 180)
+
+# the end of a rollup file after its last day
+END = '\n]\n'
+
+# bytes read back from the end of a rollup file for its last day, many times the length of a day
+TAIL_SIZE = 4096
+
+def rollup_name(out_file):
+    """Return the name of the daily rollups of out_file."""
+
+    return out_file + '.daily.json'
+
+class Moments(object):
+    """Running count, mean and sum of squared deviations of a series of values, by Welford's method."""
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self, count=0, mean=0.0, sd=0.0):
+
+        self.count = count
+
+        self.mean = mean
+
+        self.m2 = sd * sd * count
+
+    def add(self, value):
+
+        self.count += 1
+
+        delta = value - self.mean
+
+        self.mean += delta / self.count
+
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """Combine the moments of another series into these."""
+
+        count = self.count + other.count
+
+        if not count:
+            return
+
+        delta = other.mean - self.mean
+
+        self.mean += delta * other.count / count
+
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+
+        self.count = count
+
+    @property
+    def sd(self):
+        """Population standard deviation."""
+
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+class DayRollup(object):
+    """Aggregates of the records of one day."""
+
+    __slots__ = ('cbg', 'below', 'in_range', 'above', 'smbg', 'basal', 'bolus', 'carbs')
+
+    def __init__(self):
+
+        self.cbg = Moments()
+
+        # CGM readings below, within and above TARGET_RANGE
+        self.below, self.in_range, self.above = 0, 0, 0
+
+        self.smbg = Moments()
+
+        # units of insulin and grams of carbs
+        self.basal, self.bolus, self.carbs = 0.0, 0.0, 0
+
+    def merge(self, other):
+
+        self.cbg.merge(other.cbg)
+        self.below += other.below
+        self.in_range += other.in_range
+        self.above += other.above
+        self.smbg.merge(other.smbg)
+        self.basal += other.basal
+        self.bolus += other.bolus
+        self.carbs += other.carbs
+
+    def to_dict(self, day):
+
+        return {
+            'date': from_epoch(day * 86400).strftime('%Y-%m-%d'),
+            'cbgCount': self.cbg.count,
+            'cbgMean': round(self.cbg.mean, 2) if self.cbg.count else None,
+            'cbgSD': round(self.cbg.sd, 2) if self.cbg.count else None,
+            'cbgBelow': self.below,
+            'cbgInRange': self.in_range,
+            'cbgAbove': self.above,
+            'timeInRange': round(float(self.in_range) / self.cbg.count, 4) if self.cbg.count else None,
+            'smbgCount': self.smbg.count,
+            'smbgMean': round(self.smbg.mean, 2) if self.smbg.count else None,
+            # taking back what a temp basal replaced can leave a day of no delivery a rounding error below zero
+            'basalUnits': round(self.basal, 3) or 0.0,
+            'bolusUnits': round(self.bolus, 3),
+            'carbs': self.carbs
+        }
+
+    @classmethod
+    def from_dict(cls, summary):
+
+        rollup = cls()
+
+        # the means and deviation of a day without readings are null
+        rollup.cbg = Moments(summary['cbgCount'], summary['cbgMean'] or 0.0, summary['cbgSD'] or 0.0)
+        rollup.below, rollup.in_range, rollup.above = summary['cbgBelow'], summary['cbgInRange'], summary['cbgAbove']
+        rollup.smbg = Moments(summary['smbgCount'], summary['smbgMean'] or 0.0)
+        rollup.basal, rollup.bolus, rollup.carbs = summary['basalUnits'], summary['bolusUnits'], summary['carbs']
+
+        return rollup
+
+class DailyRollups:
+    """Daily aggregates of records, accumulated a record at a time as they are written.
+
+    Days are those of the device time of each record. CGM and meter readings
+    are summarised by their mean, standard deviation and, for CGM, the
+    readings below, within and above TARGET_RANGE; basal is the insulin
+    delivered in each day, in units, at the scheduled rate except while a
+    temp basal replaces it, and boluses and carbs are totals.
+    """
+
+    def __init__(self):
+
+        self.days = {}
+
+        # the day records arrive in, which they do in time order, and its rollup
+        self.current, self.rollup = None, None
+
+        # scheduled and temp basal segments that may overlap segments still to come
+        self.scheduled, self.temps = [], []
+
+    def day(self, day):
+        """Return the rollup of day, a number of days since the epoch."""
+
+        rollup = self.days.get(day)
+
+        if rollup is None:
+            rollup = self.days[day] = DayRollup()
+
+        return rollup
+
+    def add(self, record):
+
+        day = record.time // 86400
+
+        if day != self.current:
+            self.current, self.rollup = day, self.day(day)
+
+        rollup, record_type = self.rollup, record.type
+
+        if record_type == 'cbg':
+            value = record.value
+            rollup.cbg.add(value)
+            if value < TARGET_RANGE[0]:
+                rollup.below += 1
+            elif value > TARGET_RANGE[1]:
+                rollup.above += 1
+            else:
+                rollup.in_range += 1
+        elif record_type == 'basal-rate-segment':
+            self._add_basal(record)
+        elif record_type == 'bolus':
+            rollup.bolus += record.value
+        elif record_type == 'carbs':
+            rollup.carbs += record.value
+        elif record_type == 'smbg':
+            rollup.smbg.add(record.value)
+
+    def _deliver(self, start, end, rate):
+        """Add the insulin delivered at rate from start to end, split at midnight between the days spanned."""
+
+        while start < end:
+            boundary = min(end, (start // 86400 + 1) * 86400)
+            self.day(start // 86400).basal += rate * (boundary - start) / 3600.0
+            start = boundary
+
+    def _add_basal(self, segment):
+
+        temp = segment.delivery_type == 'temp'
+
+        # segments arrive in order of their start, so those that have ended overlap none to come
+        self.scheduled = [s for s in self.scheduled if s.end > segment.start]
+        self.temps = [s for s in self.temps if s.end > segment.start]
+
+        self._deliver(segment.start, segment.end, segment.rate)
+
+        # a temp basal replaces the scheduled rate while it runs, so the scheduled delivery of
+        # each overlap is taken back, once, by whichever of the two segments comes second
+        for other in (self.scheduled if temp else self.temps):
+            self._deliver(max(segment.start, other.start), min(segment.end, other.end), -(other.rate if temp else segment.rate))
+
+        (self.temps if temp else self.scheduled).append(segment)
+
+    def follow(self, temps):
+        """Carry on from existing data whose temp basals still running are temps, already added to its own rollups."""
+
+        self.temps = list(temps)
+
+    def observe(self, records):
+        """Pass the records, as generated rather than as dicts, through, adding each to the rollups."""
+
+        for record in records:
+            self.add(record)
+            yield record
+
+    def merge(self, other):
+        """Add the rollups of other, as when appending days to existing data."""
+
+        for day, rollup in other.days.items():
+            self.day(day).merge(rollup)
+
+    def _lines(self, days):
+
+        return ',\n'.join(json.dumps(self.days[day].to_dict(day), sort_keys=True, separators=(',', ':')) for day in days)
+
+    def write(self, out_file):
+        """Write the rollups as a JSON array of one object a line per day, in date order."""
+
+        with open(out_file, 'w') as f:
+            f.write('[\n')
+            f.write(self._lines(sorted(self.days)))
+            f.write(END)
+
+    def append(self, out_file):
+        """Add the rollups of data appended to that of out_file, as written by write, to it.
+
+        Only the last day of out_file is read, and merged with the first of
+        these when the appended data carries that day on, and the days after it
+        are written in place of the end of the array. A file that is not as
+        write left it, or that these do not follow on from, is rewritten whole.
+        """
+
+        if not os.path.exists(out_file):
+            self.write(out_file)
+            return
+
+        with open(out_file, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - TAIL_SIZE))
+            lines = f.read().split(b'\n')
+
+            # the last day is the line before the closing bracket, which is the last line
+            last = lines[-3] if len(lines) >= 4 and lines[-2:] == [b']', b''] else b''
+
+            if last.startswith(b'{'):
+                summary = json.loads(last.decode('utf-8'))
+                day = _day(summary['date'])
+                if min(self.days or [day]) >= day:
+                    rollup = DayRollup.from_dict(summary)
+                    if day in self.days:
+                        rollup.merge(self.days[day])
+                    self.days[day] = rollup
+                    f.seek(size - len(END) - len(last))
+                    f.write(self._lines(sorted(self.days)).encode('utf-8') + END.encode('ascii'))
+                    f.truncate()
+                    return
+
+        # the day the existing data ends on is split between the two
+        self.merge(load_rollups(out_file))
+        self.write(out_file)
+
+def _day(date):
+    """Return the day since the epoch of a date as YYYY-MM-DD."""
+
+    return to_epoch(dt.strptime(date, '%Y-%m-%d')) // 86400
+
+def load_rollups(filename):
+    """Load the rollups written by DailyRollups.write."""
+
+    rollups = DailyRollups()
+
+    with open(filename) as f:
+        for summary in json.load(f):
+            rollups.days[_day(summary['date'])] = DayRollup.from_dict(summary)
+
+    return rollups
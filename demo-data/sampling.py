@@ -0,0 +1,101 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from datetime import datetime as dt
+import random
+
+class AliasTable:
+    """Draw from a discrete weighted distribution in constant time with Vose's alias method."""
+
+    def __init__(self, weights):
+
+        n = len(weights)
+
+        total = float(sum(weights))
+
+        scaled = [w * n / total for w in weights]
+
+        self.n = n
+
+        self.probability = [1.0] * n
+
+        self.alias = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, rng=random):
+        """Return a random index, drawn with probability proportional to its weight from rng."""
+
+        u = rng.random() * self.n
+        i = int(u)
+
+        return i if (u - i) < self.probability[i] else self.alias[i]
+
+    def sample_many(self, k, rng=random):
+        """Return a list of k random indices."""
+
+        return [self.sample(rng) for i in range(k)]
+
+def hour_weights():
+    """Return the relative likelihood of each hour of the day for fingersticks, messages and temp basals."""
+
+    weights = [1] * 24
+
+    for hour in [7, 8, 11, 12, 6, 11]:
+        weights[hour] += 3
+
+    for hour in [9, 13, 4, 5, 9, 10]:
+        weights[hour] += 2
+
+    return weights
+
+HOURS = AliasTable(hour_weights())
+
+def randint_below(n, rng=random):
+    """Return a random integer in [0, n)."""
+
+    return int(rng.random() * n)
+
+def random_time(d, hour=None, rng=random):
+    """Return a random timestamp on date d, within the given hour or a likely hour if hour is None."""
+
+    if hour is None:
+        hour = HOURS.sample(rng)
+
+    u = rng.random()
+
+    # minute, second and microsecond all come from a single draw
+    micros = int(u * 3600000000)
+
+    return dt(d.year, d.month, d.day, hour, micros // 60000000, (micros // 1000000) % 60, micros % 1000000)
+
+def random_times(d, k, rng=random):
+    """Return k random timestamps on date d, with their hours drawn from the likely hours of the day."""
+
+    return [random_time(d, hour, rng) for hour in HOURS.sample_many(k, rng)]
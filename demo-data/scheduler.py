@@ -0,0 +1,171 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from multiprocessing.pool import ThreadPool
+import random
+import threading
+import zlib
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+def stage_seed(seed, name):
+    """Return the seed of the random number stream of the stage called name."""
+
+    return (seed * 1000003 + zlib.crc32(name.encode('utf-8'))) & 0xffffffffffff
+
+class StageGraph:
+    """A DAG of named stages, run on a pool of threads as soon as the stages they depend on are done.
+
+    Each stage has its own random.Random, seeded from seed and its name, and
+    the same streams carry on from one run of the graph to the next, so the
+    results depend only on the seed and not on the order the stages happen to
+    run in. A stage's function is called with its random.Random and then the
+    results of the stages it runs after, in the order they were given.
+    """
+
+    def __init__(self, seed):
+
+        self.seed = seed
+
+        self.order = []
+
+        self.stages = {}
+
+        self.rngs = {}
+
+    def add(self, name, function, after=()):
+        """Add a stage, which runs after the stages named in after have been added and run."""
+
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError('stage %s runs after unknown stage %s' % (name, dependency))
+
+        self.order.append(name)
+
+        self.stages[name] = (function, tuple(after))
+
+    def rng(self, name):
+        """Return the random number stream of the stage called name."""
+
+        if name not in self.rngs:
+            self.rngs[name] = random.Random(stage_seed(self.seed, name))
+
+        return self.rngs[name]
+
+    def clear(self):
+        """Remove the stages, keeping their random number streams, so the next graph carries on from them."""
+
+        self.order, self.stages = [], {}
+
+    def run(self, workers=1):
+        """Run every stage, returning a dict of the result of each stage by name.
+
+        With one worker the stages run in the order they were added, on the
+        calling thread. An exception in a stage is raised here once the
+        stages already running have finished.
+        """
+
+        if workers <= 1:
+            results = {}
+            for name in self.order:
+                function, after = self.stages[name]
+                results[name] = function(self.rng(name), *[results[d] for d in after])
+            return results
+
+        # the streams are made up front, so no two threads create one at once
+        for name in self.order:
+            self.rng(name)
+
+        pool = ThreadPool(workers)
+
+        done = Queue()
+
+        results, running, error = {}, set(), None
+
+        def ready(name):
+            return name not in results and name not in running and all(d in results for d in self.stages[name][1])
+
+        def submit(name):
+            function, after = self.stages[name]
+            running.add(name)
+            pool.apply_async(self._call, (name, function, [results[d] for d in after], done))
+
+        try:
+            for name in self.order:
+                if ready(name):
+                    submit(name)
+
+            while running:
+                name, ok, value = done.get()
+                running.discard(name)
+                if not ok:
+                    error = error if error is not None else value
+                    continue
+                results[name] = value
+                if error is None:
+                    for waiting in self.order:
+                        if ready(waiting):
+                            submit(waiting)
+        finally:
+            pool.close()
+            pool.join()
+
+        if error is not None:
+            raise error
+
+        return results
+
+    def _call(self, name, function, arguments, done):
+
+        try:
+            done.put((name, True, function(self.rngs[name], *arguments)))
+        except Exception as e:
+            done.put((name, False, e))
+
+def prefetch(items, ahead=1):
+    """Yield the items of an iterable, producing up to ahead of them in advance on a background thread.
+
+    This overlaps producing the next item with whatever the caller does with
+    the last one; an exception producing an item is raised when it is reached.
+    """
+
+    queue = Queue(ahead)
+
+    def produce():
+        try:
+            for item in items:
+                queue.put((True, item))
+            queue.put((True, queue))
+        except Exception as e:
+            queue.put((False, e))
+
+    producer = threading.Thread(target=produce)
+    # a caller that stops early leaves the producer blocked, which must not keep the process alive
+    producer.daemon = True
+    producer.start()
+
+    while True:
+        ok, item = queue.get()
+        if not ok:
+            raise item
+        if item is queue:
+            break
+        yield item
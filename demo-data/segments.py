@@ -0,0 +1,480 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import argparse
+from bisect import bisect_left
+from datetime import datetime as dt
+import io
+import json
+from multiprocessing import Pool, cpu_count
+import mmap
+import os
+import random
+import shutil
+import struct
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from timestamps import to_epoch
+
+# compiled library layout (all little-endian):
+#   header  - MAGIC, then number of keys, segments and values as uint32
+#   keys    - per key: start value (int16), index of first segment (uint32), number of segments (uint32)
+#   offsets - uint32 offset into values of each segment, plus a final end offset
+#   values  - int16 blood glucose values of every segment, back to back
+MAGIC = b'TPSEGLB1'
+
+HEADER = struct.Struct('<8sIII')
+
+KEY = struct.Struct('<hII')
+
+OFFSET = struct.Struct('<II')
+
+# each run in the shard file of one export: start value (int16) and number of values (uint32), then the values
+RUN = struct.Struct('<hI')
+
+# columns of the CGM readings in a Dexcom Studio tab-delimited export
+STUDIO_TIME = 'GlucoseDisplayTime'
+
+STUDIO_VALUE = 'GlucoseValue'
+
+# readings of a continuous run are 5 minutes apart, give or take this many seconds
+READING_INTERVAL = 300
+
+INTERVAL_TOLERANCE = 60
+
+class SegmentLibrary:
+    """Look up continuous segments of Dexcom data by their starting blood glucose value."""
+
+    def __init__(self, starts, firsts, counts):
+
+        # sorted start values, with the index of the first segment and number of segments for each
+        self.starts = starts
+
+        self.firsts = firsts
+
+        self.counts = counts
+
+        self.positions = dict((start, i) for i, start in enumerate(starts))
+
+        # the values and offsets of every segment as NumPy arrays, once they are first asked for
+        self.array_cache = None
+
+    def segment(self, index):
+        """Return the blood glucose values of the segment at index."""
+
+        raise NotImplementedError
+
+    def arrays(self):
+        """Return all segment values as one NumPy int array and the offsets of each segment within it.
+
+        The arrays are built on the first call and shared by every later one,
+        as by each request of a long-lived service, so they are read-only.
+        """
+
+        if self.array_cache is None:
+            values, offsets = self._arrays()
+            values.flags.writeable = False
+            offsets.flags.writeable = False
+            self.array_cache = (values, offsets)
+
+        return self.array_cache
+
+    def _arrays(self):
+
+        raise NotImplementedError
+
+    def nearest_start(self, value):
+        """Return the available start value closest to value."""
+
+        i = bisect_left(self.starts, value)
+
+        if i == 0:
+            return self.starts[0]
+        if i == len(self.starts):
+            return self.starts[-1]
+
+        before, after = self.starts[i - 1], self.starts[i]
+
+        return after if (after - value) < (value - before) else before
+
+    def random_segment(self, value, rng=random):
+        """Return a random segment starting at value, or at the nearest available start value."""
+
+        position = self.positions.get(value)
+
+        if position is None:
+            position = self.positions[self.nearest_start(value)]
+
+        return self.segment(self.firsts[position] + rng.randrange(self.counts[position]))
+
+class JSONSegmentLibrary(SegmentLibrary):
+    """Segment library loaded from an indexed_segments.json file."""
+
+    def __init__(self, filename):
+
+        raw = json.load(open(filename, 'r'))
+
+        self.segments = []
+
+        starts, firsts, counts = [], [], []
+
+        for start in sorted(int(key) for key, value in raw.items() if value):
+            starts.append(start)
+            firsts.append(len(self.segments))
+            counts.append(len(raw[str(start)]))
+            self.segments += [[reading['blood_glucose'] for reading in segment] for segment in raw[str(start)]]
+
+        SegmentLibrary.__init__(self, starts, firsts, counts)
+
+    def segment(self, index):
+
+        return self.segments[index]
+
+    def _arrays(self):
+
+        lengths = [len(segment) for segment in self.segments]
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+
+        return np.array([value for segment in self.segments for value in segment], dtype=np.int16), offsets
+
+class CompiledSegmentLibrary(SegmentLibrary):
+    """Segment library memory-mapped from a file written by compile_library."""
+
+    def __init__(self, filename):
+
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, num_keys, num_segments, num_values = HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC:
+            raise ValueError('%s is not a compiled segment library' % filename)
+
+        keys = [KEY.unpack_from(self.map, HEADER.size + i * KEY.size) for i in range(num_keys)]
+
+        self.num_segments = num_segments
+
+        self.num_values = num_values
+
+        self.offsets_start = HEADER.size + num_keys * KEY.size
+
+        self.values_start = self.offsets_start + (num_segments + 1) * 4
+
+        SegmentLibrary.__init__(self, [k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys])
+
+    def segment(self, index):
+
+        start, end = OFFSET.unpack_from(self.map, self.offsets_start + index * 4)
+
+        return struct.unpack_from('<%dh' % (end - start), self.map, self.values_start + start * 2)
+
+    def _arrays(self):
+
+        # values are a zero-copy view of the mapped file
+        values = np.frombuffer(self.map, dtype='<i2', count=self.num_values, offset=self.values_start)
+
+        offsets = np.frombuffer(self.map, dtype='<u4', count=self.num_segments + 1, offset=self.offsets_start).astype(np.int64)
+
+        return values, offsets
+
+def is_compiled(filename):
+    """Return True if filename is a compiled segment library."""
+
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def find_library(filename=None):
+    """Return filename, or the default segment library in the working directory if it is None."""
+
+    if filename is not None:
+        return filename
+
+    return 'indexed_segments.bin' if os.path.exists('indexed_segments.bin') else 'indexed_segments.json'
+
+def load_library(filename):
+    """Load a segment library, memory-mapping it if it has been compiled."""
+
+    if is_compiled(filename):
+        return CompiledSegmentLibrary(filename)
+
+    return JSONSegmentLibrary(filename)
+
+def write_library(keys, segments, out_file):
+    """Write a compiled segment library.
+
+    keys is a sorted list of (start value, number of segments) and segments
+    holds the blood glucose values of every segment in the same order.
+    """
+
+    num_values = sum(len(segment) for segment in segments)
+
+    with open(out_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys), len(segments), num_values))
+
+        first = 0
+        for start, count in keys:
+            f.write(KEY.pack(start, first, count))
+            first += count
+
+        offset = 0
+        for segment in segments:
+            f.write(struct.pack('<I', offset))
+            offset += len(segment)
+        f.write(struct.pack('<I', offset))
+
+        for segment in segments:
+            f.write(struct.pack('<%dh' % len(segment), *segment))
+
+def compile_library(json_file, out_file):
+    """Compile an indexed_segments.json file into the binary library format."""
+
+    library = JSONSegmentLibrary(json_file)
+
+    write_library(list(zip(library.starts, library.counts)), library.segments, out_file)
+
+    return library
+
+def open_export(filename):
+    """Open a Dexcom Studio export for reading as text, whether it is UTF-16, as Studio writes it, or UTF-8."""
+
+    with open(filename, 'rb') as f:
+        bom = f.read(2)
+
+    encoding = 'utf-16' if bom in (b'\xff\xfe', b'\xfe\xff') else 'utf-8-sig'
+
+    return io.open(filename, 'r', encoding=encoding, errors='replace')
+
+def read_export(filename):
+    """Yield the (seconds since the epoch, value) of each numeric CGM reading of a Dexcom Studio export, a line at a time.
+
+    Readings the receiver could only show as Low or High are yielded with a
+    value of None, so they break up a run of readings rather than being
+    skipped over.
+    """
+
+    # seconds since the epoch of each date seen, as parsing every timestamp with strptime is slow
+    days = {}
+
+    with open_export(filename) as f:
+        columns = f.readline().rstrip('\r\n').split('\t')
+
+        if STUDIO_TIME not in columns or STUDIO_VALUE not in columns:
+            raise ValueError('%s is not a Dexcom Studio export' % filename)
+
+        time_column, value_column = columns.index(STUDIO_TIME), columns.index(STUDIO_VALUE)
+
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+
+            if len(fields) <= max(time_column, value_column) or not fields[time_column]:
+                continue
+
+            timestamp = fields[time_column]
+
+            day = days.get(timestamp[:10])
+            if day is None:
+                day = days[timestamp[:10]] = to_epoch(dt.strptime(timestamp[:10], '%Y-%m-%d'))
+
+            seconds = day + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+
+            try:
+                value = int(fields[value_column])
+            except ValueError:
+                value = None
+
+            yield seconds, value
+
+def split_runs(readings, min_length=6, max_length=288):
+    """Split time-ordered readings into continuous runs of values 5 minutes apart.
+
+    A run ends at a gap, a reading out of order or a Low or High reading.
+    Runs longer than max_length are cut into pieces of at most max_length,
+    and pieces shorter than min_length are dropped.
+    """
+
+    run, last = [], None
+
+    for seconds, value in readings:
+        if value is None or last is None or abs(seconds - last - READING_INTERVAL) > INTERVAL_TOLERANCE or len(run) == max_length:
+            if len(run) >= min_length:
+                yield run
+            run = []
+
+        if value is not None:
+            run.append(value)
+
+        last = seconds if value is not None else None
+
+    if len(run) >= min_length:
+        yield run
+
+def _build_shard(job):
+    """Split one export into runs, written to a shard file, returning its name and number of runs."""
+
+    filename, shard_file, min_length, max_length = job
+
+    count = 0
+
+    with open(shard_file, 'wb') as f:
+        for run in split_runs(read_export(filename), min_length, max_length):
+            f.write(RUN.pack(run[0], len(run)))
+            f.write(struct.pack('<%dh' % len(run), *run))
+            count += 1
+
+    return shard_file, count
+
+def _shard_runs(shard_file):
+    """Yield the start value, number of values and file position of the values of each run of a shard, without reading the values."""
+
+    with open(shard_file, 'rb') as f:
+        while True:
+            header = f.read(RUN.size)
+            if len(header) < RUN.size:
+                break
+            start, length = RUN.unpack(header)
+            yield start, length, f.tell()
+            f.seek(length * 2, 1)
+
+def build_library(filenames, out_file, processes=None, min_length=6, max_length=288):
+    """Build a compiled segment library from Dexcom Studio exports, returning the number of segments and start values.
+
+    The exports are split into runs on a pool of processes, each streaming
+    one export at a time into a shard file of its runs. The shards are then
+    merged into the library in two passes, first counting the runs of each
+    start value from the run headers alone, then copying each run straight
+    to its place in the memory-mapped library, so only one run is held in
+    memory at a time, however large the exports.
+    """
+
+    workdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_file)))
+
+    try:
+        jobs = [(filename, os.path.join(workdir, '%05d.runs' % i), min_length, max_length) for i, filename in enumerate(filenames)]
+
+        pool = Pool(processes or cpu_count())
+
+        try:
+            # in order of the exports, so the library is the same whatever the number of processes
+            shards = [shard_file for shard_file, count in pool.imap(_build_shard, jobs)]
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        counts, totals = {}, {}
+
+        for shard_file in shards:
+            for start, length, position in _shard_runs(shard_file):
+                counts[start] = counts.get(start, 0) + 1
+                totals[start] = totals.get(start, 0) + length
+
+        starts = sorted(counts)
+
+        num_segments, num_values = sum(counts.values()), sum(totals.values())
+
+        # where the next segment and the next value of each start value go
+        next_segment, next_value = {}, {}
+
+        segment, value = 0, 0
+
+        for start in starts:
+            next_segment[start], next_value[start] = segment, value
+            segment += counts[start]
+            value += totals[start]
+
+        offsets_start = HEADER.size + len(starts) * KEY.size
+
+        values_start = offsets_start + (num_segments + 1) * 4
+
+        size = values_start + num_values * 2
+
+        with open(out_file, 'w+b') as f:
+            f.truncate(size)
+
+            f.write(HEADER.pack(MAGIC, len(starts), num_segments, num_values))
+
+            for start in starts:
+                f.write(KEY.pack(start, next_segment[start], counts[start]))
+
+            if not num_segments:
+                f.write(struct.pack('<I', 0))
+                return 0, 0
+
+            output = mmap.mmap(f.fileno(), size)
+
+            try:
+                struct.pack_into('<I', output, offsets_start + num_segments * 4, num_values)
+
+                for shard_file in shards:
+                    with open(shard_file, 'rb') as shard:
+                        for start, length, position in _shard_runs(shard_file):
+                            shard.seek(position)
+                            segment, value = next_segment[start], next_value[start]
+                            struct.pack_into('<I', output, offsets_start + segment * 4, value)
+                            output[values_start + value * 2:values_start + (value + length) * 2] = shard.read(length * 2)
+                            next_segment[start], next_value[start] = segment + 1, value + length
+            finally:
+                output.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    return num_segments, len(starts)
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Build memory-mappable binary libraries of continuous segments of Dexcom data.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    compile_command = subparsers.add_parser('compile', help='compile an indexed_segments.json file')
+    compile_command.add_argument('input_file', help='name of file containing indexed continuous segments of Dexcom data')
+    compile_command.add_argument('-o', '--output_file', action='store', dest='output_file', default='indexed_segments.bin', help='name of compiled output file;\ndefault is indexed_segments.bin')
+
+    build = subparsers.add_parser('build', help='build a library from raw Dexcom Studio tab-delimited exports')
+    build.add_argument('input_files', nargs='+', help='Dexcom Studio exports, split across the processes one file at a time')
+    build.add_argument('-o', '--output_file', action='store', dest='output_file', default='indexed_segments.bin', help='name of compiled output file;\ndefault is indexed_segments.bin')
+    build.add_argument('-j', '--processes', action='store', dest='processes', default=cpu_count(), type=int, help='number of processes to read the exports on;\ndefault is the number of CPUs')
+    build.add_argument('--min_length', action='store', dest='min_length', default=6, type=int, help='fewest readings in a segment;\ndefault is 6, half an hour')
+    build.add_argument('--max_length', action='store', dest='max_length', default=288, type=int, help='most readings in a segment, longer runs being cut into pieces;\ndefault is 288, a day')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.min_length < 1 or args.max_length < args.min_length:
+            parser.error('segments need at least one reading, and max_length cannot be less than min_length')
+        num_segments, num_starts = build_library(args.input_files, args.output_file, args.processes, args.min_length, args.max_length)
+        print('Built', num_segments, 'segments with', num_starts, 'start values from', len(args.input_files), 'exports to', args.output_file)
+        return
+
+    if args.command != 'compile':
+        parser.error('a command, compile or build, is required')
+
+    library = compile_library(args.input_file, args.output_file)
+
+    print('Compiled', len(library.segments), 'segments with', len(library.starts), 'start values to', args.output_file)
+
+if __name__ == '__main__':
+    main()
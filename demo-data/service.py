@@ -0,0 +1,399 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import argparse
+from datetime import datetime as dt
+from datetime import time as t
+import json
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import TCPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import TCPServer
+
+from demo_data import Dexcom, finalise_records, generate_windows
+from exporters import VENDOR_FORMATS, stream_export
+from ids import ID_KINDS, IDAllocator
+from segments import find_library, load_library
+from text import BACON_IPSUM_URL, PROVIDERS, get_provider
+from validation import Validator
+from writers import merge_windows, write_stream
+
+# formats that can be streamed, with their content types; the compressed and columnar formats need a file
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'array': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'dexcom.txt': 'text/tab-separated-values',
+    'medtronic.csv': 'text/csv',
+    'animas.csv': 'text/csv'
+}
+
+# bytes of output gathered into each chunk of a response
+CHUNK_SIZE = 65536
+
+def parse_request(content):
+    """Return the options of a generation request from its JSON content, raising ValueError if they are invalid.
+
+    Every field is optional: num_days, seed, format, window_days, messages,
+    ids, start, an ISO 8601 time to start the trace around, and schedule, a
+    basal schedule of rates by HH:MM start time.
+    """
+
+    if not isinstance(content, dict):
+        raise ValueError('the request should be a JSON object')
+
+    options = {
+        'num_days': content.get('num_days', 30),
+        'seed': content.get('seed'),
+        'format': content.get('format', 'ndjson'),
+        'window_days': content.get('window_days', 1),
+        'messages': content.get('messages', True),
+        'ids': content.get('ids', 'uuid4'),
+        'start': None,
+        'schedule': {}
+    }
+
+    for field in ['num_days', 'window_days']:
+        if not isinstance(options[field], int) or isinstance(options[field], bool) or options[field] < 1:
+            raise ValueError('%s should be a positive integer' % field)
+
+    if options['seed'] is not None and (not isinstance(options['seed'], int) or isinstance(options['seed'], bool)):
+        raise ValueError('seed should be an integer')
+
+    if options['format'] not in CONTENT_TYPES:
+        raise ValueError('format should be one of %s' % ', '.join(sorted(CONTENT_TYPES)))
+
+    if not isinstance(options['messages'], bool):
+        raise ValueError('messages should be true or false')
+
+    if options['ids'] not in ID_KINDS:
+        raise ValueError('ids should be one of %s' % ', '.join(ID_KINDS))
+
+    if content.get('start') is not None:
+        try:
+            options['start'] = dt.strptime(content['start'].rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+        except (AttributeError, ValueError):
+            raise ValueError('start should be an ISO 8601 time, such as 2014-01-01T12:00:00')
+
+    for start, rate in (content.get('schedule') or {}).items():
+        try:
+            hour, minute = start.split(':')
+            options['schedule'][t(int(hour), int(minute))] = float(rate)
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError('schedule should map HH:MM start times to basal rates')
+
+    return options
+
+class ChunkedWriter:
+    """Write text to a binary file as HTTP/1.1 chunks of about size bytes each."""
+
+    def __init__(self, wfile, size=CHUNK_SIZE):
+
+        self.wfile = wfile
+
+        self.size = size
+
+        self.pending = []
+
+        self.length = 0
+
+    def write(self, text):
+
+        self.pending.append(text)
+
+        self.length += len(text)
+
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+
+        if not self.length:
+            return
+
+        data = ''.join(self.pending).encode('utf-8')
+
+        self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+
+        self.pending, self.length = [], 0
+
+    def close(self):
+        """Write what is left, and the empty chunk that ends the response."""
+
+        self.flush()
+
+        self.wfile.write(b'0\r\n\r\n')
+
+class GeneratorHandler(BaseHTTPRequestHandler):
+    """Serve generation requests: POST /generate with a JSON object of options, and GET / for the status of the service."""
+
+    # chunked responses and keep-alive need HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        if self.path != '/':
+            self._respond(404, {'error': 'not found'})
+            return
+
+        self._respond(200, self.server.status())
+
+    def do_POST(self):
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.path != '/generate':
+            self._respond(404, {'error': 'not found'})
+            return
+
+        try:
+            options = parse_request(json.loads(body.decode('utf-8') or '{}'))
+        except ValueError as e:
+            self._respond(400, {'error': str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[options['format']])
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        out = ChunkedWriter(self.wfile)
+
+        try:
+            count = self.server.generate(options, out)
+        except Exception as e:
+            # the status has already been sent, so the response is cut short instead
+            self.close_connection = True
+            self.server.failed(e)
+            return
+
+        out.close()
+
+        self.server.served(count)
+
+    def _respond(self, status, content):
+
+        body = json.dumps(content, sort_keys=True).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+
+        pass
+
+class GeneratorService:
+    """Generate demo data on request from a segment library loaded once, handling requests on a pool of threads.
+
+    The library, with its NumPy arrays for the numpy backend, the tables built
+    at import time and the compiled schemas, when validating, are shared by
+    every request; each request gets its own random number streams, ids and
+    text provider. At most twice as many connections as workers are taken on
+    at once, and the rest wait to be accepted.
+    """
+
+    def setup_service(self, library, backend='python', workers=4, text_provider='offline', text_url=BACON_IPSUM_URL, validator=None):
+
+        self.library = library
+
+        self.backend = backend
+
+        # built now rather than by whichever requests come first, and kept by the library for every request after
+        if backend == 'numpy':
+            library.arrays()
+
+        self.text_provider = text_provider
+
+        self.text_url = text_url
+
+        self.validator = validator
+
+        self.pool = ThreadPool(workers)
+
+        self.workers = workers
+
+        # connections being handled or waiting for a worker; beyond this many, new ones wait in the listen backlog
+        self.slots = threading.BoundedSemaphore(2 * workers)
+
+        self.lock = threading.Lock()
+
+        self.requests, self.errors, self.records = 0, 0, 0
+
+        self.started = dt.now()
+
+    def process_request(self, request, client_address):
+
+        self.slots.acquire()
+
+        self.pool.apply_async(self._process_request, (request, client_address))
+
+    def _process_request(self, request, client_address):
+
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def generate(self, options, out):
+        """Generate the data options ask for, a window at a time, writing it to out as it is generated."""
+
+        dex = Dexcom(None, options['num_days'], self.backend, segments=self.library, start=options['start'])
+
+        ids = IDAllocator(options['ids'], options['seed'])
+
+        text_provider = get_provider(self.text_provider, self.text_url)
+
+        try:
+            windows = generate_windows(dex, options['window_days'], options['schedule'], options['messages'], text_provider, ids, seed=options['seed'])
+
+            records = merge_windows(windows)
+
+            if options['format'] in VENDOR_FORMATS:
+                return stream_export(records, out, options['format'], CHUNK_SIZE)
+
+            return write_stream(finalise_records(records, ids), out, options['format'], check=self.validator.check if self.validator else None)
+        finally:
+            text_provider.close()
+
+    def served(self, count):
+
+        with self.lock:
+            self.requests += 1
+            self.records += count
+
+    def failed(self, error):
+
+        with self.lock:
+            self.errors += 1
+
+        print(dt.now(), 'Request failed:', error)
+
+    def status(self):
+
+        with self.lock:
+            return {
+                'status': 'ok',
+                'started': self.started.isoformat(),
+                'workers': self.workers,
+                'segments': sum(self.library.counts),
+                'requests': self.requests,
+                'errors': self.errors,
+                'records': self.records
+            }
+
+    def server_close(self):
+
+        HTTPServer.server_close(self)
+
+        self.pool.close()
+        self.pool.join()
+
+class GeneratorServer(GeneratorService, HTTPServer):
+    """The generator service over local HTTP."""
+
+    def __init__(self, address, **kwargs):
+
+        HTTPServer.__init__(self, address, GeneratorHandler)
+
+        self.setup_service(**kwargs)
+
+class UnixGeneratorServer(GeneratorService, HTTPServer):
+    """The generator service over HTTP on a Unix domain socket."""
+
+    address_family = socket.AF_UNIX
+
+    def __init__(self, path, **kwargs):
+
+        # a socket left behind by a service that was not shut down cleanly
+        if os.path.exists(path):
+            os.remove(path)
+
+        HTTPServer.__init__(self, path, GeneratorHandler)
+
+        self.setup_service(**kwargs)
+
+    def server_bind(self):
+
+        # HTTPServer.server_bind expects a host and port
+        TCPServer.server_bind(self)
+
+        self.server_name, self.server_port = 'localhost', 0
+
+    def server_close(self):
+
+        GeneratorService.server_close(self)
+
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Serve demo diabetes data from a long-lived process, over local HTTP or a Unix socket.')
+    parser.add_argument('-d', '--dexcom', action='store', dest='dexcom_segments', help='name of file containing indexed continuous segments of Dexcom data, as JSON or compiled with segments.py;\ndefault is indexed_segments.bin if present, otherwise indexed_segments.json')
+    parser.add_argument('-b', '--backend', action='store', dest='backend', default='python', choices=['python', 'numpy'], help='engine used to build the Dexcom trace;\ndefault is python')
+    parser.add_argument('-p', '--port', action='store', dest='port', default=8282, type=int, help='port to listen on, on 127.0.0.1;\ndefault is 8282')
+    parser.add_argument('-u', '--unix_socket', action='store', dest='unix_socket', help='path of a Unix socket to listen on instead of a port')
+    parser.add_argument('-W', '--workers', action='store', dest='workers', default=cpu_count(), type=int, help='number of requests to handle at once;\ndefault is the number of CPUs')
+    parser.add_argument('-V', '--validate', action='store_true', dest='validate', help='use this flag to validate each record of the Tidepool formats as it is served')
+    parser.add_argument('-t', '--text_provider', action='store', dest='text_provider', default='offline', choices=sorted(PROVIDERS.keys()), help='source of message text;\ndefault is offline')
+    parser.add_argument('--text_url', action='store', dest='text_url', default=BACON_IPSUM_URL, help='URL to fetch bacon ipsum from, followed by the number of sentences;\ndefault is ' + BACON_IPSUM_URL)
+    args = parser.parse_args()
+
+    options = {
+        'library': load_library(find_library(args.dexcom_segments)),
+        'backend': args.backend,
+        'workers': args.workers,
+        'text_provider': args.text_provider,
+        'text_url': args.text_url,
+        'validator': Validator() if args.validate else None
+    }
+
+    if args.unix_socket:
+        server = UnixGeneratorServer(args.unix_socket, **options)
+        where = args.unix_socket
+    else:
+        server = GeneratorServer(('127.0.0.1', args.port), **options)
+        where = 'port %d' % args.port
+
+    print(dt.now(), 'Generator service listening on', where)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    print(dt.now(), 'Served', server.requests, 'requests')
+
+if __name__ == '__main__':
+    main()
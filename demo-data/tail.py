@@ -0,0 +1,116 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import json
+import os
+
+from records import BasalSegment
+from timestamps import parse_time
+
+# pumps run a temp basal for a day at most, so none running past the end of the data started before that
+MAX_TEMP_DURATION = 86400
+
+class TailState:
+    """The state generation needs to carry on from the end of an existing ndjson file.
+
+    Times are in seconds since the epoch, and are None if the file has no
+    records of that kind.
+    """
+
+    def __init__(self):
+
+        # time of the last record, which anything appended must not sort before
+        self.last_time = None
+
+        self.cbg_time = None
+
+        self.cbg_value = None
+
+        # end of the last scheduled basal segment, where the schedule picks up
+        self.basal_end = None
+
+        self.bolus_time = None
+
+        # time of the earliest record read back to
+        self.first_time = None
+
+        # the last temp basals, back to one that ends before the last scheduled segment does; temp
+        # basals do not overlap each other, so any running on past that end are among them
+        self.temps = []
+
+    def complete(self):
+
+        return None not in (self.cbg_time, self.basal_end, self.bolus_time) and self._temps_complete()
+
+    def _temps_complete(self):
+
+        if self.basal_end is None:
+            return False
+
+        return any(temp.end <= self.basal_end for temp in self.temps) or self.first_time <= self.basal_end - MAX_TEMP_DURATION
+
+    def running_temps(self):
+        """Return the temp basals still running when the last scheduled segment ends, where appended ones start."""
+
+        return [temp for temp in self.temps if self.basal_end is not None and temp.end > self.basal_end]
+
+    def update(self, record):
+        """Take what is needed from a record, reading back from the end of the file."""
+
+        time = parse_time(record.get('deviceTime') or record.get('start') or record['utcTime'])
+
+        if self.last_time is None or time > self.last_time:
+            self.last_time = time
+
+        if self.first_time is None or time < self.first_time:
+            self.first_time = time
+
+        if record['type'] == 'cbg' and self.cbg_time is None:
+            self.cbg_time, self.cbg_value = time, record['value']
+        elif record['type'] == 'bolus' and self.bolus_time is None:
+            self.bolus_time = time
+        elif record['type'] == 'basal-rate-segment' and record['deliveryType'] == 'scheduled' and self.basal_end is None:
+            self.basal_end = parse_time(record['end'])
+        elif record['type'] == 'basal-rate-segment' and record['deliveryType'] == 'temp' and not self._temps_complete():
+            self.temps.append(BasalSegment(time, parse_time(record['end']), record['delivered'], 'temp'))
+
+def read_tail(filename, chunk_size=65536):
+    """Read the TailState of an ndjson file, reading back from its end only as far as needed."""
+
+    state = TailState()
+
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+
+        # the start of the line that straddles the chunk boundary, carried into the next chunk back
+        remainder = b''
+
+        while position > 0 and not state.complete():
+            size = min(chunk_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b'\n')
+
+            remainder = lines.pop(0) if position > 0 else b''
+
+            for line in reversed(lines):
+                if line.strip():
+                    state.update(json.loads(line.decode('utf-8')))
+
+    return state
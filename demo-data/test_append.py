@@ -0,0 +1,146 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from datetime import datetime as dt
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from benchmark import synthetic_library
+from dataindex import ORDER_FIELDS, IndexedData, index_name, load_index
+from demo_data import Dexcom, append_patient, generate_patient
+from ids import IDAllocator
+from segments import load_library
+from timestamps import parse_time
+
+SEED = 7
+
+class AppendTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.directory = tempfile.mkdtemp()
+
+        library = os.path.join(cls.directory, 'segments.bin')
+
+        synthetic_library(library)
+
+        cls.library = load_library(library)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.directory)
+
+    def generate(self, out_file, days, append=False, seed=SEED, index=False):
+        """Generate or append days of data as demo_data.py does with --seed."""
+
+        random.seed(seed)
+
+        dex = Dexcom(None, days, segments=self.library, start=dt(2014, 1, 1, 12))
+
+        ids = IDAllocator('uuid4', seed)
+
+        if append:
+            return append_patient(dex, out_file, ids=ids, seed=seed)
+
+        return generate_patient(dex, out_file, 'ndjson', ids=ids, index=index)
+
+    def read_ids(self, out_file):
+
+        with open(out_file) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+        return [record['id'] for record in records], [record['_id'] for record in records]
+
+    def test_appended_ids_are_new(self):
+
+        out_file = os.path.join(self.directory, 'ids.ndjson')
+
+        existing = self.generate(out_file, 3)
+
+        self.generate(out_file, 3, append=True)
+
+        ids, _ids = self.read_ids(out_file)
+
+        self.assertEqual(len(set(ids[existing:]) & set(ids[:existing])), 0)
+        self.assertEqual(len(set(_ids[existing:]) & set(_ids[:existing])), 0)
+
+        # and so on for every further append with the same seed
+        self.generate(out_file, 3, append=True)
+
+        ids, _ids = self.read_ids(out_file)
+
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(len(set(_ids)), len(_ids))
+
+    def test_appends_are_reproducible(self):
+
+        first, second = os.path.join(self.directory, 'first.ndjson'), os.path.join(self.directory, 'second.ndjson')
+
+        for out_file in [first, second]:
+            self.generate(out_file, 2)
+            self.generate(out_file, 2, append=True)
+
+        with open(first) as f, open(second) as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_index_after_appends(self):
+
+        out_file = os.path.join(self.directory, 'indexed.ndjson')
+
+        self.generate(out_file, 2, index=True)
+
+        for i in range(3):
+            self.generate(out_file, 1, append=True)
+
+        # the index worked out afresh from the lines of the file
+        days, day_offsets, offsets, position = [], [], {}, 0
+
+        with open(out_file, 'rb') as f:
+            for line in f:
+                record = json.loads(line.decode('utf-8'))
+                field = [field for field in ORDER_FIELDS if field in record][0]
+                day = parse_time(record[field]) // 86400
+                if not days or day > days[-1]:
+                    days.append(day)
+                    day_offsets.append(position)
+                offsets.setdefault(record['type'], []).append(position)
+                position += len(line)
+
+        # a block for the records first written and one for each append
+        self.assertEqual(load_index(index_name(out_file)).blocks, 4)
+
+        with IndexedData(out_file) as data:
+            self.assertEqual(data.size, position)
+            self.assertEqual(data.days, days)
+            self.assertEqual(data.day_offsets, day_offsets)
+            self.assertEqual(data.types, sorted(offsets))
+            for record_type in offsets:
+                self.assertEqual(list(data.offsets[record_type]), offsets[record_type])
+                self.assertEqual(data.count(record_type), len(offsets[record_type]))
+            self.assertEqual(len(data.records()), sum(len(o) for o in offsets.values()))
+
+if __name__ == '__main__':
+    unittest.main()
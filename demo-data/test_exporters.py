@@ -0,0 +1,149 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import csv
+from datetime import datetime as dt
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmark import synthetic_library
+from demo_data import Dexcom, generate_windows
+from exporters import PUMP_RECORDS, VENDOR_FORMATS, stream_export, write_export
+from records import BolusRecord, CBGRecord, SMBGRecord
+from segments import STUDIO_VALUE, load_library, read_export
+from writers import merge_windows
+
+SEED = 4
+
+class Collector:
+
+    def __init__(self):
+
+        self.pieces = []
+
+    def write(self, text):
+
+        self.pieces.append(text)
+
+class ExportersTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.directory = tempfile.mkdtemp()
+
+        synthetic_library(os.path.join(cls.directory, 'segments.bin'))
+
+        dex = Dexcom(None, 3, segments=load_library(os.path.join(cls.directory, 'segments.bin')), start=dt(2014, 1, 1, 12))
+
+        cls.records = list(merge_windows(generate_windows(dex, 1, seed=SEED)))
+
+        cls.cbg = [record for record in cls.records if isinstance(record, CBGRecord)]
+
+        cls.smbg = [record for record in cls.records if isinstance(record, SMBGRecord)]
+
+        cls.pump = [record for record in cls.records if isinstance(record, PUMP_RECORDS)]
+
+        cls.dual = [record for record in cls.pump if isinstance(record, BolusRecord) and record.extended and record.initial_delivery is not None]
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.directory)
+
+    def export(self, output_format):
+        """Write the records in output_format, returning the number of rows and the header and rows read back with csv."""
+
+        out_file = os.path.join(self.directory, 'export.' + output_format)
+
+        count = write_export(self.records, out_file, output_format)
+
+        with open(out_file) as f:
+            rows = list(csv.reader(f, delimiter='\t' if output_format == 'dexcom.txt' else ','))
+
+        return count, rows[0], rows[1:]
+
+    def column(self, header, rows, name):
+
+        return [row[header.index(name)] for row in rows]
+
+    def test_rows_are_as_wide_as_the_header(self):
+
+        for output_format in VENDOR_FORMATS:
+            count, header, rows = self.export(output_format)
+            self.assertEqual(count, len(rows))
+            for row in rows:
+                self.assertEqual(len(row), len(header))
+
+    def test_dexcom(self):
+
+        count, header, rows = self.export('dexcom.txt')
+
+        self.assertEqual([value for value in self.column(header, rows, STUDIO_VALUE) if value], [str(record.value) for record in self.cbg])
+        self.assertEqual([value for value in self.column(header, rows, 'MeterValue') if value], [str(record.value) for record in self.smbg])
+
+        # read back as a Studio export
+        self.assertEqual(list(read_export(os.path.join(self.directory, 'export.dexcom.txt'))), [(record.time, record.value) for record in self.cbg])
+
+    def test_medtronic(self):
+
+        count, header, rows = self.export('medtronic.csv')
+
+        # the combined column is a date and a time once parsed
+        self.assertEqual(header[:3], ['Index', 'Date', 'Time'])
+
+        # a row for each pump record, and a second for each dual-wave bolus, and none for CGM readings
+        self.assertTrue(self.dual)
+        self.assertEqual(count, len(self.pump) + len(self.dual))
+        self.assertEqual([value for value in self.column(header, rows, 'BG Reading (mg/dL)') if value], [str(record.value) for record in self.smbg])
+
+        self.assertEqual([int(index) for index in self.column(header, rows, 'Index')], list(range(1, count + 1)))
+
+        types = self.column(header, rows, 'Bolus Type')
+
+        for i, bolus_type in enumerate(types):
+            if bolus_type == 'Dual (normal part)':
+                self.assertEqual(types[i + 1], 'Dual (square part)')
+                self.assertEqual(rows[i + 1][1:3], rows[i][1:3])
+
+        self.assertEqual(types.count('Dual (normal part)'), len(self.dual))
+        self.assertEqual(types.count('Dual (square part)'), len(self.dual))
+
+    def test_animas(self):
+
+        count, header, rows = self.export('animas.csv')
+
+        # a row for each pump record, with both parts of a combination bolus in one
+        self.assertEqual(count, len(self.pump))
+        self.assertEqual([value for value in self.column(header, rows, 'Glucose (mg/dL)') if value], [str(record.value) for record in self.smbg])
+        self.assertEqual(self.column(header, rows, 'Bolus Type').count('Combination'), len(self.dual))
+
+    def test_stream_matches_file(self):
+
+        for output_format in VENDOR_FORMATS:
+            out = Collector()
+            self.assertEqual(stream_export(self.records, out, output_format, 4096), self.export(output_format)[0])
+            with open(os.path.join(self.directory, 'export.' + output_format)) as f:
+                self.assertEqual(''.join(out.pieces), f.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from datetime import datetime as dt
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from benchmark import synthetic_library
+from demo_data import Dexcom, generate_windows
+from records import BasalSegment, BolusRecord, CarbsRecord, CBGRecord, SMBGRecord
+from rollups import DailyRollups, load_rollups
+from segments import load_library
+from writers import merge_windows
+
+# 2014-01-01, in seconds since the epoch
+DAY = 16071 * 86400
+
+def readings(days, rng):
+    """Return time-ordered records of days of CGM readings every five minutes, with meter readings, boluses and carbs."""
+
+    records = []
+
+    for time in range(DAY, DAY + days * 86400, 300):
+        records.append(CBGRecord(time, rng.randint(40, 400)))
+        if time % 10800 == 0:
+            records.append(SMBGRecord(time, rng.randint(40, 400)))
+            records.append(CarbsRecord(time, rng.randint(10, 90)))
+            records.append(BolusRecord(time, rng.randint(1, 90) / 10.0, 1.0))
+
+    return records
+
+def rollups(records):
+
+    daily = DailyRollups()
+
+    for record in records:
+        daily.add(record)
+
+    return daily
+
+def delivered(segments):
+    """Return the basal insulin delivered each day by segments, worked out span by span: the temp rate where a temp basal runs, otherwise the scheduled rate."""
+
+    days = {}
+
+    points = sorted(set([s.start for s in segments] + [s.end for s in segments] + [(s.start // 86400 + 1) * 86400 for s in segments]))
+
+    for start, end in zip(points, points[1:]):
+        running = dict((s.delivery_type, s.rate) for s in segments if s.start <= start < s.end)
+        rate = running.get('temp', running.get('scheduled', 0.0))
+        days[start // 86400] = days.get(start // 86400, 0.0) + rate * (end - start) / 3600.0
+
+    return days
+
+def hours(day, start, end, rate, delivery_type='scheduled'):
+
+    return BasalSegment(DAY + day * 86400 + int(start * 3600), DAY + day * 86400 + int(end * 3600), rate, delivery_type)
+
+class BasalTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.directory = tempfile.mkdtemp()
+
+        synthetic_library(os.path.join(cls.directory, 'segments.bin'))
+
+        cls.library = load_library(os.path.join(cls.directory, 'segments.bin'))
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.directory)
+
+    def generated(self, days, seed):
+
+        dex = Dexcom(None, days, segments=self.library, start=dt(2014, 1, 1, 12))
+
+        return [record for record in merge_windows(generate_windows(dex, 1, seed=seed)) if record.type == 'basal-rate-segment']
+
+    def units(self, daily):
+
+        return dict((day, rollup.to_dict(day)['basalUnits']) for day, rollup in daily.days.items())
+
+    def test_temps_replace_the_schedule(self):
+
+        segments = [
+            hours(0, 0, 6, 1.0),
+            # runs on into the next scheduled segment, which starts while it runs
+            hours(0, 5, 7, 3.0, 'temp'),
+            hours(0, 6, 24, 1.0),
+            # runs past midnight
+            hours(0, 23, 25, 0.0, 'temp'),
+            hours(1, 0, 24, 1.0)
+        ]
+
+        self.assertEqual(self.units(rollups(sorted(segments, key=lambda s: s.start))), {DAY // 86400: 27.0, DAY // 86400 + 1: 23.0})
+
+    def test_days_without_temps_are_the_schedule(self):
+
+        scheduled = [s for s in self.generated(6, 1) if s.delivery_type == 'scheduled']
+
+        units = self.units(rollups(scheduled))
+
+        # the first and last days are only partly covered
+        whole = sorted(units)[1:-1]
+
+        self.assertTrue(whole)
+
+        for day in whole:
+            self.assertEqual(units[day], 20.0)
+
+    def test_days_with_temps_are_what_was_delivered(self):
+
+        for seed in range(5):
+            segments = self.generated(6, seed)
+
+            self.assertTrue([s for s in segments if s.delivery_type == 'temp'])
+
+            expected = delivered(segments)
+
+            for day, rollup in rollups(segments).days.items():
+                self.assertAlmostEqual(rollup.basal, expected[day], places=9)
+
+    def test_append_under_a_running_temp(self):
+
+        segments = [hours(0, 0, 6, 1.0), hours(0, 5, 9, 2.5, 'temp'), hours(0, 6, 12, 1.5), hours(0, 12, 24, 1.0)]
+
+        whole, appended = os.path.join(self.directory, 'whole.json'), os.path.join(self.directory, 'appended.json')
+
+        rollups(segments).write(whole)
+
+        # the data appended after the first scheduled segment starts under the temp basal before it
+        rollups(segments[:2]).write(appended)
+        daily = DailyRollups()
+        daily.follow(segments[1:2])
+        for segment in segments[2:]:
+            daily.add(segment)
+        daily.append(appended)
+
+        with open(whole) as f, open(appended) as g:
+            self.assertEqual(g.read(), f.read())
+
+class AppendTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+
+        with open(os.path.join(self.directory, name)) as f:
+            return f.read()
+
+    def test_append_matches_write(self):
+
+        records = readings(4, random.Random(1))
+
+        whole, appended = os.path.join(self.directory, 'whole.json'), os.path.join(self.directory, 'appended.json')
+
+        rollups(records).write(whole)
+
+        # split part way through a day, which the two parts share, and then at midnight
+        middle = len(records) // 2 + 7
+        midnight = [i for i, record in enumerate(records) if record.time == DAY + 3 * 86400][0]
+
+        rollups(records[:middle]).write(appended)
+        rollups(records[middle:midnight]).append(appended)
+        rollups(records[midnight:]).append(appended)
+
+        self.assertEqual(self.read('appended.json'), self.read('whole.json'))
+
+        self.assertEqual(sorted(load_rollups(appended).days), sorted(rollups(records).days))
+
+    def test_append_to_nothing(self):
+
+        records = readings(2, random.Random(2))
+
+        rollups(records).write(os.path.join(self.directory, 'whole.json'))
+
+        # no file yet, and then a file with no days
+        rollups(records).append(os.path.join(self.directory, 'new.json'))
+        DailyRollups().write(os.path.join(self.directory, 'empty.json'))
+        rollups(records).append(os.path.join(self.directory, 'empty.json'))
+
+        self.assertEqual(self.read('new.json'), self.read('whole.json'))
+        self.assertEqual(self.read('empty.json'), self.read('whole.json'))
+
+if __name__ == '__main__':
+    unittest.main()
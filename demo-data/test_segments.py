@@ -0,0 +1,194 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from exporters import write_export
+from records import CBGRecord
+from segments import build_library, load_library, read_export, split_runs, write_library
+
+# 2014-01-01, in seconds since the epoch
+DAY = 16071 * 86400
+
+def readings(start, values, interval=300):
+    """Return (seconds since the epoch, value) readings of values interval seconds apart from start."""
+
+    return [(start + i * interval, value) for i, value in enumerate(values)]
+
+def lengths(runs):
+
+    return [len(run) for run in runs]
+
+class SplitRunsTest(unittest.TestCase):
+
+    def test_gaps(self):
+
+        # 10 minutes late is a gap, but a minute either way is not
+        trace = readings(DAY, range(100, 110)) + readings(DAY + 9 * 300 + 600, range(200, 208)) + readings(DAY + 17 * 300 + 660, range(300, 307))
+
+        self.assertEqual(list(split_runs(trace)), [list(range(100, 110)), list(range(200, 208)) + list(range(300, 307))])
+
+    def test_out_of_order(self):
+
+        trace = readings(DAY, range(100, 108)) + readings(DAY + 300, range(200, 208))
+
+        self.assertEqual(list(split_runs(trace)), [list(range(100, 108)), list(range(200, 208))])
+
+    def test_low_and_high(self):
+
+        values = list(range(100, 108)) + [None] + list(range(200, 210)) + [None, None] + list(range(300, 306))
+
+        self.assertEqual(list(split_runs(readings(DAY, values))), [list(range(100, 108)), list(range(200, 210)), list(range(300, 306))])
+
+    def test_short_runs_are_dropped(self):
+
+        values = [100] * 5 + [None] + [200] * 6 + [None] + [300]
+
+        self.assertEqual(lengths(split_runs(readings(DAY, values))), [6])
+        self.assertEqual(lengths(split_runs(readings(DAY, values), min_length=1)), [5, 6, 1])
+
+    def test_max_length(self):
+
+        values = list(range(100, 120))
+
+        self.assertEqual(list(split_runs(readings(DAY, values), 3, 8)), [values[:8], values[8:16], values[16:]])
+        self.assertEqual(lengths(split_runs(readings(DAY, values), 6, 8)), [8, 8])
+        self.assertEqual(lengths(split_runs(readings(DAY, values), 6, 10)), [10, 10])
+
+class BuildLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+
+        return os.path.join(self.directory, name)
+
+    def export(self, name, records, encoding='utf-8'):
+        """Write records as a Dexcom Studio export, and reencode it as Studio would, with a byte order mark, for utf-16."""
+
+        write_export(records, self.path(name), 'dexcom.txt')
+
+        if encoding != 'utf-8':
+            with io.open(self.path(name), 'r', encoding='utf-8') as f:
+                text = f.read()
+            with io.open(self.path(name), 'w', encoding=encoding) as f:
+                f.write(text)
+
+        return self.path(name)
+
+    def trace(self, rng, days):
+        """Return CGM records of days of readings, broken up by gaps and by readings the receiver showed as Low or High."""
+
+        records, time = [], DAY
+
+        while time < DAY + days * 86400:
+            chance = rng.random()
+            if chance < 0.01:
+                time += rng.randint(2, 30) * 300
+            elif chance < 0.02:
+                records.append(CBGRecord(time, rng.choice(['Low', 'High'])))
+            else:
+                records.append(CBGRecord(time, rng.randint(40, 400)))
+            time += 300
+
+        return records
+
+    def read(self, name):
+
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def expected(self, filenames, name, min_length=6, max_length=288):
+        """Write the library the exports should build, worked out in memory, returning its runs."""
+
+        runs = [run for filename in filenames for run in split_runs(read_export(filename), min_length, max_length)]
+
+        # stable, so the runs of each start value stay in the order of the exports
+        runs.sort(key=lambda run: run[0])
+
+        starts = sorted(set(run[0] for run in runs))
+
+        write_library([(start, len([run for run in runs if run[0] == start])) for start in starts], runs, self.path(name))
+
+        return runs
+
+    def test_exports(self):
+
+        rng = random.Random(5)
+
+        filenames = [self.export('%d.txt' % i, self.trace(rng, 2 + i), 'utf-16' if i % 2 else 'utf-8') for i in range(5)]
+
+        runs = self.expected(filenames, 'expected.bin', max_length=100)
+
+        self.assertTrue(len(runs) > 10)
+
+        for processes in [1, 3]:
+            self.assertEqual(build_library(filenames, self.path('%d.bin' % processes), processes, max_length=100), (len(runs), len(set(run[0] for run in runs))))
+
+        self.assertEqual(self.read('1.bin'), self.read('expected.bin'))
+        self.assertEqual(self.read('3.bin'), self.read('expected.bin'))
+
+        library = load_library(self.path('3.bin'))
+
+        self.assertEqual(sum(library.counts), len(runs))
+        self.assertEqual([list(library.segment(i)) for i in range(len(runs))], runs)
+
+    def test_encodings(self):
+
+        records = self.trace(random.Random(6), 1)
+
+        utf8, utf16 = self.export('utf8.txt', records), self.export('utf16.txt', records, 'utf-16')
+
+        self.assertNotEqual(self.read('utf8.txt'), self.read('utf16.txt'))
+
+        self.assertEqual(list(read_export(utf16)), list(read_export(utf8)))
+
+        self.assertEqual([value for time, value in read_export(utf8)], [record.value if record.value not in ('Low', 'High') else None for record in records])
+
+    def test_no_usable_runs(self):
+
+        # every run too short, between Low readings
+        records = [CBGRecord(DAY + i * 300, 'Low' if i % 5 == 4 else 120) for i in range(200)]
+
+        filename = self.export('short.txt', records, 'utf-16')
+
+        self.assertEqual(build_library([filename, filename], self.path('empty.bin'), 2), (0, 0))
+
+        write_library([], [], self.path('expected.bin'))
+
+        self.assertEqual(self.read('empty.bin'), self.read('expected.bin'))
+
+        library = load_library(self.path('empty.bin'))
+
+        self.assertEqual((library.starts, library.counts, library.num_segments), ([], [], 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from benchmark import synthetic_library
+from segments import load_library
+from service import GeneratorServer, UnixGeneratorServer, parse_request
+
+REQUEST = {'num_days': 2, 'seed': 11, 'start': '2014-01-01T12:00:00'}
+
+class Collector:
+    """Gather what is written to it, as the service's chunked responses are."""
+
+    def __init__(self):
+
+        self.pieces = []
+
+    def write(self, text):
+
+        self.pieces.append(text)
+
+def dechunk(data):
+    """Return the body of a chunked response and the sizes of its chunks, checking each is framed as its size says."""
+
+    body, sizes = [], []
+
+    while True:
+        line, data = data.split(b'\r\n', 1)
+        size = int(line, 16)
+        sizes.append(size)
+        if not size:
+            assert data == b'\r\n', 'data after the last chunk'
+            return b''.join(body), sizes
+        assert data[size:size + 2] == b'\r\n', 'chunk of the wrong size'
+        body.append(data[:size])
+        data = data[size + 2:]
+
+def send(sock, method, path, content=None):
+    """Make an HTTP request on sock, closing the connection, and return the head and the raw body of the response."""
+
+    body = b'' if content is None else content if isinstance(content, bytes) else json.dumps(content).encode('utf-8')
+
+    sock.sendall(('%s %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\nContent-Length: %d\r\n\r\n' % (method, path, len(body))).encode('ascii') + body)
+
+    pieces = []
+    while True:
+        piece = sock.recv(65536)
+        if not piece:
+            break
+        pieces.append(piece)
+    sock.close()
+
+    return b''.join(pieces).split(b'\r\n\r\n', 1)
+
+def exchange(sock, method, path, content=None):
+    """Make an HTTP request on sock as send does, and return the status, headers and body of the response."""
+
+    head, body = send(sock, method, path, content)
+
+    lines = head.decode('ascii').split('\r\n')
+
+    headers = dict((name.lower(), value.strip()) for name, value in (line.split(':', 1) for line in lines[1:]))
+
+    if headers.get('transfer-encoding') == 'chunked':
+        body = dechunk(body)[0]
+
+    return int(lines[0].split()[1]), headers, body
+
+class ServiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.directory = tempfile.mkdtemp()
+
+        synthetic_library(os.path.join(cls.directory, 'segments.bin'))
+
+        cls.library = load_library(os.path.join(cls.directory, 'segments.bin'))
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+
+        self.server = GeneratorServer(('127.0.0.1', 0), library=self.library, workers=3)
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, method, path, content=None):
+
+        return exchange(socket.create_connection(self.server.server_address), method, path, content)
+
+    def expected(self, content):
+        """Return what the service generates for content, written straight through rather than over HTTP."""
+
+        out = Collector()
+
+        self.server.generate(parse_request(content), out)
+
+        return ''.join(out.pieces).encode('utf-8')
+
+    def test_chunked_body(self):
+
+        head, data = send(socket.create_connection(self.server.server_address), 'POST', '/generate', dict(REQUEST, num_days=4))
+
+        self.assertTrue(head.startswith(b'HTTP/1.1 200'))
+        self.assertIn(b'Transfer-Encoding: chunked', head)
+        self.assertIn(b'Content-Type: application/x-ndjson', head)
+
+        body, sizes = dechunk(data)
+
+        # several chunks, each but the last at least CHUNK_SIZE bytes, and the empty one that ends the response
+        self.assertTrue(len(sizes) > 2)
+        self.assertEqual(sizes[-1], 0)
+
+        self.assertEqual(body, self.expected(dict(REQUEST, num_days=4)))
+
+    def test_formats(self):
+
+        for output_format in ['json', 'array', 'dexcom.txt', 'medtronic.csv']:
+            status, headers, body = self.request('POST', '/generate', dict(REQUEST, format=output_format))
+            self.assertEqual(status, 200)
+            self.assertEqual(body, self.expected(dict(REQUEST, format=output_format)))
+
+    def test_seeded_requests_at_once(self):
+
+        bodies = [None] * 6
+
+        def post(i):
+            # alternating between two seeds
+            bodies[i] = self.request('POST', '/generate', dict(REQUEST, seed=i % 2))[2]
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(len(bodies))]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(bodies[0])
+        self.assertEqual(bodies[0::2], [bodies[0]] * 3)
+        self.assertEqual(bodies[1::2], [bodies[1]] * 3)
+        self.assertNotEqual(bodies[0], bodies[1])
+
+    def test_bad_requests(self):
+
+        for content in [b'{"num_days": ', [1, 2], {'format': 'npz'}, {'format': 'ndjson.gz'}, {'num_days': 0}, {'seed': 'one'}, {'ids': 'sequential'}, {'start': 'yesterday'}, {'schedule': {'noon': 1.0}}]:
+            status, headers, body = self.request('POST', '/generate', content)
+            self.assertEqual(status, 400)
+            self.assertEqual(headers['content-type'], 'application/json')
+            self.assertIn('error', json.loads(body.decode('utf-8')))
+
+        self.assertEqual(self.request('POST', '/elsewhere', {})[0], 404)
+        self.assertEqual(self.request('GET', '/elsewhere')[0], 404)
+
+    def test_status(self):
+
+        lines = 0
+
+        for seed in range(3):
+            status, headers, body = self.request('POST', '/generate', dict(REQUEST, seed=seed))
+            lines += body.count(b'\n')
+
+        self.request('POST', '/generate', {'format': 'npz'})
+
+        status, headers, body = self.request('GET', '/')
+
+        self.assertEqual(status, 200)
+
+        content = json.loads(body.decode('utf-8'))
+
+        self.assertEqual(content['status'], 'ok')
+        self.assertEqual(content['workers'], 3)
+        self.assertEqual(content['segments'], sum(self.library.counts))
+        # bad requests are not counted, as nothing was generated for them
+        self.assertEqual(content['requests'], 3)
+        self.assertEqual(content['errors'], 0)
+        self.assertEqual(content['records'], lines)
+
+class UnixServiceTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def test_socket_is_removed(self):
+
+        synthetic_library(os.path.join(self.directory, 'segments.bin'))
+
+        path = os.path.join(self.directory, 'service.sock')
+
+        # left behind by a service that was not shut down cleanly
+        open(path, 'w').close()
+
+        server = UnixGeneratorServer(path, library=load_library(os.path.join(self.directory, 'segments.bin')), workers=1)
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+
+        status, headers, body = exchange(sock, 'GET', '/')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8'))['requests'], 0)
+
+        server.shutdown()
+        server.server_close()
+
+        self.assertFalse(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import json
+import socket
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from text import BaconIpsumProvider, WordBankProvider
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answer bacon ipsum requests with text naming the number of sentences asked for, or with the server's status."""
+
+    def do_GET(self):
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        sentences = self.path.rsplit('=', 1)[1]
+
+        body = json.dumps(['stand-in text of %s sentences' % sentences]).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+
+        pass
+
+class StandInServer(HTTPServer):
+
+    def __init__(self, status=200):
+
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+
+        self.status = status
+
+        self.requests = 0
+
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self):
+
+        return 'http://127.0.0.1:%d/api/?type=meat-and-filler&sentences=' % self.server_address[1]
+
+    def stop(self):
+
+        self.shutdown()
+        self.server_close()
+
+def unused_port():
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+class BaconIpsumProviderTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.server = StandInServer()
+
+    def tearDown(self):
+
+        self.server.stop()
+
+    def test_prefetch_fetches_each_key_once(self):
+
+        provider = BaconIpsumProvider(self.server.url(), workers=4, batch_size=3)
+
+        keys = [(1, 0), (2, 0), (3, 5), (1, 0), (2, 7), (3, 5)]
+
+        provider.prefetch(keys)
+
+        self.assertEqual(self.server.requests, 4)
+
+        for key in keys:
+            self.assertEqual(provider.text(key), 'stand-in text of %d sentences' % key[0])
+
+        # every piece of text was already cached
+        self.assertEqual(self.server.requests, 4)
+
+        provider.close()
+
+    def test_lru_hits_and_evictions(self):
+
+        provider = BaconIpsumProvider(self.server.url(), cache_size=2)
+
+        provider.text((1, 0))
+        provider.text((2, 0))
+        provider.text((1, 0))
+
+        self.assertEqual(self.server.requests, 2)
+
+        # evicts (2, 0), the least recently used
+        provider.text((3, 0))
+        provider.text((1, 0))
+
+        self.assertEqual(self.server.requests, 3)
+
+        provider.text((2, 0))
+
+        self.assertEqual(self.server.requests, 4)
+
+        provider.close()
+
+    def test_falls_back_on_server_errors(self):
+
+        self.server.status = 503
+
+        provider = BaconIpsumProvider(self.server.url(), workers=2)
+
+        provider.prefetch([(1, 3), (2, 4)])
+
+        self.assertEqual(provider.failures, 2)
+
+        self.assertEqual(provider.text((1, 3)), WordBankProvider().text((1, 3)))
+
+        provider.close()
+
+    def test_falls_back_when_server_is_down(self):
+
+        provider = BaconIpsumProvider('http://127.0.0.1:%d/?sentences=' % unused_port(), timeout=5)
+
+        self.assertEqual(provider.text((2, 1)), WordBankProvider().text((2, 1)))
+
+        self.assertEqual(provider.failures, 1)
+
+if __name__ == '__main__':
+    unittest.main()
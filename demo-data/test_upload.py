@@ -0,0 +1,169 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zlib
+
+from upload import StubServer, Uploader, iter_array, read_batches
+
+RECORDS = [
+    {'type': 'cbg', 'value': 123, 'deviceTime': '2014-01-01T12:00:00'},
+    {'type': 'smbg', 'value': 98.5, 'deviceTime': '2014-01-01T12:05:00'},
+    {'type': 'message', 'messageText': u'bacon, [ham] and "eggs" \u00e9', 'parentMessage': None, 'deviceTime': '2014-01-01T12:10:00'},
+    {'type': 'bolus', 'value': 1e-3, 'deviceTime': '2014-01-01T12:15:00'},
+    {'type': 'cbg', 'value': 1234567, 'deviceTime': '2014-01-01T12:20:00'}
+]
+
+class IterArrayTest(unittest.TestCase):
+
+    def parse(self, text, chunk_size):
+
+        # json.dumps gives Python 2 a str, which StringIO does not take
+        return list(iter_array(io.StringIO(text.decode('ascii') if isinstance(text, bytes) else text), chunk_size))
+
+    def test_every_chunk_size(self):
+
+        for text in [json.dumps(RECORDS), json.dumps(RECORDS, indent=4), ' [ 1 , 22 ,333,\n{"a": [4444]} ]\n']:
+            expected = json.loads(text)
+            for chunk_size in range(1, len(text) + 2):
+                self.assertEqual(self.parse(text, chunk_size), expected)
+
+    def test_empty_array(self):
+
+        self.assertEqual(self.parse('[]', 1), [])
+        self.assertEqual(self.parse('[ \n ]\n', 3), [])
+
+    def test_invalid_arrays(self):
+
+        for text in ['', '{"type": "cbg"}', '[1, 2', '[1 2]', '[1,]', '[{"a": 1]']:
+            for chunk_size in [1, 4, 1024]:
+                with self.assertRaises(ValueError):
+                    self.parse(text, chunk_size)
+
+class ReadBatchesTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+
+        out_file = os.path.join(self.directory, name)
+
+        with open(out_file, 'wb') as f:
+            f.write(content)
+
+        return out_file
+
+    def test_formats(self):
+
+        lines = [(json.dumps(record) + '\n').encode('utf-8') for record in RECORDS]
+
+        # compressed two records at a time, as writers.write_compressed does, so the file is several gzip members
+        members = [gzip_compress(b''.join(lines[i:i + 2])) for i in range(0, len(lines), 2)]
+
+        files = [
+            self.write('data.json', json.dumps(RECORDS, indent=4).encode('utf-8')),
+            self.write('data.ndjson', b''.join(lines)),
+            self.write('data.ndjson.gz', b''.join(members)),
+            self.write('data.json.gz', gzip_compress(json.dumps(RECORDS).encode('utf-8')))
+        ]
+
+        for filename in files:
+            batches = list(read_batches([filename], 2))
+            self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+            self.assertEqual([json.loads(record) for batch in batches for record in batch], RECORDS)
+
+        # batches run on from one file into the next
+        self.assertEqual([len(batch) for batch in read_batches(files, 3)], [3] * 6 + [2])
+
+class UploaderTest(unittest.TestCase):
+
+    def start(self, fail_rate):
+
+        server = StubServer(('127.0.0.1', 0), fail_rate)
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        return server, 'http://127.0.0.1:%d/data' % server.server_address[1]
+
+    def batches(self, count, size):
+
+        records = [json.dumps(dict(RECORDS[0], value=i)) for i in range(count * size)]
+
+        return [records[i:i + size] for i in range(0, len(records), size)]
+
+    def test_retries_until_accepted(self):
+
+        server, url = self.start(0.5)
+
+        # enough retries that a batch failing every one of them is vanishingly unlikely
+        uploader = Uploader(url, concurrency=3, retries=30, backoff=0.001)
+
+        uploader.upload(self.batches(20, 7))
+
+        stats = uploader.close()
+
+        self.assertEqual(server.records, 140)
+        self.assertEqual(stats.records, 140)
+        self.assertEqual(stats.batches, 20)
+        self.assertTrue(stats.retries > 0)
+        self.assertEqual(stats.errors, 0)
+        self.assertEqual(stats.failed_records, 0)
+
+    def test_every_batch_failing(self):
+
+        server, url = self.start(1.0)
+
+        uploader = Uploader(url, concurrency=2, retries=0, backoff=0.001)
+
+        uploader.upload(self.batches(5, 3))
+
+        stats = uploader.close()
+
+        self.assertEqual(server.records, 0)
+        self.assertEqual(stats.records, 0)
+        self.assertEqual(stats.retries, 0)
+        self.assertEqual(stats.errors, 5)
+        self.assertEqual(stats.failed_records, 15)
+
+def gzip_compress(data):
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    return compressor.compress(data) + compressor.flush()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# Run with python -m unittest discover -s demo-data
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import copy
+from datetime import datetime as dt
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from benchmark import synthetic_library
+from columnar import TIME_COLUMNS, np, pa, type_file
+from demo_data import Dexcom, finalise_records, generate_windows
+from ids import IDAllocator
+from segments import load_library
+from writers import merge_windows, write_compressed, write_records, zstandard
+
+SEED = 3
+
+def gunzip(data):
+    """Return the decompressed contents of every gzip member of data, one after another."""
+
+    out = []
+
+    while data:
+        decompressor = zlib.decompressobj(31)
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+
+    return b''.join(out)
+
+def unzstd(data):
+    """Return the decompressed contents of every zstd frame of data, one after another."""
+
+    out = []
+
+    while data:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+
+    return b''.join(out)
+
+class WritersTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.directory = tempfile.mkdtemp()
+
+        synthetic_library(os.path.join(cls.directory, 'segments.bin'))
+
+        dex = Dexcom(None, 3, segments=load_library(os.path.join(cls.directory, 'segments.bin')), start=dt(2014, 1, 1, 12))
+
+        ids = IDAllocator('uuid4', SEED)
+
+        cls.records = list(finalise_records(merge_windows(generate_windows(dex, 1, ids=ids, seed=SEED)), ids))
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.directory)
+
+    def fresh(self):
+        """Return a copy of the records, as writing them formats their timestamps in place."""
+
+        return copy.deepcopy(self.records)
+
+    def path(self, name):
+
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def ndjson(self):
+
+        write_records(self.fresh(), self.path('records.ndjson'), 'ndjson')
+
+        return self.read('records.ndjson')
+
+    def test_ndjson_gz_is_compressed_ndjson(self):
+
+        expected = self.ndjson()
+
+        self.assertEqual(write_records(self.fresh(), self.path('records.ndjson.gz'), 'ndjson.gz'), len(self.records))
+        self.assertEqual(gunzip(self.read('records.ndjson.gz')), expected)
+
+        # many more chunks than workers, and a last chunk that is not full
+        for workers in [1, 3]:
+            for chunk_size in [1, 7, len(self.records) - 1]:
+                write_compressed(self.fresh(), self.path('chunked.ndjson.gz'), 'ndjson.gz', chunk_size=chunk_size, workers=workers, level=1)
+                self.assertEqual(gunzip(self.read('chunked.ndjson.gz')), expected)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_ndjson_zst_is_compressed_ndjson(self):
+
+        expected = self.ndjson()
+
+        write_records(self.fresh(), self.path('records.ndjson.zst'), 'ndjson.zst', workers=3, level=1)
+        self.assertEqual(unzstd(self.read('records.ndjson.zst')), expected)
+
+        write_compressed(self.fresh(), self.path('chunked.ndjson.zst'), 'ndjson.zst', chunk_size=7, workers=2)
+        self.assertEqual(unzstd(self.read('chunked.ndjson.zst')), expected)
+
+    def by_type(self):
+
+        types = {}
+
+        for record in self.records:
+            types.setdefault(record['type'], []).append(record)
+
+        return types
+
+    @unittest.skipIf(np is None, 'NumPy is not installed')
+    def test_npz_times_are_epoch_seconds(self):
+
+        write_records(self.fresh(), self.path('records.npz'), 'npz')
+
+        for record_type, records in self.by_type().items():
+            with np.load(type_file(self.path('records.npz'), record_type, 'npz')) as columns:
+                self.assertEqual(len(columns['type']), len(records))
+                for field in TIME_COLUMNS:
+                    if field in records[0]:
+                        self.assertEqual(columns[field].dtype, np.int64)
+                        self.assertEqual(columns[field].tolist(), [record[field] for record in records])
+
+    @unittest.skipIf(pa is None, 'pyarrow is not installed')
+    def test_arrow_round_trip(self):
+
+        write_records(self.fresh(), self.path('records.arrow'), 'arrow')
+
+        for record_type, records in self.by_type().items():
+            with pa.OSFile(type_file(self.path('records.arrow'), record_type, 'arrow'), 'rb') as f:
+                table = pa.ipc.open_file(f).read_all()
+            self.assertEqual(table.num_rows, len(records))
+            for field in TIME_COLUMNS:
+                if field in records[0]:
+                    self.assertEqual(table.column(field).cast(pa.int64()).to_pylist(), [record[field] for record in records])
+            self.assertEqual(table.column('id').to_pylist(), [record['id'] for record in records])
+
+if __name__ == '__main__':
+    unittest.main()
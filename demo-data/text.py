@@ -0,0 +1,232 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from collections import OrderedDict
+from datetime import datetime as dt
+import json
+from multiprocessing.pool import ThreadPool
+import random
+import threading
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+BACON_IPSUM_URL = 'https://baconipsum.com/api/?type=meat-and-filler&sentences='
+
+# word bank for offline text, in the style of bacon ipsum
+CORPUS = """
+Bacon ipsum dolor amet pork belly short ribs fatback, ham hock tenderloin sausage filler.
+Pastrami turkey brisket, sirloin beef ribs and chuck shank meatball kielbasa.
+Short loin ground round t-bone, porchetta pancetta tri-tip andouille jowl.
+Frankfurter drumstick corned beef, spare ribs flank swine bresaola salami cupim.
+Leberkas hamburger rump shoulder, picanha beef capicola biltong prosciutto.
+Chicken venison boudin, strip steak pig landjaeger ball tip doner tongue.
+Tail buffalo kevin, meatloaf filet mignon jerky burgdoggen alcatra chislic.
+Ham pork loin sausage, bacon brisket pork chop turducken shankle ribeye.
+Ribeye sirloin beef, turkey tenderloin bacon pastrami short ribs and ham hock.
+Pork chop fatback chuck, ground round sausage meatball andouille prosciutto bresaola.
+"""
+
+def _build_chain(corpus):
+
+    chain = {}
+
+    for sentence in corpus.split('.'):
+        words = sentence.split()
+        if not words:
+            continue
+        for current, following in zip([None] + words, words + [None]):
+            chain.setdefault(current, []).append(following)
+
+    return chain
+
+CHAIN = _build_chain(CORPUS)
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used item when full."""
+
+    def __init__(self, size):
+
+        self.size = size
+
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+
+        return key in self.items
+
+    def get(self, key):
+        """Return the item for key, raising KeyError if it is not cached."""
+
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+
+        self.items.pop(key, None)
+        self.items[key] = value
+
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+class TextProvider:
+    """Supply message text, memoising up to cache_size pieces of generated text.
+
+    Text is looked up by a key of (number of sentences, variant); variants
+    bounds how many distinct pieces of text there are for each length.
+    """
+
+    def __init__(self, cache_size=1024, variants=64):
+
+        self.cache = LRUCache(cache_size)
+
+        self.variants = variants
+
+    def key(self, sentences, rng=random):
+        """Return the key of a random piece of text with the given number of sentences."""
+
+        return (sentences, rng.randrange(self.variants))
+
+    def text(self, key):
+        """Return the text for key."""
+
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            value = self._generate(key)
+            self.cache.put(key, value)
+            return value
+
+    def prefetch(self, keys):
+        """Make the text for keys available ahead of use; a no-op for providers that are cheap to call."""
+
+        pass
+
+    def close(self):
+
+        pass
+
+    def _generate(self, key):
+
+        raise NotImplementedError
+
+class WordBankProvider(TextProvider):
+    """Generate bacon ipsum style text offline from a word bank shipped with the generator."""
+
+    def _generate(self, key):
+
+        sentences, variant = key
+
+        # seeded from the key, so the text for a key is always the same and the shared RNG is left alone
+        rng = random.Random(sentences * 100003 + variant)
+
+        text = []
+
+        for i in range(sentences):
+            words = []
+            word = rng.choice(CHAIN[None])
+            while word is not None:
+                words.append(word)
+                word = rng.choice(CHAIN[word])
+            text.append(' '.join(words) + '.')
+
+        return ' '.join(text)
+
+class BaconIpsumProvider(TextProvider):
+    """Fetch text from the bacon ipsum API, or a stand-in for it at url, concurrently in batches.
+
+    Text that cannot be fetched, because the server is down or answers with
+    an error or something other than a list of text, falls back to text from
+    the offline word bank, so a run never fails for want of message text.
+    """
+
+    def __init__(self, url=BACON_IPSUM_URL, workers=8, batch_size=32, timeout=30, **kwargs):
+
+        TextProvider.__init__(self, **kwargs)
+
+        self.url = url
+
+        self.fallback = WordBankProvider()
+
+        # pieces of text that could not be fetched and came from the fallback instead
+        self.failures = 0
+
+        self.lock = threading.Lock()
+
+        self.workers = workers
+
+        self.batch_size = batch_size
+
+        self.timeout = timeout
+
+        self.pool = None
+
+    def _generate(self, key):
+
+        try:
+            request = urlopen(self.url + str(key[0]), timeout=self.timeout)
+            text = json.loads(request.read().decode('utf-8'))[0]
+        except (IOError, OSError, ValueError, IndexError, KeyError, TypeError):
+            # URLError, HTTPError and socket timeouts are all IOErrors
+            with self.lock:
+                self.failures += 1
+            # generated afresh rather than through the fallback's cache, which is not shared between threads
+            return self.fallback._generate(key)
+
+        return text
+
+    def prefetch(self, keys):
+
+        missing = sorted(set(key for key in keys if key not in self.cache))
+
+        if not missing:
+            return
+
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+
+        print()
+        print(dt.now(), 'Fetching', len(missing), 'pieces of bacon ipsum...')
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            for key, value in zip(batch, self.pool.map(self._generate, batch)):
+                self.cache.put(key, value)
+
+    def close(self):
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+PROVIDERS = {
+    'offline': WordBankProvider,
+    'baconipsum': BaconIpsumProvider
+}
+
+def get_provider(name, url=BACON_IPSUM_URL):
+    """Return a new text provider of the named kind."""
+
+    if name == 'baconipsum':
+        return BaconIpsumProvider(url)
+
+    return PROVIDERS[name]()
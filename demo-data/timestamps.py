@@ -0,0 +1,69 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from datetime import datetime as dt
+from datetime import timedelta as td
+
+# generated records carry their timestamps as whole seconds since EPOCH, and are
+# only formatted as ISO 8601 strings by the output writer
+EPOCH = dt(1970, 1, 1)
+
+def to_epoch(d):
+    """Return a datetime as whole seconds since EPOCH, dropping any microseconds."""
+
+    delta = d - EPOCH
+
+    return delta.days * 86400 + delta.seconds
+
+def from_epoch(seconds):
+    """Return seconds since EPOCH as a datetime."""
+
+    return EPOCH + td(seconds=seconds)
+
+def parse_time(timestamp):
+    """Return an ISO 8601 timestamp, as written by TimeFormatter, as seconds since EPOCH."""
+
+    return to_epoch(dt.strptime(timestamp.rstrip('Z'), '%Y-%m-%dT%H:%M:%S'))
+
+class TimeFormatter:
+    """Format seconds since EPOCH as ISO 8601 strings, caching the formatted date, hour and minute.
+
+    Other formats ending in the seconds can be had by passing the strftime
+    pattern of everything up to them as pattern.
+    """
+
+    def __init__(self, size=4096, pattern='%Y-%m-%dT%H:%M:'):
+
+        self.size = size
+
+        self.pattern = pattern
+
+        self.prefixes = {}
+
+    def format(self, seconds):
+
+        minute, second = divmod(seconds, 60)
+
+        try:
+            prefix = self.prefixes[minute]
+        except KeyError:
+            if len(self.prefixes) >= self.size:
+                self.prefixes.clear()
+            prefix = self.prefixes[minute] = from_epoch(minute * 60).strftime(self.pattern)
+
+        return prefix + '%02d' % second
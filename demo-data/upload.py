@@ -0,0 +1,402 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import argparse
+from datetime import datetime as dt
+import gzip
+import io
+import json
+import random
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from httplib import HTTPConnection, HTTPSConnection
+    from Queue import Queue
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Queue
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse
+
+# upper bounds, in milliseconds, of the buckets of the batch latency histogram; the last is unbounded
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# statuses worth trying a batch again for
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# characters of a JSON array file read at a time
+CHUNK_SIZE = 65536
+
+# whitespace allowed between the tokens of JSON
+JSON_SPACE = ' \t\n\r'
+
+def open_text(filename):
+    """Open an ndjson or JSON array file for reading as text, through gzip if its name ends in .gz."""
+
+    if filename.endswith('.gz'):
+        # buffered again for Python 2, whose GzipFile lacks the read1 TextIOWrapper needs
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(filename, 'rb')), encoding='utf-8')
+
+    return io.open(filename, encoding='utf-8')
+
+def iter_array(f, chunk_size=CHUNK_SIZE):
+    """Yield the elements of the JSON array in the text file f, reading and parsing it chunk_size characters at a time.
+
+    Only the element being parsed and what is left of the chunk it is in are
+    held, however long the array is. Raises ValueError if f does not hold a
+    JSON array.
+    """
+
+    decoder = json.JSONDecoder()
+
+    buf, position, eof = '', 0, False
+
+    # '[' before the array, 'first' after it opens, 'value' before an element and ',' after one
+    expect = '['
+
+    while True:
+        while position < len(buf) and buf[position] in JSON_SPACE:
+            position += 1
+
+        if position == len(buf):
+            if eof:
+                raise ValueError('%s ends part way through a JSON array' % getattr(f, 'name', 'the file'))
+            more = f.read(chunk_size)
+            buf, position, eof = buf[position:] + more, 0, not more
+            continue
+
+        if expect == 'value':
+            try:
+                value, end = decoder.raw_decode(buf, position)
+            except ValueError:
+                end = None
+            # an element running to the end of the chunk, a number especially, may carry on into the next
+            if end is None or (end == len(buf) and not eof):
+                if eof:
+                    raise ValueError('%s holds an invalid JSON array element' % getattr(f, 'name', 'the file'))
+                more = f.read(chunk_size)
+                buf, position, eof = buf[position:] + more, 0, not more
+                continue
+            yield value
+            position, expect = end, ','
+        elif expect == '[':
+            if buf[position] != '[':
+                raise ValueError('%s does not hold a JSON array' % getattr(f, 'name', 'the file'))
+            position, expect = position + 1, 'first'
+        elif buf[position] == ']':
+            return
+        elif expect == ',':
+            if buf[position] != ',':
+                raise ValueError('%s holds an invalid JSON array' % getattr(f, 'name', 'the file'))
+            position, expect = position + 1, 'value'
+        else:
+            expect = 'value'
+
+def read_batches(filenames, batch_size):
+    """Read the records of ndjson or JSON array files, yielding them as lists of batch_size JSON strings.
+
+    Files are read a line or a chunk at a time, so they can be any size, and
+    files ending in .gz are decompressed as they are read.
+    """
+
+    batch = []
+
+    for filename in filenames:
+        with open_text(filename) as f:
+            first = f.read(1)
+            f.seek(0)
+            if first == '[':
+                records = (json.dumps(record, separators=(',', ':')) for record in iter_array(f))
+            else:
+                records = (line.strip() for line in f if line.strip())
+            for record in records:
+                batch.append(record)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+
+    if batch:
+        yield batch
+
+class UploadStats:
+    """Counts, errors and a latency histogram of the batches of an upload, shared by its workers."""
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+
+        self.records = 0
+
+        self.batches = 0
+
+        self.retries = 0
+
+        # batches that still failed after all their retries, and the records in them
+        self.errors = 0
+
+        self.failed_records = 0
+
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+        self.started = time.time()
+
+        self.finished = None
+
+    def add(self, records, latency, ok, retries):
+
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and latency * 1000 > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+
+        with self.lock:
+            self.batches += 1
+            self.retries += retries
+            self.histogram[bucket] += 1
+            if ok:
+                self.records += records
+            else:
+                self.errors += 1
+                self.failed_records += records
+
+    def report(self):
+
+        elapsed = (self.finished or time.time()) - self.started
+
+        labels = ['<=%dms' % bound for bound in LATENCY_BUCKETS] + ['>%dms' % LATENCY_BUCKETS[-1]]
+
+        return {
+            'records': self.records,
+            'batches': self.batches,
+            'retries': self.retries,
+            'errors': self.errors,
+            'failed_records': self.failed_records,
+            'seconds': elapsed,
+            'records_per_second': self.records / elapsed if elapsed > 0 else 0.0,
+            'latency_histogram': [[label, count] for label, count in zip(labels, self.histogram)]
+        }
+
+class Uploader:
+    """POST batches of records to a URL from a bounded pool of workers, each holding a keep-alive connection.
+
+    Batches wait in a queue of at most queue_size batches, so reading the
+    records is held back while the workers are busy. A batch that fails with a
+    connection error or a retryable status is tried again up to retries times,
+    backing off exponentially from backoff seconds.
+    """
+
+    def __init__(self, url, concurrency=4, retries=3, backoff=0.1, timeout=30, queue_size=None):
+
+        self.url = urlparse(url)
+
+        self.path = self.url.path or '/'
+
+        self.concurrency = concurrency
+
+        self.retries = retries
+
+        self.backoff = backoff
+
+        self.timeout = timeout
+
+        self.queue = Queue(queue_size or 2 * concurrency)
+
+        self.stats = UploadStats()
+
+        self.workers = [threading.Thread(target=self._work) for i in range(concurrency)]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _connect(self):
+
+        connection_class = HTTPSConnection if self.url.scheme == 'https' else HTTPConnection
+
+        return connection_class(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def _post(self, connection, body):
+        """POST body on connection, returning the status of the response."""
+
+        connection.request('POST', self.path, body, {'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+
+        response = connection.getresponse()
+
+        # the response has to be read in full before the connection can be used again
+        response.read()
+
+        return response.status
+
+    def _work(self):
+
+        connection = self._connect()
+
+        while True:
+            batch = self.queue.get()
+
+            if batch is None:
+                self.queue.task_done()
+                break
+
+            body = ('[' + ','.join(batch) + ']').encode('utf-8')
+
+            start = time.time()
+
+            ok, attempt = False, 0
+
+            while True:
+                try:
+                    status = self._post(connection, body)
+                    ok = 200 <= status < 300
+                    retry = status in RETRY_STATUSES
+                except Exception:
+                    connection.close()
+                    connection = self._connect()
+                    retry = True
+
+                if ok or not retry or attempt >= self.retries:
+                    break
+
+                time.sleep(self.backoff * 2 ** attempt)
+
+                attempt += 1
+
+            self.stats.add(len(batch), time.time() - start, ok, attempt)
+
+            self.queue.task_done()
+
+        connection.close()
+
+    def upload(self, batches):
+        """Queue batches for the workers, blocking while the queue is full."""
+
+        for batch in batches:
+            self.queue.put(batch)
+
+    def close(self):
+        """Wait for the queued batches to be sent, and stop the workers."""
+
+        for worker in self.workers:
+            self.queue.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+        self.stats.finished = time.time()
+
+        return self.stats
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Accept POSTed JSON arrays of records, counting them, and failing a share of requests if asked to."""
+
+    # keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if random.random() < self.server.fail_rate:
+            self._respond(503, {'error': 'unavailable'})
+            return
+
+        try:
+            records = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self._respond(400, {'error': 'invalid JSON'})
+            return
+
+        with self.server.lock:
+            self.server.records += len(records)
+
+        self._respond(200, {'accepted': len(records)})
+
+    def _respond(self, status, content):
+
+        body = json.dumps(content).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+
+        pass
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for an ingest service, for testing uploads against."""
+
+    daemon_threads = True
+
+    def __init__(self, address, fail_rate=0.0):
+
+        HTTPServer.__init__(self, address, StubHandler)
+
+        self.fail_rate = fail_rate
+
+        self.lock = threading.Lock()
+
+        self.records = 0
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Upload generated demo data to an ingest service, or run a local stand-in for one.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    send = subparsers.add_parser('send', help='upload ndjson or JSON array files of demo data')
+    send.add_argument('files', nargs='+', help='files of demo data, as written by demo_data.py, as ndjson, gzipped ndjson or a JSON array')
+    send.add_argument('-u', '--url', action='store', dest='url', default='http://127.0.0.1:8181/data', help='URL to POST batches of records to, as JSON arrays;\ndefault is http://127.0.0.1:8181/data')
+    send.add_argument('-b', '--batch_size', action='store', dest='batch_size', default=500, type=int, help='number of records in each batch;\ndefault is 500')
+    send.add_argument('-c', '--concurrency', action='store', dest='concurrency', default=4, type=int, help='number of batches in flight at once, each on its own keep-alive connection;\ndefault is 4')
+    send.add_argument('-r', '--retries', action='store', dest='retries', default=3, type=int, help='number of times to retry a failed batch;\ndefault is 3')
+
+    stub = subparsers.add_parser('stub', help='run a local stub ingest server')
+    stub.add_argument('-p', '--port', action='store', dest='port', default=8181, type=int, help='port to listen on;\ndefault is 8181')
+    stub.add_argument('--fail_rate', action='store', dest='fail_rate', default=0.0, type=float, help='share of requests to fail with 503, to exercise retries;\ndefault is 0')
+
+    args = parser.parse_args()
+
+    if args.command == 'stub':
+        server = StubServer(('127.0.0.1', args.port), args.fail_rate)
+        print(dt.now(), 'Stub ingest server listening on port', args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print(dt.now(), 'Accepted', server.records, 'records')
+        return
+
+    if args.command != 'send':
+        parser.error('a command, send or stub, is required')
+
+    uploader = Uploader(args.url, args.concurrency, args.retries)
+
+    try:
+        uploader.upload(read_batches(args.files, args.batch_size))
+    finally:
+        stats = uploader.close()
+
+    print(json.dumps(stats.report(), indent=4, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
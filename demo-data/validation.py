@@ -0,0 +1,270 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import sys
+
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schemas')
+
+# the schema the records of a device data file are items of
+ROOT_SCHEMA = 'diabetes.json'
+
+# fields finalise_records adds for storage, which the schemas of the records themselves do not describe
+OUTPUT_FIELDS = ['_id', 'deviceId']
+
+# Python types for each draft-03 simple type; bool is excluded from the numbers separately
+SIMPLE_TYPES = {
+    'string': STRING_TYPES,
+    'number': (int, float),
+    'integer': (int,),
+    'boolean': (bool,),
+    'object': (dict,),
+    'array': (list,),
+    'null': (type(None),)
+}
+
+DATE_TIME = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
+
+def _type_test(types):
+    """Return a Python expression testing whether v is one of the draft-03 types."""
+
+    if isinstance(types, STRING_TYPES):
+        types = [types]
+
+    if 'any' in types:
+        return None
+
+    tests = []
+
+    for name in types:
+        test = 'isinstance(v, %s)' % name.upper()
+        if name in ('number', 'integer'):
+            test = '(%s and not isinstance(v, bool))' % test
+        tests.append(test)
+
+    return ' or '.join(tests)
+
+def compile_schema(schema, name, ignore=()):
+    """Compile a draft-03 object schema into a function returning a list of the errors of a record.
+
+    Only what the schemas in schemas/ use is supported: type, required, enum,
+    the date-time format, local $refs to definitions and additionalProperties.
+    """
+
+    properties = schema.get('properties', {})
+
+    lines = ['def check(record):', '    errors = []']
+
+    constants = {'DATE_TIME': DATE_TIME}
+    for type_name, python_types in SIMPLE_TYPES.items():
+        constants[type_name.upper()] = python_types
+
+    for n, field in enumerate(sorted(properties)):
+        spec = properties[field]
+
+        if '$ref' in spec and spec['$ref'].startswith('#/definitions/'):
+            definition = dict(schema['definitions'][spec['$ref'][len('#/definitions/'):]])
+            definition.update(spec)
+            spec = definition
+
+        checks = []
+
+        if 'type' in spec:
+            test = _type_test(spec['type'])
+            if test is not None:
+                checks.append(('not (%s)' % test, '%s should be of type %s' % (field, json.dumps(spec['type']))))
+
+        if 'enum' in spec:
+            constants['ENUM_%d' % n] = spec['enum']
+            # True and 1 compare equal, so whether each is a boolean is checked as well as the value
+            checks.append(('not any(v == e and isinstance(v, bool) == isinstance(e, bool) for e in ENUM_%d)' % n, '%s should be one of %s' % (field, json.dumps(spec['enum']))))
+
+        if spec.get('format') == 'date-time':
+            checks.append(('isinstance(v, STRING) and not DATE_TIME.match(v)', '%s should be a date-time' % field))
+
+        lines.append('    if %r in record:' % field)
+        lines.append('        v = record[%r]' % field)
+        for test, message in checks:
+            lines.append('        if %s:' % test)
+            lines.append('            errors.append(%r)' % message)
+        if not checks:
+            lines.append('        pass')
+
+        if spec.get('required'):
+            lines.append('    else:')
+            lines.append('        errors.append(%r)' % ('%s is required' % field))
+
+    if schema.get('additionalProperties') is False:
+        constants['ALLOWED'] = frozenset(list(properties) + list(ignore))
+        lines.append('    for key in record:')
+        lines.append('        if key not in ALLOWED:')
+        lines.append("            errors.append('%s is not allowed' % key)")
+
+    lines.append('    return errors')
+
+    namespace = dict(constants)
+
+    exec(compile('\n'.join(lines) + '\n', '<schema %s>' % name, 'exec'), namespace)
+
+    return namespace['check']
+
+def _type_values(schema):
+    """Return the values of the type field a schema admits, or None if it admits any."""
+
+    spec = schema.get('properties', {}).get('type', {})
+
+    if '$ref' in spec and spec['$ref'].startswith('#/definitions/'):
+        spec = schema['definitions'][spec['$ref'][len('#/definitions/'):]]
+
+    return spec.get('enum')
+
+def load_schemas(schema_dir=SCHEMA_DIR, root=ROOT_SCHEMA):
+    """Load the object schemas of the records a root array schema admits, following $refs through anyOf and oneOf.
+
+    Returns a list of (file name, schema).
+    """
+
+    schemas = []
+
+    def visit(filename):
+
+        with open(os.path.join(schema_dir, filename)) as f:
+            schema = json.load(f)
+
+        branches = schema.get('items', schema).get('anyOf') or schema.get('oneOf')
+
+        if branches is None:
+            schemas.append((filename, schema))
+            return
+
+        for branch in branches:
+            visit(os.path.normpath(os.path.join(os.path.dirname(filename), branch['$ref'])))
+
+    visit(root)
+
+    return schemas
+
+class Validator:
+    """Validate device data records against the schemas in schemas/, compiled once into a checker per schema.
+
+    Records are dispatched on their type field to only the checkers of the
+    schemas that admit that type, rather than trying every schema. A record is
+    valid if any of those accepts it; fields in ignore are allowed anywhere.
+    """
+
+    def __init__(self, schema_dir=SCHEMA_DIR, ignore=OUTPUT_FIELDS):
+
+        self.checkers = {}
+
+        # checkers of schemas that do not restrict the type, tried after those that name it
+        self.fallbacks = []
+
+        for filename, schema in load_schemas(schema_dir):
+            check = compile_schema(schema, filename, ignore)
+            values = _type_values(schema)
+            if values is None:
+                self.fallbacks.append(check)
+            else:
+                for value in values:
+                    self.checkers.setdefault(value, []).append(check)
+
+    def errors(self, record):
+        """Return the errors of a record against the schema that fits it best, or an empty list if it is valid."""
+
+        if not isinstance(record, dict):
+            return ['record should be an object']
+
+        best = None
+
+        for check in self.checkers.get(record.get('type'), []) + self.fallbacks:
+            errors = check(record)
+            if not errors:
+                return errors
+            if best is None or len(errors) < len(best):
+                best = errors
+
+        return best if best is not None else ['unknown type %s' % record.get('type')]
+
+    def check(self, record):
+        """Raise ValueError if a record is not valid."""
+
+        errors = self.errors(record)
+
+        if errors:
+            raise ValueError('invalid %s record %s: %s' % (record.get('type'), json.dumps(record, sort_keys=True), '; '.join(errors)))
+
+def read_records(filename):
+    """Yield the records of an ndjson file, a line at a time, or of a file holding one JSON array or record."""
+
+    with open(filename) as f:
+        try:
+            first = json.loads(f.readline())
+        except ValueError:
+            # not one record to a line, so the whole file is one JSON value
+            f.seek(0)
+            content = json.load(f)
+            for record in (content if isinstance(content, list) else [content]):
+                yield record
+            return
+
+        yield first
+
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Validate demo diabetes data against the schemas of the data model.')
+    parser.add_argument('files', nargs='+', help='ndjson or JSON array files of device data')
+    parser.add_argument('--schemas', action='store', dest='schema_dir', default=SCHEMA_DIR, help='directory of the schemas;\ndefault is the schemas directory of this repository')
+    parser.add_argument('--strict', action='store_true', dest='strict', help='use this flag to reject the _id and deviceId fields added for storage where a schema does not allow them')
+    args = parser.parse_args()
+
+    validator = Validator(args.schema_dir, [] if args.strict else OUTPUT_FIELDS)
+
+    invalid = 0
+
+    for filename in args.files:
+        count = 0
+
+        for record in read_records(filename):
+            errors = validator.errors(record)
+            if errors:
+                invalid += 1
+                print('%s: record %d: %s' % (filename, count, '; '.join(errors)))
+            count += 1
+
+        print('%s: %d records' % (filename, count))
+
+    if invalid:
+        print('FAIL:', invalid, 'invalid records')
+        sys.exit(1)
+
+    print('OK: all records valid')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+# == BSD2 LICENSE ==
+# Copyright (c) 2014, Tidepool Project
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the associated License, which is identical to the BSD 2-Clause
+# License as published by the Open Source Initiative at opensource.org.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the License for more details.
+#
+# You should have received a copy of the License along with this program; if
+# not, you can obtain one from Tidepool Project at tidepool.org.
+# == BSD2 LICENSE ==
+
+# for Python 3 compatibility
+from __future__ import print_function
+
+from collections import deque
+import heapq
+import itertools
+import json
+from multiprocessing.pool import ThreadPool
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from columnar import COLUMNAR_FORMATS, write_columnar
+from columnar import available as columnar_available
+from timestamps import TimeFormatter
+
+# ndjson compressed in independently compressed chunks, which concatenate into a valid gzip or zstd file
+COMPRESSED_FORMATS = ['ndjson.gz', 'ndjson.zst']
+
+FORMATS = ['json', 'array', 'ndjson'] + COMPRESSED_FORMATS + COLUMNAR_FORMATS
+
+# fields holding timestamps, as seconds since the epoch until they are written
+TIME_FIELDS = ['deviceTime', 'start', 'end']
+
+def sort_time(record):
+    """Return the timestamp a record is ordered by in the output."""
+
+    return record.time
+
+def _keyed(stream, n):
+
+    for i, record in enumerate(stream):
+        yield (sort_time(record), n, i, record)
+
+def merge_streams(streams):
+    """Merge streams of records, each already in time order, into one time-ordered stream."""
+
+    for key in heapq.merge(*[_keyed(stream, n) for n, stream in enumerate(streams)]):
+        yield key[3]
+
+def merge_windows(windows):
+    """Merge successive windows of record streams into one time-ordered stream.
+
+    windows yields a key that no record of that or any later window sorts
+    before, and the window's time-ordered streams. Records are only held back
+    until no later window can still sort before them.
+    """
+
+    held = []
+
+    sequence = itertools.count()
+
+    for floor, streams in windows:
+        while held and held[0][0] < floor:
+            yield heapq.heappop(held)[2]
+
+        for record in merge_streams(streams):
+            heapq.heappush(held, (sort_time(record), next(sequence), record))
+
+    while held:
+        yield heapq.heappop(held)[2]
+
+def record_time(record):
+    """Return the time, in seconds since the epoch, a record dict is ordered by before it is formatted."""
+
+    if 'deviceTime' in record:
+        return record['deviceTime']
+    if 'start' in record:
+        return record['start']
+    return record['utcTime']
+
+def format_record(record, formatter):
+    """Format the timestamps of a record as ISO 8601 strings."""
+
+    for field in TIME_FIELDS:
+        if field in record:
+            record[field] = formatter.format(record[field])
+    if 'utcTime' in record:
+        record['utcTime'] = formatter.format(record['utcTime']) + 'Z'
+    return record
+
+def format_times(records):
+    """Format the timestamps of records as ISO 8601 strings as they are written."""
+
+    formatter = TimeFormatter()
+
+    for record in records:
+        yield format_record(record, formatter)
+
+def format_available(output_format):
+    """Return whether the libraries output_format needs, if any, are installed."""
+
+    if output_format == 'ndjson.zst':
+        return zstandard is not None
+
+    if output_format in COLUMNAR_FORMATS:
+        return columnar_available(output_format)
+
+    return True
+
+# threads compressing chunks of ndjson.gz and ndjson.zst at once
+COMPRESS_WORKERS = 4
+
+# compression level of each compressed format when none is given
+LEVELS = {'ndjson.gz': 6, 'ndjson.zst': 3}
+
+def _compressor(output_format, level):
+    """Return a function compressing a chunk of bytes as a complete gzip member or zstd frame."""
+
+    if output_format == 'ndjson.zst':
+        if zstandard is None:
+            raise ImportError('ndjson.zst output requires zstandard to be installed')
+        # each call gets its own compressor, as they cannot be shared between threads
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+
+    def gzip_chunk(data):
+        # wbits of 16 + 15 writes a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    return gzip_chunk
+
+def write_compressed(records, out_file, output_format='ndjson.gz', check=None, chunk_size=8192, workers=COMPRESS_WORKERS, level=None):
+    """Write records as ndjson compressed in chunks of chunk_size records, compressing chunks in parallel on a pool of threads.
+
+    Both zlib and zstandard release the GIL while compressing. At most twice
+    as many chunks as workers are in flight at once, and they are written in
+    order. level is the zlib or zstd compression level, by default that of
+    LEVELS. Returns the number of records.
+    """
+
+    compress = _compressor(output_format, level if level is not None else LEVELS[output_format])
+
+    formatter = TimeFormatter()
+
+    pool = ThreadPool(workers)
+
+    pending = deque()
+
+    count = 0
+
+    try:
+        with open(out_file, 'wb') as f:
+            chunk = []
+            for record in records:
+                record = format_record(record, formatter)
+                if check is not None:
+                    check(record)
+                chunk.append(json.dumps(record, separators=(',', ':')))
+                count += 1
+                if len(chunk) == chunk_size:
+                    pending.append(pool.apply_async(compress, (('\n'.join(chunk) + '\n').encode('utf-8'),)))
+                    chunk = []
+                    while len(pending) >= 2 * workers:
+                        f.write(pending.popleft().get())
+            if chunk:
+                pending.append(pool.apply_async(compress, (('\n'.join(chunk) + '\n').encode('utf-8'),)))
+            while pending:
+                f.write(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+
+    return count
+
+def _checked(records, check):
+    """Pass records through, calling check with a formatted copy of each."""
+
+    formatter = TimeFormatter()
+
+    for record in records:
+        check(format_record(dict(record), formatter))
+        yield record
+
+def write_stream(records, f, output_format='json', index=None, check=None):
+    """Write records to the open text file f one at a time, as json, array or ndjson, returning the number of records.
+
+    f need only have a write method, so records can be streamed to a socket
+    as well as a file. index and check are as for write_records.
+    """
+
+    count = 0
+
+    if output_format == 'ndjson':
+        formatter = TimeFormatter()
+        for record in records:
+            time = record_time(record)
+            # ASCII only, as json.dumps escapes anything else, so its length is its size in bytes
+            record = format_record(record, formatter)
+            if check is not None:
+                check(record)
+            line = json.dumps(record, separators=(',', ':')) + '\n'
+            f.write(line)
+            if index is not None:
+                index.add(time, record['type'], len(line))
+            count += 1
+        return count
+
+    records = format_times(records)
+
+    if output_format == 'json':
+        first, separator, end = '\n    ', ',\n    ', '\n]'
+    else:
+        first, separator, end = '', ',', ']'
+
+    f.write('[')
+    for record in records:
+        if check is not None:
+            check(record)
+        f.write(separator if count else first)
+        if output_format == 'json':
+            f.write(json.dumps(record, indent=4, separators=(',', ': ')).replace('\n', '\n    '))
+        else:
+            f.write(json.dumps(record, separators=(',', ':')))
+        count += 1
+    f.write(end if count else ']')
+
+    return count
+
+def write_records(records, out_file, output_format='json', index=None, append=False, check=None, workers=COMPRESS_WORKERS, level=None):
+    """Write records to out_file one at a time, without holding them all in memory.
+
+    output_format is one of FORMATS: 'json' is an indented JSON array, 'array'
+    is a minified JSON array and 'ndjson' is one minified record per line.
+    'ndjson.gz' and 'ndjson.zst' are compressed ndjson, and 'npz' and 'arrow'
+    write a file of columns for each type of record, named after out_file, a
+    chunk of records of the type at a time.
+    An ndjson file can also be indexed as it is written, by passing a
+    dataindex.IndexBuilder as index, and appended to rather than overwritten.
+    check, if given, is called with each record once it is formatted, before
+    it is written, as validation.Validator.check is to stop at an invalid one.
+    workers and level are the threads and compression level of compressed
+    ndjson, as for write_compressed.
+    """
+
+    if append and output_format != 'ndjson':
+        raise ValueError('only ndjson output can be appended to')
+
+    if output_format in COMPRESSED_FORMATS:
+        return write_compressed(records, out_file, output_format, check, workers=workers, level=level)
+
+    if output_format in COLUMNAR_FORMATS:
+        return write_columnar(_checked(records, check) if check is not None else records, out_file, output_format)
+
+    with open(out_file, 'a' if append else 'w') as f:
+        return write_stream(records, f, output_format, index, check)